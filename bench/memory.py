@@ -0,0 +1,182 @@
+"""
+Memory footprint benchmarks
+
+Generates client/transaction histories at increasing scale and records the peak and
+steady state (still allocated after the call returned) memory of the ledger entry points
+with `tracemalloc`. Results are JSON lines, one per target and scale, so runs of
+different engines, caches or indexes can be compared or checked against a budget.
+
+$ python3 -m bench.memory --scales 100 1000 --rows 50 --budget 50000000
+"""
+import argparse
+import csv
+import json
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from main.history import DepositHistory
+from main.payment_gateway import PaymentManager, process
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+SCRIPT = ROOT / 'main' / 'payment_gateway.py'
+
+# runs the CLI as a script and reports its memory on stderr
+CLI = """
+import json, runpy, sys, tracemalloc
+tracemalloc.start()
+sys.argv = [{script!r}, {input!r}]
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+finally:
+    current, peak = tracemalloc.get_traced_memory()
+    sys.stderr.write(json.dumps(dict(peak=peak, steady=current)) + '\\n')
+"""
+
+
+def write_history(path, size) -> dict:
+    """
+    Write a ledger of `size` clients with one deposit each
+    returns: PaymentManager kwargs for the ledger
+    """
+    path = pathlib.Path(path)
+    kwargs = dict(client_csv=path / 'client_accounts.csv', transaction_csv=path / 'transactions.csv')
+
+    with open(kwargs['client_csv'], 'w', encoding=PaymentManager.COLS['client']['encoding']) as f:
+        writer = csv.DictWriter(f, fieldnames=PaymentManager.COLS['client']['fields'])
+        for i in range(1, size + 1):
+            writer.writerow(dict(client="{:05d}".format(i), held="0.00", available="100.00", total="100.00",
+                                 locked="False"))
+
+    with open(kwargs['transaction_csv'], 'w', encoding=PaymentManager.COLS['tx']['encoding']) as f:
+        writer = csv.DictWriter(f, fieldnames=PaymentManager.COLS['tx']['fields'])
+        for i in range(1, size + 1):
+            writer.writerow(dict(type="deposit", client="{:05d}".format(i), tx="{:010d}".format(i), amount="100.00"))
+    return kwargs
+
+
+def batch(size, rows) -> list:
+    """
+    `rows` valid deposits and withdrawals against a history of `size` clients
+    """
+    data = []
+    for i in range(rows):
+        client = "{:05d}".format(i % size + 1)
+        typ = "withdrawal" if i % 2 else "deposit"
+        data.append(dict(type=typ, client=client, tx="{:010d}".format(size + i + 1), amount="1.00"))
+    return data
+
+
+def write_input(path, data):
+    with open(path, 'w', encoding='UTF-32') as f:
+        writer = csv.DictWriter(f, fieldnames=PaymentManager.COLS['tx']['fields'])
+        writer.writeheader()
+        writer.writerows(data)
+
+
+def measure(fn, *args, **kwargs) -> dict:
+    """
+    returns: peak and steady state bytes allocated by `fn`
+    """
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return dict(peak_bytes=peak, steady_bytes=current, seconds=round(seconds, 6))
+
+
+def bench_get_record(kwargs, data) -> dict:
+    pm = PaymentManager(**kwargs)
+    return measure(pm.get_record, 'tx', False, *[d['tx'] for d in data])
+
+
+def bench_process(kwargs, data) -> dict:
+    return measure(process, *data, **kwargs)
+
+
+def bench_history(kwargs, data, horizon=64) -> dict:
+    # builds the tiered history, then looks up the oldest deposits (spilled) and the batch's (misses)
+    def load_and_lookup():
+        with DepositHistory.load(kwargs['transaction_csv'], horizon) as history:
+            history.get_record(False, *["{:010d}".format(i + 1) for i in range(len(data))])
+            history.get_record(False, *[d['tx'] for d in data])
+
+    return measure(load_and_lookup)
+
+
+def bench_cli(kwargs, data) -> dict:
+    # the CLI works on `client_accounts.csv` and `transactions.csv` in its working directory
+    cwd = pathlib.Path(kwargs['client_csv']).parent
+    write_input(cwd / 'input.csv', data)
+
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', CLI.format(script=str(SCRIPT), input=str(cwd / 'input.csv'))],
+                         cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    seconds = time.perf_counter() - start
+    mem = json.loads(out.stderr.strip().splitlines()[-1])
+    return dict(peak_bytes=mem['peak'], steady_bytes=mem['steady'], seconds=round(seconds, 6))
+
+
+# benchmark targets: new engines, caches or indexes register here to be measured the same way
+TARGETS = {'get_record': bench_get_record,
+           'process': bench_process,
+           'history': bench_history,
+           'cli': bench_cli}
+
+
+def run(scales=(100, 1000), rows=50, targets=None) -> list:
+    """
+    returns: one result record per target and history size
+    """
+    results = []
+    for size in scales:
+        for name in targets or TARGETS:
+            # every target gets a fresh ledger
+            with tempfile.TemporaryDirectory() as tmp:
+                kwargs = write_history(tmp, size)
+                rec = dict(target=name, history=size, rows=rows)
+                rec.update(TARGETS[name](kwargs, batch(size, rows)))
+                results.append(rec)
+    return results
+
+
+def over_budget(results, budget) -> list:
+    """
+    returns: results whose peak exceeds `budget` bytes
+    """
+    return [r for r in results if r['peak_bytes'] > budget]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000], help="history sizes")
+    parser.add_argument('--rows', type=int, default=50, help="rows processed per measurement")
+    parser.add_argument('--targets', nargs='+', choices=sorted(TARGETS), help="default: all")
+    parser.add_argument('--budget', type=int, help="fail if a peak exceeds this many bytes")
+    parser.add_argument('--output', help="also append the JSON lines to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.scales, args.rows, args.targets)
+    lines = [json.dumps(r, sort_keys=True) for r in results]
+    print('\n'.join(lines))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    if args.budget and over_budget(results, args.budget):
+        for r in over_budget(results, args.budget):
+            sys.stderr.write("over budget: {target} history={history} peak={peak_bytes}\n".format(**r))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""
+Differential replay harness
+
+Feeds the same transaction stream into the reference `process()` path and into an alternative
+engine on fresh ledgers, diffs the per row accept/reject decisions and the resulting
+`client_accounts`, shrinks diverging streams to a minimal reproducer and reports the
+speedup measured on the same run.
+
+An engine is a callable `engine(rows, ledger) -> decisions` where `ledger` holds the
+`PaymentManager` paths and `decisions` has one entry per row: `ok` or the rejection's class name.
+
+$ python3 -m bench.replay --engine compacted --rows 10000 --clients 500 --seed 1
+$ python3 -m bench.replay --engine compacted --input tx.csv
+"""
+import argparse
+import csv
+import pathlib
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+from bench.workload import MIX, generate, parse_mix
+from main.history import DepositHistory
+from main.partition import partition_rows
+from main.payment_gateway import PaymentManager, Prefetcher, compact_transactions, process
+
+try:
+    from main.settle import settle
+except ImportError:  # numpy is optional
+    settle = None
+
+
+def decision(result) -> str:
+    return type(result[1]).__name__ if isinstance(result, tuple) else 'ok'
+
+
+def reference(rows, ledger) -> list:
+    """
+    The reference path: `process()` one row at a time
+    """
+    decisions = []
+    for row in rows:
+        try:
+            decisions.append(decision(process(dict(row), **ledger)))
+        except Exception as err:
+            # e.g. ValueError for invalid ids
+            decisions.append(type(err).__name__)
+    return decisions
+
+
+def compacted(rows, ledger, every=100) -> list:
+    """
+    Reference path compacting `transactions.csv` every `every` rows
+    """
+    decisions = []
+    for i in range(0, len(rows), every):
+        decisions.extend(reference(rows[i:i + every], ledger))
+        compact_transactions(ledger['transaction_csv'])
+    return decisions
+
+
+def prefetched(rows, ledger, window=64) -> list:
+    """
+    Reference path serving record lookups from a read-ahead buffer of `window` rows
+    """
+    prefetch = Prefetcher(ledger['client_csv'], ledger['transaction_csv'])
+    decisions = []
+    for i in range(0, len(rows), window):
+        batch = rows[i:i + window]
+        prefetch.load(batch)
+        decisions.extend(reference(batch, dict(ledger, prefetch=prefetch)))
+    return decisions
+
+
+def batched(rows, ledger, window=64) -> list:
+    """
+    Reference path saving to a write-back buffer that is flushed once per `window` rows
+    """
+    prefetch = Prefetcher(ledger['client_csv'], ledger['transaction_csv'], write_back=True)
+    decisions = []
+    for i in range(0, len(rows), window):
+        batch = rows[i:i + window]
+        prefetch.load(batch)
+        decisions.extend(reference(batch, dict(ledger, prefetch=prefetch)))
+        prefetch.flush()
+    return decisions
+
+
+def tiered(rows, ledger, horizon=16) -> list:
+    """
+    Reference path serving tx lookups from a tiered history keeping `horizon` txs in memory
+    """
+    with DepositHistory.load(ledger['transaction_csv'], horizon) as history:
+        return reference(rows, dict(ledger, history=history))
+
+
+def partitioned(rows, ledger, span=2) -> list:
+    """
+    Reference path over the input regrouped by ranges of `span` client ids, decisions in input order
+    """
+    order = list(partition_rows(rows, span=span, memory_rows=32))
+    decisions = [None] * len(rows)
+    for (position, _), d in zip(order, reference([row for _, row in order], ledger)):
+        decisions[position] = d
+    return decisions
+
+
+def settled(rows, ledger, window=64) -> list:
+    """
+    Batched settlement of runs of up to `window` deposits and withdrawals, other rows through `process()`
+    """
+    decisions = []
+    while len(decisions) < len(rows):
+        try:
+            for d in settle([dict(row) for row in rows[len(decisions):]], window, **ledger):
+                decisions.append(d)
+        except Exception as err:
+            # e.g. ValueError for invalid ids, settling goes on after the row
+            decisions.append(type(err).__name__)
+    return decisions
+
+
+# alternative engines checked against the reference
+ENGINES = {'reference': reference,
+           'compacted': compacted,
+           'prefetched': prefetched,
+           'batched': batched,
+           'tiered': tiered,
+           'partitioned': partitioned}
+if settle is not None:
+    ENGINES['settled'] = settled
+
+
+def new_ledger(path) -> dict:
+    path = pathlib.Path(path)
+    ledger = dict(client_csv=path / 'client_accounts.csv', transaction_csv=path / 'transactions.csv')
+    for p in ledger.values():
+        p.touch()
+    return ledger
+
+
+def client_state(ledger) -> dict:
+    """
+    returns: client -> (held, available, total, locked) compared by value
+    """
+    state = {}
+    with open(ledger['client_csv'], 'r', encoding=PaymentManager.COLS['client']['encoding']) as f:
+        for row in csv.DictReader(f, fieldnames=PaymentManager.COLS['client']['fields']):
+            row = {k: '' if v is None else str(v).strip() for k, v in row.items()}
+            state[row['client']] = (Decimal(row['held'] or 0), Decimal(row['available'] or 0),
+                                    Decimal(row['total'] or 0), row['locked'] == 'True')
+    return state
+
+
+def run(engine, rows) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = new_ledger(tmp)
+        start = time.perf_counter()
+        decisions = engine(rows, ledger)
+        seconds = time.perf_counter() - start
+        return dict(decisions=decisions, state=client_state(ledger), seconds=seconds)
+
+
+def diff(rows, engine, base=reference) -> dict:
+    """
+    Replay `rows` on both engines
+    returns: the diverging rows, clients and timings of the run
+    """
+    ref, alt = run(base, rows), run(engine, rows)
+    decisions = [dict(row=i, tx=rows[i], reference=a, engine=b)
+                 for i, (a, b) in enumerate(zip(ref['decisions'], alt['decisions'])) if a != b]
+    if len(ref['decisions']) != len(alt['decisions']):
+        decisions.append(dict(row=min(len(ref['decisions']), len(alt['decisions'])), tx=None,
+                              reference=len(ref['decisions']), engine=len(alt['decisions'])))
+    clients = {c: dict(reference=ref['state'].get(c), engine=alt['state'].get(c))
+               for c in set(ref['state']) | set(alt['state']) if ref['state'].get(c) != alt['state'].get(c)}
+    return dict(rows=len(rows), decisions=decisions, clients=clients,
+                reference_seconds=ref['seconds'], engine_seconds=alt['seconds'],
+                speedup=ref['seconds'] / alt['seconds'] if alt['seconds'] else None)
+
+
+def diverges(rows, engine, base=reference) -> bool:
+    d = diff(rows, engine, base)
+    return bool(d['decisions'] or d['clients'])
+
+
+def shrink(rows, engine, base=reference) -> list:
+    """
+    Minimal reproducer of a divergence (ddmin over complements)
+    """
+    d = diff(rows, engine, base)
+    if d['decisions']:
+        # engines are sequential so nothing after the first diverging decision is needed
+        rows = rows[:d['decisions'][0]['row'] + 1]
+
+    n = 2
+    while len(rows) >= 2:
+        chunk = -(-len(rows) // n)
+        for i in range(0, len(rows), chunk):
+            complement = rows[:i] + rows[i + chunk:]
+            if complement and diverges(complement, engine, base):
+                rows = complement
+                n = max(n - 1, 2)
+                break
+        else:
+            if n >= len(rows):
+                break
+            n = min(len(rows), n * 2)
+    return rows
+
+
+def read_input(path) -> list:
+    """
+    Rows of an input file the way the CLI reads them
+    """
+    with open(path, 'r', encoding='UTF-32', buffering=20000000) as csvfile:
+        reader = csv.DictReader(csvfile, fieldnames=PaymentManager.COLS['tx']['fields'])
+        next(reader)
+        return [{k.strip(): str(v).strip().replace('None', '') for k, v in row.items()} for row in reader]
+
+
+def report(d, reproducer=None) -> str:
+    lines = ["rows: {rows}".format(**d),
+             "diverging decisions: {}".format(len(d['decisions'])),
+             "diverging clients: {}".format(len(d['clients'])),
+             "reference: {:.3f}s engine: {:.3f}s speedup: {}".format(
+                 d['reference_seconds'], d['engine_seconds'],
+                 "{:.2f}x".format(d['speedup']) if d['speedup'] else "n/a")]
+    for x in d['decisions'][:10]:
+        lines.append("  row {row}: reference={reference} engine={engine} {tx}".format(**x))
+    for c, x in list(d['clients'].items())[:10]:
+        lines.append("  client {}: reference={reference} engine={engine}".format(c, **x))
+    if reproducer:
+        lines.append("minimal reproducer:")
+        lines.append(",".join(PaymentManager.COLS['tx']['fields']))
+        lines.extend(",".join(r[f] for f in PaymentManager.COLS['tx']['fields']) for r in reproducer)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engine', choices=sorted(ENGINES), required=True)
+    parser.add_argument('--input', help="replay this input file instead of a generated stream")
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--mix', nargs='+', metavar='OP=WEIGHT',
+                        help="default: " + " ".join("{}={}".format(k, v) for k, v in MIX.items()))
+    parser.add_argument('--invalid', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-shrink', action='store_true', help="do not shrink a diverging stream")
+    args = parser.parse_args(argv)
+
+    if args.input:
+        rows = read_input(args.input)
+    else:
+        rows = list(generate(args.rows, clients=args.clients, zipf=args.zipf,
+                             mix=parse_mix(args.mix) if args.mix else None, invalid=args.invalid, seed=args.seed))
+
+    engine = ENGINES[args.engine]
+    d = diff(rows, engine)
+    reproducer = None
+    if (d['decisions'] or d['clients']) and not args.no_shrink:
+        reproducer = shrink(rows, engine)
+    print(report(d, reproducer))
+    return 1 if d['decisions'] or d['clients'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Workload generator
+
+Emits transaction streams in the input format (UTF-32 `type, client, tx, amount`) with
+- Zipf skewed client popularity, hot clients spread over the id space
+- a configurable deposit/withdrawal/dispute/resolve/chargeback mix
+- a chosen rate of invalid rows (duplicates, negative amounts, oversize ids)
+- seeded reproducibility
+
+A small balance model per client keeps the valid rows acceptable to the ledger:
+withdrawals and disputes never exceed the available funds, disputes target the client's own
+deposits, resolves follow disputes and chargebacks follow resolves. Rows picked for an
+operation the client cannot make (e.g. a resolve without a dispute) become deposits.
+Locked clients keep receiving traffic like they do after a fraud wave.
+
+$ python3 -m bench.workload tx.csv --rows 1000000 --clients 5000 --zipf 1.2 \\
+      --mix deposit=70 withdrawal=20 dispute=5 resolve=3 chargeback=2 --invalid 0.01 --seed 42
+"""
+import argparse
+import bisect
+import csv
+import io
+import random
+import sys
+from collections import deque
+from decimal import Decimal
+from itertools import accumulate
+
+from main.payment_gateway import PaymentManager
+
+MIX = dict(deposit=70, withdrawal=20, dispute=5, resolve=3, chargeback=2)
+INVALID = ('duplicate', 'negative', 'oversize')
+# rejected by id validation: out of range and more set bits than the id type has
+OVERSIZE_CLIENT = str(2 ** 17 - 1)
+OVERSIZE_TX = str(2 ** 33 - 1)
+CENT = Decimal("0.01")
+
+
+def client_id(i) -> str:
+    return "{:05d}".format(i)
+
+
+def tx_id(i) -> str:
+    return "{:010d}".format(i)
+
+
+class Workload:
+    """
+    Seeded generator of transaction rows, see module doc
+    """
+    # recent deposits kept per client for disputes, keeps the model bounded for long streams
+    RECENT = 16
+
+    def __init__(self, clients=1000, zipf=1.1, mix=None, invalid=0.0, invalid_kinds=INVALID, seed=0):
+        if not 0 < clients <= PaymentManager.MAX_UINT16:
+            raise ValueError("clients must be a valid u16 count: {}".format(clients))
+        if not 0 <= invalid <= 1:
+            raise ValueError("invalid rate must be within [0, 1]: {}".format(invalid))
+
+        self.rng = random.Random(seed)
+        self.invalid = invalid
+        self.invalid_kinds = list(invalid_kinds)
+
+        mix = mix or MIX
+        self.ops = [op for op in mix if mix[op] > 0]
+        self.op_weights = list(accumulate(mix[op] for op in self.ops))
+        unknown = set(self.ops) - set(MIX)
+        if unknown:
+            raise ValueError("Unknown operation(s) in mix: {}".format(sorted(unknown)))
+
+        # popularity rank -> client id
+        self.ids = list(range(1, clients + 1))
+        self.rng.shuffle(self.ids)
+        self.client_weights = list(accumulate(1 / (k ** zipf) for k in range(1, clients + 1)))
+
+        self.next_tx = 0
+        self.available = {}
+        self.deposits = {}  # client -> recent undisputed deposits [(tx, amount)]
+        self.disputed = {}  # client -> {tx: amount}
+        self.resolved = {}  # client -> {tx: amount}
+        self.locked = set()
+        self.recent = deque(maxlen=1024)  # emitted valid rows, source of duplicates
+
+    def pick_client(self) -> int:
+        r = self.rng.random() * self.client_weights[-1]
+        return self.ids[min(bisect.bisect_left(self.client_weights, r), len(self.ids) - 1)]
+
+    def pick_op(self) -> str:
+        r = self.rng.random() * self.op_weights[-1]
+        return self.ops[min(bisect.bisect_left(self.op_weights, r), len(self.ops) - 1)]
+
+    def new_tx(self) -> str:
+        self.next_tx += 1
+        return tx_id(self.next_tx)
+
+    def amount(self, upper=None) -> Decimal:
+        a = Decimal(str(round(self.rng.lognormvariate(3, 1.2), 2))).quantize(CENT)
+        if upper is not None:
+            a = min(a, upper)
+        return max(a, CENT)
+
+    def deposit(self, c) -> dict:
+        tx, a = self.new_tx(), self.amount()
+        self.available[c] = self.available.get(c, Decimal(0)) + a
+        recent = self.deposits.setdefault(c, deque(maxlen=self.RECENT))
+        recent.append((tx, a))
+        return dict(type="deposit", client=client_id(c), tx=tx, amount=str(a))
+
+    def valid_row(self) -> dict:
+        c = self.pick_client()
+        op = self.pick_op()
+        available = self.available.get(c, Decimal(0))
+
+        if op == 'withdrawal' and available >= CENT:
+            a = self.amount(available)
+            self.available[c] = available - a
+            return dict(type=op, client=client_id(c), tx=self.new_tx(), amount=str(a))
+
+        if op == 'dispute':
+            recent = self.deposits.get(c, ())
+            candidates = [d for d in recent if d[1] <= available]
+            if candidates:
+                tx, a = self.rng.choice(candidates)
+                recent.remove((tx, a))
+                self.available[c] = available - a
+                self.disputed.setdefault(c, {})[tx] = a
+                return dict(type=op, client=client_id(c), tx=tx, amount="")
+
+        if op == 'resolve' and self.disputed.get(c):
+            tx = self.rng.choice(sorted(self.disputed[c]))
+            a = self.disputed[c].pop(tx)
+            self.available[c] = available + a
+            self.resolved.setdefault(c, {})[tx] = a
+            return dict(type=op, client=client_id(c), tx=tx, amount="")
+
+        if op == 'chargeback':
+            candidates = sorted(tx for tx, a in self.resolved.get(c, {}).items() if a <= available)
+            if candidates:
+                tx = self.rng.choice(candidates)
+                self.available[c] = available - self.resolved[c].pop(tx)
+                self.locked.add(c)
+                return dict(type=op, client=client_id(c), tx=tx, amount="")
+
+        return self.deposit(c)
+
+    def invalid_row(self) -> dict:
+        kind = self.rng.choice(self.invalid_kinds)
+        if kind == 'duplicate' and self.recent:
+            return dict(self.rng.choice(self.recent))
+        if kind == 'oversize':
+            if self.rng.random() < 0.5:
+                return dict(type="deposit", client=OVERSIZE_CLIENT, tx=self.new_tx(), amount=str(self.amount()))
+            return dict(type="deposit", client=client_id(self.pick_client()), tx=OVERSIZE_TX,
+                        amount=str(self.amount()))
+        typ = self.rng.choice(("deposit", "withdrawal"))
+        return dict(type=typ, client=client_id(self.pick_client()), tx=self.new_tx(), amount=str(-self.amount()))
+
+    def rows(self, count):
+        """
+        Yields `count` rows as dicts of the input fields
+        """
+        for _ in range(count):
+            if self.invalid and self.rng.random() < self.invalid:
+                yield self.invalid_row()
+            else:
+                row = self.valid_row()
+                self.recent.append(row)
+                yield dict(row)
+
+
+def generate(count, **kwargs):
+    """
+    Shorthand for `Workload(**kwargs).rows(count)`
+    """
+    return Workload(**kwargs).rows(count)
+
+
+def write(f, rows, header=True):
+    """
+    Write rows in the input format to a binary file object
+    """
+    out = io.TextIOWrapper(f, encoding='UTF-32', newline='', write_through=False)
+    writer = csv.DictWriter(out, fieldnames=PaymentManager.COLS['tx']['fields'])
+    if header:
+        writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+    out.flush()
+    out.detach()
+
+
+def parse_mix(items) -> dict:
+    mix = dict(MIX, **{op: 0 for op in MIX})
+    for item in items:
+        op, _, weight = item.partition('=')
+        if op not in MIX:
+            raise argparse.ArgumentTypeError("unknown operation `{}`".format(op))
+        mix[op] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help="output csv path, `-` for stdout")
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--zipf', type=float, default=1.1, help="popularity skew exponent, 0 is uniform")
+    parser.add_argument('--mix', nargs='+', metavar='OP=WEIGHT', help="default: " +
+                        " ".join("{}={}".format(k, v) for k, v in MIX.items()))
+    parser.add_argument('--invalid', type=float, default=0.0, help="rate of invalid rows")
+    parser.add_argument('--invalid-kinds', nargs='+', choices=INVALID, default=list(INVALID))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rows = generate(args.rows, clients=args.clients, zipf=args.zipf, mix=parse_mix(args.mix) if args.mix else None,
+                    invalid=args.invalid, invalid_kinds=args.invalid_kinds, seed=args.seed)
+    if args.output == '-':
+        write(sys.stdout.buffer, rows)
+    else:
+        with open(args.output, 'wb') as f:
+            write(f, rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
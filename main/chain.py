@@ -0,0 +1,303 @@
+"""
+Integrity chain
+
+Hash chain over the tx log for incremental integrity checks: the log is cut into segments of rows in canonical
+form, every segment is digested and chained to the previous one, so a changed, dropped or reordered sealed row
+breaks the chain from its segment on. `--seal` covers the rows appended since the last seal, `--verify` rehashes
+the segments sealed since the last verify (`--full`: all of them in parallel). With `CHAIN_KEY` the chain is an
+HMAC keyed from outside the ledger directory.
+
+$ CHAIN_KEY=/etc/ledger/chain.key python3 main/payment_gateway.py --seal
+"""
+import codecs
+import csv
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import pathlib
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import NamedTemporaryFile
+
+from main.payment_gateway import PaymentManager, compact_row, transactions_lock
+
+
+def chain_path(transaction_csv) -> pathlib.Path:
+    """
+    Default directory of the integrity chain e.g. `transactions.csv.chain/`
+    """
+    path = pathlib.Path(transaction_csv)
+    return path.with_name(path.name + '.chain')
+
+
+def canonical_lines(path, offset=0, length=None, chunk=1 << 22):
+    """
+    Rows of the UTF-32 `transactions.csv` from byte `offset` (a row start) on, `length` bytes at most
+    returns: (row in canonical form as bytes, byte offset after the row) of every non blank row
+    """
+    fields = PaymentManager.COLS['tx']['fields']
+    with open(path, 'rb') as f:
+        bom = f.read(4)
+        end = f.seek(0, os.SEEK_END) if length is None else offset + length
+        codec = 'UTF-32-BE' if bom == codecs.BOM_UTF32_BE else 'UTF-32-LE'
+        if bom in (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE):
+            offset = max(offset, len(bom))
+        position = f.seek(offset)
+        rest = ''
+        while position < end:
+            data = f.read(min(chunk, end - position))
+            if not data:
+                break
+            position += len(data)
+            lines = (rest + data.decode(codec)).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                offset += (len(line) + 1) * 4
+                if line.strip():
+                    yield canonical_row(line, fields), offset
+        if rest.strip():
+            yield canonical_row(rest, fields), offset + len(rest) * 4
+
+
+def canonical_row(line, fields) -> bytes:
+    # `compact_row` of the line as `csv.DictReader` reads it, split directly unless quoted
+    values = next(csv.reader([line])) if '"' in line else line.split(',')
+    values = (values + [''] * len(fields))[:len(fields)]
+    return ','.join(v.strip() for v in values).encode()
+
+
+def segment_digest(path, offset, length) -> tuple:
+    """
+    returns: rows and sha256 hex digest of the rows in `length` bytes at `offset` of `transactions.csv`
+    """
+    digest = hashlib.sha256()
+    rows = 0
+    for line, _ in canonical_lines(path, offset, length):
+        digest.update(line + b'\n')
+        rows += 1
+    return rows, digest.hexdigest()
+
+
+def chained(chain, digest, key=None) -> str:
+    data = bytes.fromhex(chain) + bytes.fromhex(digest)
+    return hmac.new(key, data, hashlib.sha256).hexdigest() if key else hashlib.sha256(data).hexdigest()
+
+
+def chain_key(path, transaction_csv) -> bytes:
+    """
+    The HMAC key of the integrity chain of `transactions.csv`, read from `path`, None without a path.
+    The key must not live in the ledger directory: whoever can rewrite the ledger must not be able to read it
+    """
+    if not path:
+        return None
+    path = pathlib.Path(path).resolve()
+    if path.is_relative_to(pathlib.Path(transaction_csv).resolve().parent):
+        raise ValueError("The chain key must be kept outside the ledger directory: {}".format(path))
+    key = path.read_bytes().strip()
+    if not key:
+        raise ValueError("Empty chain key: {}".format(path))
+    return key
+
+
+class LedgerChain:
+    """
+    Hash chain over `transactions.csv` for incremental integrity checks.
+
+    The tx log is cut into segments of `segment_rows` rows. Every segment gets the sha256 digest of its rows in
+    canonical form (`compact_row`) and a chain digest of the previous chain digest and its digest, so changing,
+    dropping or reordering a sealed row breaks the chain from its segment on. Segments are kept in
+    `<transactions>.chain/segments.csv` with their byte offset and length. The rows after the last full segment
+    are covered by a tail digest in `head.json`, together with the digest of `client_accounts.csv` at the seal.
+
+    Threats covered: without a `key` the chain digests are plain sha256 stored next to the data, which catches
+    accidental corruption (bad disks, partial writes, a broken compaction) but not a deliberate edit, as whoever
+    rewrites a row can rewrite the chain too; the chain head (`seal()['chain']`) must then be kept elsewhere to
+    notice. With a `key` (see `chain_key`, kept outside the ledger directory) chain digests are HMAC-SHA256 and
+    `head.json` carries an HMAC over the tail, client digest, segment count and chain head, so sealed rows edited,
+    reordered or dropped by someone who can write the ledger directory but cannot read the key are found too.
+    Neither covers an attacker holding the key or removing the chain directory as a whole; rows appended after the
+    last seal are reported as `unsealed`.
+
+    `seal` only reads the rows appended since the last seal, `verify` only rehashes the segments sealed since
+    the last verify and `verify(full=True)` rehashes all of them in parallel. Compaction keeps the canonical rows
+    but moves them, their offsets are found again by rehashing the log from the start.
+    """
+    FIELDS = ['segment', 'rows', 'offset', 'length', 'digest', 'chain']
+    GENESIS = '00' * 32
+
+    def __init__(self, transaction_csv, client_csv=None, segment_rows=4096, path=None, key=None):
+        self.transaction_csv = pathlib.Path(transaction_csv)
+        self.client_csv = pathlib.Path(client_csv) if client_csv else None
+        self.key = key
+        self.path = pathlib.Path(path or chain_path(transaction_csv))
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segments = []
+        if (self.path / 'segments.csv').exists():
+            with open(self.path / 'segments.csv', 'r', newline='') as f:
+                for rec in csv.DictReader(f, fieldnames=self.FIELDS):
+                    self.segments.append(dict(rec, **{k: int(rec[k]) for k in self.FIELDS[:4]}))
+        # the segment size of an existing chain wins
+        self.head = dict(segment_rows=segment_rows, verified=0, tail=None, client=None, keyed=bool(key), mac=None)
+        if (self.path / 'head.json').exists():
+            with open(self.path / 'head.json') as f:
+                self.head.update(json.load(f))
+        self.segment_rows = self.head['segment_rows']
+        if self.head['keyed'] and not key:
+            raise ValueError("The chain of {} is keyed, its key is needed".format(self.transaction_csv))
+        if key and not self.head['keyed']:
+            if self.segments or self.head['tail']:
+                raise ValueError("The chain of {} was sealed without a key, remove {} and seal again".format(
+                    self.transaction_csv, self.path))
+            self.head['keyed'] = True
+
+    @property
+    def chain(self) -> str:
+        return self.segments[-1]['chain'] if self.segments else self.GENESIS
+
+    @property
+    def end(self) -> int:
+        # byte offset after the last full segment
+        return self.segments[-1]['offset'] + self.segments[-1]['length'] if self.segments else 0
+
+    @property
+    def rows(self) -> int:
+        return len(self.segments) * self.segment_rows + (self.head['tail']['rows'] if self.head['tail'] else 0)
+
+    def head_mac(self) -> str:
+        # everything `head.json` vouches for, the chain head binds the segments
+        head = json.dumps(dict(self.head, mac=None, segments=len(self.segments), chain=self.chain), sort_keys=True)
+        return hmac.new(self.key, head.encode(), hashlib.sha256).hexdigest()
+
+    def head_changed(self) -> bool:
+        if not self.key or (self.head['mac'] is None and not self.segments and not self.head['tail']):
+            # unkeyed, or nothing sealed yet
+            return False
+        return not hmac.compare_digest(self.head['mac'] or '', self.head_mac())
+
+    def save(self, segments=()):
+        with open(self.path / 'segments.csv', 'a', newline='') as f:
+            csv.DictWriter(f, fieldnames=self.FIELDS).writerows(segments)
+        if self.key:
+            self.head['mac'] = self.head_mac()
+        # tmp file next to the chain so the move is an atomic rename
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=self.path, suffix='.tmp')
+        with open(temp_path.name, 'w') as f:
+            json.dump(self.head, f, indent=1)
+        shutil.move(temp_path.name, self.path / 'head.json')
+
+    def client_digest(self):
+        if self.client_csv is None or not self.client_csv.exists():
+            return None
+        fields = PaymentManager.COLS['client']['fields']
+        digest = hashlib.sha256()
+        with open(self.client_csv, 'r', encoding=PaymentManager.COLS['client']['encoding'], newline='') as f:
+            for row in csv.DictReader(f, fieldnames=fields):
+                digest.update(','.join(compact_row(row, fields).values()).encode() + b'\n')
+        return digest.hexdigest()
+
+    def changed(self, segments, workers=None) -> list:
+        """
+        returns: the segments whose bytes at the recorded offset do not hash to the recorded digest
+        """
+        jobs = [(self.transaction_csv, s['offset'], s['length']) for s in segments]
+        if workers == 1 or len(jobs) < 2:
+            results = [segment_digest(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(segment_digest, *zip(*jobs), chunksize=max(1, len(jobs) // 64)))
+        return [s for s, (rows, digest) in zip(segments, results) if (rows, digest) != (s['rows'], s['digest'])]
+
+    def rescan(self):
+        """
+        Rehash the sealed rows from the start of the log and record where they are now, e.g. after a compaction
+        returns: the first segment that does not match (the tail is `len(segments)`), None if all match
+        """
+        lines = canonical_lines(self.transaction_csv)
+        offset = 0
+        for i, s in enumerate(self.segments + ([self.head['tail']] if self.head['tail'] else [])):
+            digest, rows, start = hashlib.sha256(), 0, offset
+            for line, offset in itertools.islice(lines, s['rows']):
+                digest.update(line + b'\n')
+                rows += 1
+            if (rows, digest.hexdigest()) != (s['rows'], s['digest']):
+                return i
+            s.update(offset=start, length=offset - start)
+        (self.path / 'segments.csv').unlink(missing_ok=True)
+        self.save(self.segments)
+        return None
+
+    def seal(self) -> dict:
+        """
+        Extend the chain over the rows appended since the last seal
+        returns: full segments added and rows covered
+        """
+        with transactions_lock:
+            if self.head_changed():
+                raise ValueError("The chain head of {} changed, run a full verify".format(self.transaction_csv))
+            # rows are only appended after the last sealed one if it is still where it was
+            covered = self.segments[-1:] + ([self.head['tail']] if self.head['tail'] else [])
+            if self.changed(covered, workers=1) and self.rescan() is not None:
+                raise ValueError("Sealed rows of {} changed, run a full verify".format(self.transaction_csv))
+
+            new, chain = [], self.chain
+            digest, rows, start = hashlib.sha256(), 0, self.end
+            offset = start
+            for line, offset in canonical_lines(self.transaction_csv, start):
+                digest.update(line + b'\n')
+                rows += 1
+                if rows == self.segment_rows:
+                    chain = chained(chain, digest.hexdigest(), self.key)
+                    new.append(dict(segment=len(self.segments) + len(new), rows=rows, offset=start,
+                                    length=offset - start, digest=digest.hexdigest(), chain=chain))
+                    digest, rows, start = hashlib.sha256(), 0, offset
+            client = self.client_digest()
+
+        self.segments.extend(new)
+        self.head['tail'] = dict(rows=rows, offset=start, length=offset - start, digest=digest.hexdigest()) \
+            if rows else None
+        self.head['client'] = dict(rows=self.rows, digest=client) if client else None
+        self.save(new)
+        return dict(segments=len(new), rows=self.rows, chain=self.chain)
+
+    def verify(self, full=False, workers=None) -> dict:
+        """
+        Rehash the segments sealed since the last verify (all of them if `full`, in `workers` processes) and the
+        tail, and check the chain of the recorded digests
+        returns: stats of the check, `ok` and the first broken segment if any, `head` ('ok' or 'changed') for a
+        keyed chain
+        """
+        start = time.perf_counter()
+        # a forged head must not be saved again by the rescan below
+        head = ('changed' if self.head_changed() else 'ok') if self.key else None
+        checked = self.segments if full else self.segments[self.head['verified']:]
+        tail = [self.head['tail']] if self.head['tail'] else []
+        broken = None
+        if head != 'changed' and (self.changed(checked, workers) or self.changed(tail, workers=1)):
+            broken = self.rescan()
+
+        chain = self.GENESIS
+        for s in self.segments:
+            chain = chained(chain, s['digest'], self.key)
+            if chain != s['chain'] and (broken is None or s['segment'] < broken):
+                broken = s['segment']
+                break
+
+        unsealed = sum(1 for _ in canonical_lines(self.transaction_csv, self.end + sum(t['length'] for t in tail)))
+        client = None
+        if self.head['client'] and self.client_csv is not None:
+            if unsealed or self.head['client']['rows'] != self.rows:
+                # processed since the seal, the client table has moved on
+                client = 'unsealed'
+            else:
+                client = 'ok' if self.client_digest() == self.head['client']['digest'] else 'changed'
+
+        ok = broken is None and client != 'changed' and head != 'changed'
+        if ok:
+            self.head['verified'] = len(self.segments)
+            self.save()
+        return dict(ok=ok, full=full, segments=len(self.segments), checked=len(checked) + len(tail),
+                    broken=broken, rows=self.rows, unsealed=unsealed, client=client, head=head, chain=self.chain,
+                    seconds=round(time.perf_counter() - start, 6))
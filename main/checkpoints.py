@@ -0,0 +1,246 @@
+"""
+Balance checkpoints
+
+Journals the client record left by every applied transaction and checkpoints the client balances every K
+transactions, so the balance of a client as of any row of the tx log is answered from the nearest checkpoint and
+a bounded number of journal lines.
+
+$ CHECKPOINTS=1000 python3 main/payment_gateway.py assets/tx1.csv
+$ CHECKPOINTS=1000 python3 main/payment_gateway.py --as-of 001 25000
+"""
+import bisect
+import csv
+import io
+import os
+import pathlib
+import shutil
+from decimal import Decimal
+from tempfile import NamedTemporaryFile
+
+from main.payment_gateway import PaymentManager, Prefetcher, add, applied_record, subtract
+
+
+def checkpoints_path(transaction_csv) -> pathlib.Path:
+    """
+    Default directory of the balance checkpoints e.g. `transactions.csv.checkpoints/`
+    """
+    path = pathlib.Path(transaction_csv)
+    return path.with_name(path.name + '.checkpoints')
+
+
+class Checkpoints:
+    """
+    Client balances as of the N-th row of `transactions.csv`.
+
+    Every applied transaction appends the client record it left behind, with its position in the tx log, to a
+    journal (`<transactions>.checkpoints/journal.csv`). Every `every` positions a checkpoint is written: the
+    latest record of each client changed since the previous checkpoint (`<position>.<journal offset>.delta.csv`),
+    and every `base`-th checkpoint the latest record of every client (`<position>.<journal offset>.csv`), so the
+    checkpoints grow with the rows applied rather than with rows / every x clients. Checkpoint rows are sorted by
+    client: `as_of` binary searches the checkpoints from the nearest at or before N back to its full base and
+    reads at most `every` journal lines after it, so a query costs O(every + base x log clients) however long the
+    history is.
+
+    The journal is rebuilt by replaying the tx log when it does not match it, e.g. when checkpoints are enabled on
+    an existing ledger or after a compaction. The replay matches the engine's records as long as all ids have the
+    same width.
+    """
+    FIELDS = ['position'] + ["client", "held", "available", "total", "locked"]
+
+    def __init__(self, path, every=1000, base=16):
+        self.path = pathlib.Path(path)
+        self.every = every
+        self.base = base
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.journal = open(self.path / 'journal.csv', 'a+b')
+        self.position = 0
+        self.latest = {}  # client id -> record as of `position`
+        self.changed = set()  # clients journaled since the last checkpoint
+        self.index = []  # (position, journal offset, full) of every checkpoint, ascending
+        # journal lines and checkpoints read by the last query
+        self.stats = dict(read=0, checkpoints=0)
+
+    @classmethod
+    def load(cls, transaction_csv, every=1000, path=None, base=16) -> object:
+        """
+        Open the checkpoints of `transactions.csv`, replaying the tx log if they do not cover it
+        """
+        checkpoints = cls(path or checkpoints_path(transaction_csv), every, base)
+        checkpoints.recover()
+        rows = 0
+        if pathlib.Path(transaction_csv).exists():
+            # read 20MB  chunks
+            with open(transaction_csv, 'r', encoding=PaymentManager.COLS['tx']['encoding'],
+                      buffering=20000000) as f:
+                rows = sum(1 for line in f if line.strip())
+        if rows != checkpoints.position:
+            checkpoints.replay(transaction_csv)
+        return checkpoints
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.journal.close()
+
+    def checkpoint_path(self, position, offset, full=True) -> pathlib.Path:
+        return self.path / ('{}.{}.csv' if full else '{}.{}.delta.csv').format(position, offset)
+
+    def recover(self):
+        """
+        Restore the position and the latest records from the last full checkpoint, the deltas and the journal
+        after it
+        """
+        for p in self.path.glob('*.*.csv'):
+            position, offset = p.name.split('.')[:2]
+            self.index.append((int(position), int(offset), not p.name.endswith('.delta.csv')))
+        self.index.sort()
+        # the first checkpoint is always full
+        start = max((i for i, entry in enumerate(self.index) if entry[2]), default=0)
+        for entry in self.index[start:]:
+            self.latest.update((rec['client'], rec) for rec in self.read_checkpoint(*entry))
+        for rec in self.read_journal(self.index[-1][1] if self.index else 0):
+            self.position = int(rec.pop('position'))
+            self.latest[rec['client']] = rec
+            self.changed.add(rec['client'])
+        if self.index and not self.position:
+            self.position = self.index[-1][0]
+
+    def replay(self, transaction_csv):
+        """
+        Rebuild the journal and the checkpoints from the tx log, one pass
+        """
+        self.journal.truncate(0)
+        for p in self.path.glob('*.*.csv'):
+            p.unlink()
+        self.position, self.latest, self.changed, self.index = 0, {}, set(), []
+        amounts = {}  # tx id -> disputed amount, the amount of its first row with one
+        fields = PaymentManager.COLS['tx']['fields']
+        # read 20MB  chunks
+        with open(transaction_csv, 'r', encoding=PaymentManager.COLS['tx']['encoding'], buffering=20000000) as f:
+            for row in csv.DictReader(f, fieldnames=fields):
+                row = Prefetcher.row(row, fields)
+                if row['amount'] and Decimal(row['amount']):
+                    amounts.setdefault(row['tx'], Decimal(row['amount']))
+                cx = dict(self.latest.get(row['client']) or
+                          dict(client=row['client'], held="0.00", available="0.00", total="0.00", locked="False"))
+                amount = row['amount'] if row['type'] in ('deposit', 'withdrawal') else amounts.get(row['tx'], 0)
+                if row['type'] == 'deposit':
+                    cx['total'], cx['available'] = add(cx['total'], amount), add(cx['available'], amount)
+                elif row['type'] == 'withdrawal':
+                    cx['total'], cx['available'] = subtract(cx['total'], amount), subtract(cx['available'], amount)
+                elif row['type'] == 'dispute':
+                    cx['held'], cx['available'] = add(cx['held'], amount), subtract(cx['available'], amount)
+                elif row['type'] == 'resolve':
+                    cx['held'], cx['available'] = subtract(cx['held'], amount), add(cx['available'], amount)
+                elif row['type'] == 'chargeback':
+                    cx['available'], cx['total'] = subtract(cx['available'], amount), subtract(cx['total'], amount)
+                    cx['locked'] = "True"
+                self.append(cx)
+
+    def record(self, tx, clients):
+        """
+        Journal the record of the client of an applied transaction
+        clients: the records the transaction saved, as in `PaymentManager.clients`
+        """
+        rec = applied_record(tx, clients)
+        if rec is not None:
+            self.append(rec)
+        self.journal.flush()
+
+    def append(self, rec):
+        self.position += 1
+        line = io.StringIO()
+        csv.DictWriter(line, fieldnames=self.FIELDS).writerow(dict(rec, position=self.position))
+        self.journal.seek(0, os.SEEK_END)
+        self.journal.write(line.getvalue().encode())
+        self.latest[rec['client']] = rec
+        self.changed.add(rec['client'])
+        if self.position % self.every == 0:
+            self.write_checkpoint()
+
+    def write_checkpoint(self):
+        self.journal.flush()
+        offset = self.journal.seek(0, os.SEEK_END)
+        # a full base once `base` checkpoints, the clients changed since the previous checkpoint in between
+        full = not any(entry[2] for entry in self.index[-self.base + 1:]) if self.base > 1 else True
+        path = self.checkpoint_path(self.position, offset, full)
+        # tmp file next to the checkpoints so the move is an atomic rename
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=self.path, suffix='.tmp')
+        with open(temp_path.name, 'w', encoding='UTF-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=PaymentManager.COLS['client']['fields'])
+            # sorted by client for `find`
+            for cid in sorted(self.latest if full else self.changed):
+                writer.writerow(self.latest[cid])
+        shutil.move(temp_path.name, path)
+        self.index.append((self.position, offset, full))
+        self.changed = set()
+
+    def read_checkpoint(self, position, offset, full=True):
+        with open(self.checkpoint_path(position, offset, full), 'r', encoding='UTF-8', newline='') as f:
+            for rec in csv.DictReader(f, fieldnames=PaymentManager.COLS['client']['fields']):
+                yield rec
+
+    def find(self, cid, position, offset, full=True) -> dict:
+        """
+        The record of client `cid` in a checkpoint, None if it holds none: a binary search over byte offsets
+        """
+        def first_line(at):
+            # the first line starting at or after byte `at`, and its client
+            f.seek(max(at - 1, 0))
+            if at:
+                f.readline()
+            line = f.readline()
+            return line, next(csv.reader([line.decode()]))[0] if line.strip() else None
+
+        self.stats['checkpoints'] += 1
+        with open(self.checkpoint_path(position, offset, full), 'rb') as f:
+            lo, hi = 0, f.seek(0, os.SEEK_END)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                client = first_line(mid)[1]
+                if client is None or client >= cid:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            line, client = first_line(lo)
+        if client != cid:
+            return None
+        return dict(zip(PaymentManager.COLS['client']['fields'], next(csv.reader([line.decode()]))))
+
+    def read_journal(self, offset, until=None):
+        self.journal.flush()
+        with open(self.path / 'journal.csv', 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                values = next(csv.reader([line.decode()]))
+                if until is not None and int(values[0]) > until:
+                    return
+                self.stats['read'] += 1
+                yield dict(zip(self.FIELDS, values))
+
+    def as_of(self, cid, position) -> dict:
+        """
+        returns: the record of client `cid` after the first `position` rows of the tx log, None if it had none yet
+        """
+        if position < 0:
+            raise ValueError("Invalid position: {}".format(position))
+        position = min(position, self.position)
+        cid = str(cid).strip()
+        self.stats.update(read=0, checkpoints=0)
+        found = None
+        i = bisect.bisect_right(self.index, (position, float('inf')))
+        offset = self.index[i - 1][1] if i else 0
+        # the newest checkpoint holding the client, back to the full base
+        for entry in reversed(self.index[:i]):
+            found = self.find(cid, *entry)
+            if found is not None or entry[2]:
+                break
+        for rec in self.read_journal(offset, until=position):
+            if rec['client'] == cid:
+                rec.pop('position')
+                found = rec
+        return found
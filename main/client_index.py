@@ -0,0 +1,177 @@
+"""
+Client to transactions index
+
+Secondary index of the tx log by client: every saved row is copied to an append only segment and indexed by
+client, so a page of a client's history (`PaymentManager.get_history`) is a slice of its entries and one seek per
+row, whatever the size of the log.
+
+$ CLIENT_INDEX=1 python3 main/payment_gateway.py assets/tx1.csv
+$ python3 main/payment_gateway.py --transactions 001 0 50
+"""
+import csv
+import io
+import json
+import os
+import pathlib
+import shutil
+import struct
+from collections import defaultdict
+from tempfile import NamedTemporaryFile
+
+from main.payment_gateway import PaymentManager, Prefetcher, file_stamp
+
+
+def client_index_path(transaction_csv) -> pathlib.Path:
+    """
+    Default directory of the client -> transactions index e.g. `transactions.csv.clients/`
+    """
+    path = pathlib.Path(transaction_csv)
+    return path.with_name(path.name + '.clients')
+
+
+class ClientIndex:
+    """
+    Secondary index of `transactions.csv` by client, serving `PaymentManager.get_history`.
+
+    Every row appended to the tx log is copied to an append only segment (`<transactions>.clients/rows.csv`) and
+    a (client id, tx id, offset) entry is appended to `index.bin`. The entries of every client are kept in memory
+    in log order, so a page of a client's history is a slice of its entries and one seek per row, whatever the
+    size of the log.
+
+    `save_transactions` keeps the index in step and records the stamp of the file it wrote. An index whose stamp
+    does not match `transactions.csv` (written by someone else, compacted or flushed from a write-back buffer)
+    is rebuilt by `load` with one pass. Ids are matched exactly, as they are when all ids have the same width,
+    rows with ids that are not numeric u16/u32 ids are not indexed.
+    """
+    ENTRY = struct.Struct('<HIQ')  # client id, tx id, offset of the row in the segment
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment = open(self.path / 'rows.csv', 'a+b')
+        self.entries = open(self.path / 'index.bin', 'a+b')
+        self.clients = defaultdict(list)  # client id -> (tx id, offset) of its rows, oldest first
+        self.stats = dict(read=0)  # rows read by the last query
+
+    @classmethod
+    def load(cls, transaction_csv, path=None) -> object:
+        """
+        Open the index of `transactions.csv`, rebuilding it with one pass if it is not the index of this file
+        """
+        index = cls(path or client_index_path(transaction_csv))
+        stamp = index.read_stamp()
+        if pathlib.Path(transaction_csv).exists() and stamp == list(file_stamp(transaction_csv)):
+            index.recover()
+        else:
+            index.rebuild(transaction_csv)
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.segment.close()
+        self.entries.close()
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.clients.values())
+
+    def read_stamp(self):
+        try:
+            with open(self.path / 'stamp.json') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def sync(self, transaction_csv):
+        """
+        Record that the index covers `transactions.csv` as it is now
+        """
+        self.segment.flush()
+        self.entries.flush()
+        # tmp file next to the index so the move is an atomic rename
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=self.path, suffix='.tmp')
+        with open(temp_path.name, 'w') as f:
+            json.dump(list(file_stamp(transaction_csv)), f)
+        shutil.move(temp_path.name, self.path / 'stamp.json')
+
+    def recover(self):
+        self.entries.seek(0)
+        data = self.entries.read()
+        # an entry torn by a crash is dropped, its row is not covered by the recorded stamp
+        for cid, tx, offset in self.ENTRY.iter_unpack(data[:len(data) - len(data) % self.ENTRY.size]):
+            self.clients[cid].append((tx, offset))
+
+    def rebuild(self, transaction_csv):
+        """
+        Index the tx log from scratch
+        """
+        (self.path / 'stamp.json').unlink(missing_ok=True)
+        self.segment.truncate(0)
+        self.entries.truncate(0)
+        self.clients.clear()
+        if pathlib.Path(transaction_csv).exists():
+            fields = PaymentManager.COLS['tx']['fields']
+            # read 20MB  chunks
+            with open(transaction_csv, 'r', encoding=PaymentManager.COLS['tx']['encoding'],
+                      buffering=20000000) as f:
+                for row in csv.DictReader(f, fieldnames=fields):
+                    self.append(Prefetcher.row(row, fields))
+            self.sync(transaction_csv)
+
+    @staticmethod
+    def key(value, limit):
+        value = str(value).strip()
+        if value.isascii() and value.isdigit() and int(value) <= limit:
+            return int(value)
+        return None
+
+    def append(self, rec) -> bool:
+        cid = self.key(rec['client'], PaymentManager.MAX_UINT16)
+        tx = self.key(rec['tx'], PaymentManager.MAX_UINT32)
+        if cid is None or tx is None:
+            return False
+        line = io.StringIO()
+        csv.DictWriter(line, fieldnames=PaymentManager.COLS['tx']['fields']).writerow(rec)
+        offset = self.segment.seek(0, os.SEEK_END)
+        self.segment.write(line.getvalue().encode())
+        self.entries.seek(0, os.SEEK_END)
+        self.entries.write(self.ENTRY.pack(cid, tx, offset))
+        self.clients[cid].append((tx, offset))
+        return True
+
+    def add(self, row) -> bool:
+        """
+        Index a saved row, rows indexed before are ignored as saves ignore duplicates
+        returns: True if indexed
+        """
+        rec = Prefetcher.row(row, PaymentManager.COLS['tx']['fields'])
+        cid = self.key(rec['client'], PaymentManager.MAX_UINT16)
+        tx = self.key(rec['tx'], PaymentManager.MAX_UINT32)
+        if any(t == tx and self.read(offset) == rec for t, offset in self.clients.get(cid, [])):
+            return False
+        return self.append(rec)
+
+    def read(self, offset) -> dict:
+        self.segment.flush()
+        with open(self.path / 'rows.csv', 'rb') as f:
+            f.seek(offset)
+            values = next(csv.reader([f.readline().decode()]))
+        self.stats['read'] += 1
+        return dict(zip(PaymentManager.COLS['tx']['fields'], values))
+
+    def count(self, cid) -> int:
+        return len(self.clients.get(self.key(cid, PaymentManager.MAX_UINT16), []))
+
+    def page(self, cid, offset=0, limit=100, newest_first=False) -> list:
+        """
+        returns: rows `offset` to `offset + limit` of the client's history, oldest first unless `newest_first`
+        """
+        self.stats['read'] = 0
+        entries = self.clients.get(self.key(cid, PaymentManager.MAX_UINT16), [])
+        if newest_first:
+            entries = entries[::-1]
+        return [self.read(o) for _, o in entries[offset:offset + limit]]
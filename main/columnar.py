@@ -0,0 +1,188 @@
+"""
+Columnar ledger export
+
+Writes the client table, the transaction log and the client aggregates as one NumPy `.npy` file per column
+so analytics can memory-map them (`np.load(..., mmap_mode='r')`) instead of decoding the UTF-16/UTF-32 CSVs,
+and rebuilds the CSV store from such an export.
+
+Layout of an export directory:
+
+- `manifest.json`: format version and, per table (`client`, `tx`, `aggregate`), its rows, fields and the
+  decimal scale of its fixed-point columns
+- `<table>.<field>.npy`: the stored values, fixed-width bytes (`S<n>`, ASCII) or `U<n>` if a value is not ASCII
+- `<table>.<field>.i8.npy`: for the amount columns (balances and tx amounts), int64 multiples of 10 ** -scale;
+  left out (scale null) if an amount of the table has more than `MAX_SCALE` decimal places or does not fit int64
+
+$ python3 -m main.columnar export ledger.cols [--client-csv client_accounts.csv] [--transaction-csv transactions.csv]
+$ python3 -m main.columnar import ledger.cols [--client-csv client_accounts.csv] [--transaction-csv transactions.csv]
+"""
+import argparse
+import csv
+import json
+import pathlib
+import shutil
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+
+from main.payment_gateway import PaymentManager, aggregate_path
+
+VERSION = 1
+AMOUNTS = {'client': ['held', 'available', 'total'], 'tx': ['amount'], 'aggregate': []}
+MAX_SCALE = 8  # decimal places of fixed-point amounts, whole parts up to 2 ** 63 // 10 ** 8 (about 9.2e10)
+
+
+def load_columns(path, index, strip=True) -> dict:
+    """
+    returns: one array of (stripped) strings per field of the `index` ('client', 'tx' or 'aggregate') file
+    """
+    fields = PaymentManager.COLS[index]['fields']
+    with open(path, 'r', encoding=PaymentManager.COLS[index]['encoding'], newline='') as f:
+        text = f.read()
+    lines = [line for line in text.splitlines() if line]
+    cells = ','.join(lines).split(',')
+    if '"' not in text and len(cells) == len(lines) * len(fields):
+        # plain rows of full width: one split for the whole file
+        table = np.array(cells, dtype=str).reshape(len(lines), len(fields))
+    else:
+        rows = [row + [''] * (len(fields) - len(row)) for row in csv.reader(lines) if row]
+        table = np.array(rows, dtype=str).reshape(len(rows), len(fields))
+    return {f: np.char.strip(table[:, i]) if strip else table[:, i] for i, f in enumerate(fields)}
+
+
+def decimals(amounts) -> int:
+    fractions = np.char.partition(amounts, '.')[:, 2] if len(amounts) else amounts
+    return int(np.char.str_len(fractions).max()) if len(amounts) else 0
+
+
+def fixed_point(amounts, scale):
+    """
+    Decimal strings as int64 multiples of 10 ** -scale, empty strings are 0
+    raises: ValueError if a value does not fit int64 at that scale
+    """
+    if not len(amounts):
+        return np.zeros(0, dtype=np.int64)
+    negative = np.char.startswith(amounts, '-')
+    parts = np.char.partition(np.char.lstrip(amounts, '+-'), '.')
+    # int64 arithmetic wraps silently: whole parts below `bound` keep |value| < 2 ** 63
+    bound = min(2 ** 63 // 10 ** scale, 10 ** 18)
+    digits = np.char.lstrip(parts[:, 0], '0')
+    if (np.char.str_len(digits) > 18).any():
+        raise ValueError("Amounts out of the int64 range at scale {}".format(scale))
+    whole = np.where(digits == '', '0', digits).astype(np.int64)
+    if (whole >= bound).any():
+        raise ValueError("Amounts out of the int64 range at scale {}".format(scale))
+    values = whole * 10 ** scale
+    if scale:
+        values += np.char.ljust(parts[:, 2], scale, '0').astype(np.int64)
+    return np.where(negative, -values, values)
+
+
+def ledger_paths(client_csv=None, transaction_csv=None, aggregate_csv=None) -> dict:
+    # the defaults of `PaymentManager`, the files need not exist yet
+    client_csv = pathlib.Path(client_csv or pathlib.Path.cwd() / "client_accounts.csv")
+    transaction_csv = pathlib.Path(transaction_csv or pathlib.Path.cwd() / "transactions.csv")
+    return {'client': client_csv, 'tx': transaction_csv,
+            'aggregate': pathlib.Path(aggregate_csv or aggregate_path(client_csv))}
+
+
+def export_ledger(path, client_csv=None, transaction_csv=None, aggregate_csv=None) -> dict:
+    """
+    Write the ledger's tables column by column into directory `path`, aggregates only if the file exists
+    returns: the manifest
+    """
+    path = pathlib.Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    manifest = dict(version=VERSION, tables={})
+    for index, source in ledger_paths(client_csv, transaction_csv, aggregate_csv).items():
+        if not source.exists():
+            continue
+        columns = load_columns(source, index, strip=False)
+        fields = PaymentManager.COLS[index]['fields']
+        table = dict(rows=len(columns[fields[0]]), fields=fields, scale=None)
+        for field, values in columns.items():
+            try:
+                values = values.astype(np.bytes_)
+            except UnicodeEncodeError:
+                pass
+            np.save(path / '{}.{}.npy'.format(index, field), values)
+
+        amounts = {f: np.char.strip(columns[f]) for f in AMOUNTS[index]}
+        try:
+            scale = max([decimals(a) for a in amounts.values()], default=0)
+            if scale > MAX_SCALE:
+                raise ValueError("Amounts with more than {} decimal places".format(MAX_SCALE))
+            numeric = {f: fixed_point(a, scale) for f, a in amounts.items()}
+        except ValueError:
+            # not a number, too many decimal places or out of the int64 range: the values are still exported as stored
+            numeric = {}
+        for field, values in numeric.items():
+            np.save(path / '{}.{}.i8.npy'.format(index, field), values)
+        table['scale'] = scale if numeric else None
+        manifest['tables'][index] = table
+
+    with open(path / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def load_ledger(path, mmap=True) -> dict:
+    """
+    returns: table -> field -> array as written by `export_ledger`, memory-mapped unless `mmap` is false;
+    fixed-point amount columns are keyed `<field>.i8`
+    """
+    path = pathlib.Path(path)
+    with open(path / 'manifest.json') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != VERSION:
+        raise ValueError("Unsupported export version: {}".format(manifest.get('version')))
+    tables = {}
+    for index, table in manifest['tables'].items():
+        columns = tables[index] = {}
+        numeric = AMOUNTS[index] if table['scale'] is not None else []
+        for field in table['fields'] + [f + '.i8' for f in numeric]:
+            columns[field] = np.load(path / '{}.{}.npy'.format(index, field), mmap_mode='r' if mmap else None)
+    return tables
+
+
+def import_ledger(path, client_csv=None, transaction_csv=None, aggregate_csv=None) -> dict:
+    """
+    Rebuild the CSV store from an export, each file is replaced as a whole
+    returns: table -> rows written
+    """
+    tables = load_ledger(path)
+    written = {}
+    for index, target in ledger_paths(client_csv, transaction_csv, aggregate_csv).items():
+        if index not in tables:
+            continue
+        fields = PaymentManager.COLS[index]['fields']
+        columns = [np.asarray(tables[index][f]) for f in fields]
+        columns = [c.astype(str) if c.dtype.kind == 'S' else c for c in columns]
+        # tmp file next to the store so the move is an atomic rename
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=target.parent)
+        with open(temp_path.name, 'w', encoding=PaymentManager.COLS[index]['encoding']) as csvtempfile:
+            csv.writer(csvtempfile).writerows(zip(*(c.tolist() for c in columns)))
+        shutil.move(csvtempfile.name, target)
+        written[index] = len(columns[0])
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path', help="export directory")
+    parser.add_argument('--client-csv', help="default: ./client_accounts.csv")
+    parser.add_argument('--transaction-csv', help="default: ./transactions.csv")
+    parser.add_argument('--aggregate-csv', help="default: next to the client accounts")
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        manifest = export_ledger(args.path, args.client_csv, args.transaction_csv, args.aggregate_csv)
+        written = {index: table['rows'] for index, table in manifest['tables'].items()}
+    else:
+        written = import_ledger(args.path, args.client_csv, args.transaction_csv, args.aggregate_csv)
+    print(json.dumps(dict(command=args.command, path=args.path, rows=written)))
+
+
+if __name__ == '__main__':
+    main()
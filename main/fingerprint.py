@@ -0,0 +1,203 @@
+"""
+Input fingerprints
+
+Fingerprints every input file as a whole and in content defined chunks of rows, and registers them once a run has
+applied its rows, so a re-sent file or an overlapping tail is skipped wholesale instead of every row being rejected
+as a duplicate. A report of the skipped files, chunks and rows is printed to stderr.
+
+$ FINGERPRINT=1024 python3 main/payment_gateway.py 'inbox/*.csv'
+"""
+import csv
+import hashlib
+import itertools
+import pathlib
+import zlib
+
+from main.payment_gateway import PaymentManager, compact_row, count_rows, read_rows
+
+
+def registry_path(transaction_csv) -> pathlib.Path:
+    """
+    Default directory of the input fingerprints e.g. `transactions.csv.inputs/`
+    """
+    path = pathlib.Path(transaction_csv)
+    return path.with_name(path.name + '.inputs')
+
+
+def input_chunks(path, size=1024) -> tuple:
+    """
+    Fingerprints of an input file: the sha256 digest of all its rows, its chunks as (first row, rows, digest,
+    anchored) and an 8 byte key of every row. Rows are hashed in canonical form (`compact_row`). A chunk ends after a
+    row whose crc32 is a multiple of `size` (`size` rows on average, 4 * size at most), so chunks between two such
+    cuts (`anchored`) depend on the rows only and the same rows re-sent at another offset give the same anchored
+    chunks. The chunks cut by the start or the end of the file are not anchored, their rows are matched one by one
+    (see `InputRegistry.plan`).
+    """
+    fields = PaymentManager.COLS['tx']['fields']
+    whole, digest, chunks, keys = hashlib.sha256(), hashlib.sha256(), [], []
+    first, defined = 0, False  # start of the current chunk, True if the rows put it there
+    # read 20MB  chunks
+    with open(path, 'r', encoding='UTF-32', buffering=20000000) as csvfile:
+        for i, row in enumerate(read_rows(csvfile)):
+            line = ','.join(compact_row(row, fields).values()).encode() + b'\n'
+            whole.update(line)
+            digest.update(line)
+            keys.append(hashlib.sha256(line).digest()[:InputRegistry.KEY])
+            cut = zlib.crc32(line) % size == 0
+            if cut or i + 1 - first >= 4 * size:
+                # a cut at the maximum size is where the rows put it if its chunk started at such a cut
+                end = cut or defined
+                chunks.append((first, i + 1 - first, digest.hexdigest(), defined and end))
+                digest, first, defined = hashlib.sha256(), i + 1, end
+    if len(keys) > first:
+        chunks.append((first, len(keys) - first, digest.hexdigest(), False))
+    return whole.hexdigest(), chunks, keys
+
+
+def skip_chunks(rows, chunks):
+    """
+    `rows` without the rows of `chunks`, (first row, rows) in order
+    """
+    chunks = iter(chunks)
+    chunk = next(chunks, None)
+    for i, row in enumerate(rows):
+        while chunk is not None and i >= chunk[0] + chunk[1]:
+            chunk = next(chunks, None)
+        if chunk is None or i < chunk[0]:
+            yield row
+
+
+class InputRegistry:
+    """
+    Fingerprints of the input files and chunks applied to a ledger (`<transactions>.inputs/registry.csv`) and the
+    keys of the rows fingerprinted, in input order (`rows.bin`).
+
+    `plan` fingerprints an input file (`input_chunks`) and returns the rows that were applied before, by an
+    earlier run or earlier in this run, so they can be skipped wholesale instead of every row being rejected by
+    `validate`: a file seen as a whole, every anchored chunk seen before and the rows around such a chunk that
+    match the rows around its earlier occurrence one by one (the head and tail of an overlap, which are cut by
+    the start or end of a file). Rows of a file that shares no anchored chunk with earlier input go through
+    `validate`. The fingerprints of a run are registered by `commit` once all its rows were applied, so an
+    interrupted run leaves nothing behind. A row rejected the first time is not retried when it comes again. The
+    registry is dropped when the tx log has fewer rows than when it was written (a new ledger).
+    """
+    FIELDS = ['kind', 'digest', 'rows', 'source', 'position', 'offset']
+    KEY = 8  # bytes of a row key
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.digests = {}  # digest -> record
+        self.pending = {}  # digests of this run, registered on commit
+        self.pending_keys = []  # row keys of this run, after the `stored` ones
+        self.position = 0
+        if (self.path / 'registry.csv').exists():
+            with open(self.path / 'registry.csv', 'r', newline='') as f:
+                for rec in csv.DictReader(f, fieldnames=self.FIELDS):
+                    self.digests[rec['digest']] = rec
+                    self.position = max(self.position, int(rec['position']))
+        keys = self.path / 'rows.bin'
+        self.stored = keys.stat().st_size // self.KEY if keys.exists() else 0
+
+    @classmethod
+    def load(cls, transaction_csv, rows=None, path=None) -> object:
+        """
+        rows: rows of `transactions.csv` if known
+        """
+        registry = cls(path or registry_path(transaction_csv))
+        if registry.position > (count_rows(transaction_csv, 'tx') if rows is None else rows):
+            registry.clear()
+        return registry
+
+    def __contains__(self, digest) -> bool:
+        return digest in self.digests or digest in self.pending
+
+    def clear(self):
+        (self.path / 'registry.csv').unlink(missing_ok=True)
+        (self.path / 'rows.bin').unlink(missing_ok=True)
+        self.digests.clear()
+        self.position = self.stored = 0
+
+    def history(self, start, stop) -> list:
+        """
+        returns: the keys of rows `start` to `stop` of the rows fingerprinted before, in input order
+        """
+        start = max(start, 0)
+        keys = []
+        if start < min(stop, self.stored):
+            with open(self.path / 'rows.bin', 'rb') as f:
+                f.seek(start * self.KEY)
+                data = f.read((min(stop, self.stored) - start) * self.KEY)
+            keys = [data[k:k + self.KEY] for k in range(0, len(data), self.KEY)]
+        return keys + self.pending_keys[max(start - self.stored, 0):max(stop - self.stored, 0)]
+
+    def history_from(self, offset, step, block=4096):
+        """
+        The keys of the rows fingerprinted before from row `offset` on, towards the first row if `step` is negative,
+        read `block` rows at a time
+        """
+        while 0 <= offset < self.stored + len(self.pending_keys):
+            keys = self.history(offset, offset + block) if step > 0 else \
+                self.history(offset - block + 1, offset + 1)[::-1]
+            yield from keys
+            offset += step * len(keys)
+
+    def plan(self, path, size=1024) -> dict:
+        """
+        Fingerprint an input file
+        returns: its report and the runs of rows (first row, rows) to skip
+        """
+        whole, chunks, keys = input_chunks(path, size)
+        seen = [whole in self] * len(keys)
+        anchors = len(chunks) if whole in self else 0
+        for first, rows, digest, anchored in chunks if whole not in self else []:
+            rec = (self.pending.get(digest) or self.digests.get(digest)) if anchored else None
+            if not rec or not rec.get('offset'):
+                continue
+            anchors += 1
+            offset, end = int(rec['offset']), first + rows
+            seen[first:end] = [True] * rows
+            # the rows around it that follow the rows around its earlier occurrence
+            for k, key in zip(range(first - 1, -1, -1), self.history_from(offset - 1, -1, 4 * size)):
+                if seen[k] or keys[k] != key:
+                    break
+                seen[k] = True
+            for k, key in zip(range(end, len(keys)), self.history_from(end - first + offset, 1, 4 * size)):
+                if seen[k] or keys[k] != key:
+                    break
+                seen[k] = True
+
+        skip, first = [], 0
+        for flag, run in itertools.groupby(seen):
+            rows = len(list(run))
+            if flag:
+                skip.append((first, rows))
+            first += rows
+        report = dict(file=str(path), digest=whole, seen=whole in self, rows=len(keys), chunks=len(chunks),
+                      skipped_chunks=anchors, skipped_rows=sum(seen))
+        if whole not in self:
+            offset = self.stored + len(self.pending_keys)
+            for first, rows, digest, anchored in chunks:
+                if anchored:
+                    self.pending.setdefault(digest, dict(kind='chunk', digest=digest, rows=rows, source=path.name,
+                                                         offset=offset + first))
+            self.pending.setdefault(whole, dict(kind='file', digest=whole, rows=len(keys), source=path.name,
+                                                offset=offset))
+            self.pending_keys.extend(keys)
+        return dict(report=report, skip=skip)
+
+    def commit(self, position):
+        """
+        Register the fingerprints of this run, `position`: rows of `transactions.csv` after it
+        """
+        # the keys go first, records refer to them
+        with open(self.path / 'rows.bin', 'ab') as f:
+            f.write(b''.join(self.pending_keys))
+        self.stored += len(self.pending_keys)
+        self.pending_keys = []
+        new = [dict(rec, position=position) for digest, rec in self.pending.items() if digest not in self.digests]
+        with open(self.path / 'registry.csv', 'a', newline='') as f:
+            csv.DictWriter(f, fieldnames=self.FIELDS).writerows(new)
+        self.digests.update((rec['digest'], rec) for rec in new)
+        self.pending.clear()
+        self.position = max(self.position, position)
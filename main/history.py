@@ -0,0 +1,222 @@
+"""
+Tiered transaction history
+
+Keeps the rows of the most recently opened txs in memory and spills older ones to an append only segment on disk
+indexed by sorted runs of (tx id, offset) entries, so the deposit lookups of disputes, resolves and chargebacks
+do not scan `transactions.csv` and memory stays flat however long the history gets.
+
+$ HISTORY=4096 python3 main/payment_gateway.py assets/tx1.csv
+"""
+import bisect
+import csv
+import heapq
+import io
+import mmap
+import os
+import pathlib
+import shutil
+import struct
+from collections import OrderedDict, defaultdict
+
+from main.payment_gateway import PaymentManager, Prefetcher
+
+
+def history_path(transaction_csv) -> pathlib.Path:
+    """
+    Default directory of the tiered tx history e.g. `transactions.csv.history/`
+    """
+    path = pathlib.Path(transaction_csv)
+    return path.with_name(path.name + '.history')
+
+
+class HistoryRun:
+    """
+    A sorted run of (tx id, offset) index entries on disk, searched through mmap
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.map) // DepositHistory.ENTRY.size
+
+    def __getitem__(self, i):
+        return DepositHistory.ENTRY.unpack_from(self.map, i * DepositHistory.ENTRY.size)
+
+    def entries(self):
+        return (self[i] for i in range(len(self)))
+
+    def lookup(self, key):
+        i = bisect.bisect_left(self, (key, 0))
+        while i < len(self) and self[i][0] == key:
+            yield self[i][1]
+            i += 1
+
+    def close(self):
+        self.map.close()
+
+
+class DepositHistory:
+    """
+    Tiered store of saved transaction rows by tx id, serving the tx lookups of `PaymentManager.get_record`.
+
+    Disputes, resolves and chargebacks need the deposit they refer to (`get_disputed_amount`) and almost always
+    refer to a recent one. The rows of the `horizon` most recently opened txs are kept in memory, older txs are
+    spilled to an append only segment (`<transactions>.history/rows.csv`) indexed by sorted runs of
+    (tx id, offset) entries that are only searched on a miss. Memory stays flat however long the history gets.
+
+    Tx ids are matched exactly, as they are when all ids have the same width. Only numeric u32 ids are kept,
+    lookups of any other id fall back to scanning `transactions.csv`. The history is built from the file by
+    `load` and kept in step by `save_transactions`, nobody else may write the file while it is in use.
+    """
+    ENTRY = struct.Struct('<IQ')  # tx id, offset of the row in the segment
+
+    def __init__(self, path, horizon=4096):
+        self.path = pathlib.Path(path)
+        self.horizon = horizon
+        self.chunk = max(1, horizon // 4)  # txs spilled at a time
+        self.hot = OrderedDict()  # tx id -> rows, oldest first
+        self.tail = defaultdict(list)  # key -> offsets of rows added to spilled txs and not in a run yet
+        self.runs = []
+        self.sequence = 0
+        self.stats = dict(hot=0, cold=0, miss=0, spilled=0)
+
+        # the segment is derived from `transactions.csv`, start over
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path.mkdir(parents=True)
+        self.segment = open(self.path / 'rows.csv', 'w+b')
+
+    @classmethod
+    def load(cls, transaction_csv, horizon=4096, path=None) -> object:
+        """
+        Build the history of `transactions.csv` with one pass
+        """
+        history = cls(path or history_path(transaction_csv), horizon)
+        fields = PaymentManager.COLS['tx']['fields']
+        # read 20MB  chunks
+        with open(transaction_csv, 'r', encoding=PaymentManager.COLS['tx']['encoding'], buffering=20000000) as f:
+            for row in csv.DictReader(f, fieldnames=fields):
+                history.add(row)
+        return history
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.segment.close()
+
+    @staticmethod
+    def key(tx):
+        tx = str(tx).strip()
+        if tx.isascii() and tx.isdigit() and int(tx) <= PaymentManager.MAX_UINT32:
+            return int(tx)
+        return None
+
+    def write(self, rec) -> int:
+        line = io.StringIO()
+        csv.DictWriter(line, fieldnames=PaymentManager.COLS['tx']['fields']).writerow(rec)
+        offset = self.segment.seek(0, os.SEEK_END)
+        self.segment.write(line.getvalue().encode())
+        return offset
+
+    def read(self, offset) -> dict:
+        self.segment.seek(offset)
+        values = next(csv.reader([self.segment.readline().decode()]))
+        return dict(zip(PaymentManager.COLS['tx']['fields'], values))
+
+    def cold(self, tx) -> list:
+        """
+        Rows of a spilled tx, oldest first
+        """
+        key = self.key(tx)
+        offsets = list(self.tail.get(key, []))
+        for run in self.runs:
+            offsets.extend(run.lookup(key))
+        rows = (self.read(offset) for offset in sorted(offsets))
+        return [row for row in rows if row['tx'] == tx]
+
+    def add(self, row) -> bool:
+        """
+        Record a saved row, rows recorded before are ignored as saves ignore duplicates
+        returns: True if recorded
+        """
+        rec = Prefetcher.row(row, PaymentManager.COLS['tx']['fields'])
+        tx = rec['tx']
+        key = self.key(tx)
+        if key is None:
+            return False
+
+        rows = self.hot.get(tx)
+        if rows is None:
+            rows = self.cold(tx)
+            if rows:
+                if rec in rows:
+                    return False
+                self.tail[key].append(self.write(rec))
+                if sum(len(offsets) for offsets in self.tail.values()) >= self.chunk:
+                    self.spill()
+                return True
+            rows = self.hot[tx] = []
+        if rec in rows:
+            return False
+        rows.append(rec)
+        if len(self.hot) >= self.horizon + self.chunk:
+            self.spill()
+        return True
+
+    def spill(self):
+        """
+        Move the oldest txs beyond the horizon to the segment and index them with a new run
+        """
+        entries = [(key, offset) for key, offsets in self.tail.items() for offset in offsets]
+        self.tail.clear()
+        while len(self.hot) > self.horizon:
+            tx, rows = self.hot.popitem(last=False)
+            entries.extend((self.key(tx), self.write(rec)) for rec in rows)
+            self.stats['spilled'] += 1
+        if entries:
+            self.write_run(sorted(entries))
+
+        # merge runs of similar size, a lookup searches a logarithmic number of runs
+        while len(self.runs) > 1 and len(self.runs[-1]) * 2 >= len(self.runs[-2]):
+            runs = self.runs[-2:]
+            del self.runs[-2:]
+            self.write_run(heapq.merge(*[run.entries() for run in runs]))
+            for run in runs:
+                run.close()
+                os.remove(run.path)
+
+    def write_run(self, entries):
+        path = self.path / '{:08d}.idx'.format(self.sequence)
+        self.sequence += 1
+        with open(path, 'wb') as f:
+            for entry in entries:
+                f.write(self.ENTRY.pack(*entry))
+        self.runs.append(HistoryRun(path))
+
+    def get_record(self, unique, *keys):
+        """
+        Same as `PaymentManager.get_record('tx', unique, *keys)` with exact ids
+        returns: None if any key is not a numeric id
+        """
+        if not all(isinstance(k, str) and self.key(k) is not None for k in keys):
+            return None
+
+        records = defaultdict(list)
+        for tx in dict.fromkeys(k.strip() for k in keys):
+            rows = self.hot.get(tx)
+            if rows is not None:
+                self.stats['hot'] += 1
+            else:
+                rows = self.cold(tx)
+                self.stats['cold' if rows else 'miss'] += 1
+            if rows:
+                records[tx].extend(dict(row) for row in rows)
+        return records
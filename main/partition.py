@@ -0,0 +1,110 @@
+"""
+External partition pre-pass
+
+Regroups input rows by ranges of client ids on disk with bounded memory, every client keeping its order, so the
+ledger works on one small set of clients at a time and the caches and indexes behind the lookups see a small
+working set.
+
+$ PARTITION=1024 PREFETCH=256 python3 main/payment_gateway.py assets/tx1.csv
+"""
+import csv
+import heapq
+import itertools
+import pathlib
+from collections import OrderedDict, defaultdict
+from tempfile import TemporaryDirectory
+
+from main.payment_gateway import PaymentManager
+
+
+def partition_rows(rows, span=1024, memory_rows=100000, workdir=None):
+    """
+    External partition pre-pass: regroup `rows` by ranges of `span` client ids with bounded memory.
+
+    Rows are written to one run on disk per client id range together with their input position, so every client
+    keeps its original order. Rows of different clients that share a tx id depend on each other's order
+    (operations are unique per tx id across clients), the ranges of such clients are merged back into input order.
+    Ranges are then yielded one after another and the ledger works on one small set of clients at a time.
+    Other clients do not interact as long as all ids have the same width (lookups match ids by substring).
+
+    At most `memory_rows` tx ids are held in memory, sorted runs of them are spilled to `workdir`
+    (a temporary directory by default).
+    yields: (input position, row)
+    """
+    fields = PaymentManager.COLS['tx']['fields']
+
+    def range_of(client):
+        cid = str(client or '').strip()
+        if cid.isascii() and cid.isdigit():
+            return min(int(cid), PaymentManager.MAX_UINT16 + 1) // span
+        # no valid client id e.g. a deposit for a new client
+        return -1
+
+    with TemporaryDirectory(dir=workdir) as tmp:
+        tmp = pathlib.Path(tmp)
+        part_path = lambda part: tmp / 'part{}.csv'.format(part)
+        opened = OrderedDict()  # part -> (file, writer), least recently used first
+        parts = set()
+        txs, runs = set(), []
+
+        def spill():
+            runs.append(tmp / 'tx{}.run'.format(len(runs)))
+            with open(runs[-1], 'w', encoding='UTF-8', newline='') as f:
+                csv.writer(f).writerows(sorted(txs))
+            txs.clear()
+
+        def read_run(path):
+            with open(path, 'r', encoding='UTF-8', newline='') as f:
+                for tx, part in csv.reader(f):
+                    yield tx, int(part)
+
+        try:
+            for position, row in enumerate(rows):
+                part = range_of(row.get('client'))
+                if part not in opened:
+                    # bound the number of open files
+                    if len(opened) >= 128:
+                        opened.popitem(last=False)[1][0].close()
+                    f = open(part_path(part), 'a', encoding='UTF-8', newline='')
+                    opened[part] = (f, csv.writer(f))
+                opened.move_to_end(part)
+                opened[part][1].writerow([position] + [row.get(k) or '' for k in fields])
+                parts.add(part)
+
+                tx = str(row.get('tx') or '').strip()
+                if tx:
+                    txs.add((tx, part))
+                    if len(txs) >= memory_rows:
+                        spill()
+        finally:
+            for f, _ in opened.values():
+                f.close()
+
+        # ranges sharing a tx id are processed together
+        parent = {part: part for part in parts}
+
+        def find(part):
+            while parent[part] != part:
+                parent[part] = parent[parent[part]]
+                part = parent[part]
+            return part
+
+        entries = heapq.merge(*[read_run(path) for path in runs], iter(sorted(txs)))
+        for _, shared in itertools.groupby(entries, key=lambda entry: entry[0]):
+            roots = {find(part) for _, part in shared}
+            first = min(roots)
+            for root in roots:
+                parent[root] = first
+
+        groups = defaultdict(list)
+        for part in sorted(parts):
+            groups[find(part)].append(part)
+
+        for root in sorted(groups):
+            files = [open(part_path(part), 'r', encoding='UTF-8', newline='') for part in groups[root]]
+            try:
+                readers = [((int(line[0]), dict(zip(fields, line[1:]))) for line in csv.reader(f)) for f in files]
+                yield from heapq.merge(*readers, key=lambda entry: entry[0])
+            finally:
+                for f in files:
+                    f.close()
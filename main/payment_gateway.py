@@ -1,16 +1,32 @@
 import copy
+import io
 import os
 import pathlib
 import pprint
-import struct
 import sys
 import csv
+import time
 from collections import defaultdict
 from random import randrange
 from tempfile import NamedTemporaryFile
 import shutil
 from decimal import Decimal
 import ast
+import codecs
+import atexit
+import hashlib
+import contextlib
+import itertools
+import mmap
+import threading
+import glob
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only the vectorized input stages need it
+    np = None
 
 
 def add(a, b) -> str:
@@ -47,6 +63,22 @@ def subtract(a, b) -> str:
     return str(a - b)
 
 
+def file_stamp(path) -> tuple:
+    """
+    Cheap change marker of a file: (inode, size, mtime). Saves replace files so the inode changes too
+    """
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def aggregate_path(client_csv) -> pathlib.Path:
+    """
+    Default aggregates file next to the client accounts e.g. `client_accounts.aggregates.csv`
+    """
+    client_path = pathlib.Path(client_csv)
+    return client_path.with_name(client_path.stem + '.aggregates' + client_path.suffix)
+
+
 def encode_file(f, encoding):
     """
     Handy function for encoding a file for testing
@@ -112,6 +144,588 @@ class TransactionNotFound(PaymentError):
     pass
 
 
+def merge_client_rows(reader, clients, upd, index='client'):
+    """
+    Rows of `client_accounts.csv` after updating existing records or appending new records to the end
+    reader: rows of the current file in order
+    upd: collects the updated records
+    """
+    for i, rec in clients.items():
+        merge = {}
+        [merge.update(c) for c in rec]
+        # update line in client_accounts if record exists
+        updated = False
+        for row in reader:
+            # update existing record if exists
+            if row[index].strip() == merge[index].strip():
+                updated = True
+                row.update(**merge)
+                upd.append(row)
+                yield row
+                break
+            yield row
+        # now write row to file with possible update
+        if not updated:
+            yield merge
+    # copy the rest
+    yield from reader
+
+
+def merge_transaction_rows(reader, transactions, upd):
+    """
+    Rows of `transactions.csv` after appending new records to the end, duplicates are ignored
+    reader: rows of the current file in order
+    upd: collects the duplicate and new records
+    """
+    new_data = copy.deepcopy(transactions)
+    for row in reader:
+        # make a copy of each row read
+        yield row
+        for i, t in transactions.items():
+            for rec in t:
+                if equal_csv_row_dict(row, rec):
+                    # skip duplicate since row already written
+                    upd.append(rec)
+                    # remove updated record from new data
+                    for m in upd:
+                        for n in new_data[i]:
+                            if equal_csv_row_dict(m, n):
+                                new_data[i].remove(m)
+                                break
+                    continue
+    # append new records
+    if new_data:
+        for _, l in new_data.items():
+            for r in l:
+                upd.append(r)
+                yield r
+
+
+def merge_aggregate_rows(reader, aggregates, upd):
+    """
+    Rows of the aggregates file after updating existing records or appending new records to the end
+    reader: rows of the current file in order
+    upd: collects the updated and new records
+    """
+    new_data = dict(aggregates)
+    for row in reader:
+        rec = new_data.pop(row['client'].strip(), None)
+        if rec:
+            row = rec
+            upd.append(rec)
+        yield row
+    # append new records
+    for rec in new_data.values():
+        upd.append(rec)
+        yield rec
+
+
+def replace_client_rows(reader, records):
+    """
+    Rows of `client_accounts.csv` with the first row of every client in `records` replaced by its record and the
+    records of new clients appended in order
+    reader: rows of the current file in order
+    records: client id -> record, e.g. the latest record of every client changed by a batch
+    """
+    new_data = dict(records)
+    for row in reader:
+        rec = new_data.pop(row['client'].strip(), None)
+        if rec:
+            row.update(**rec)
+        yield row
+    # append new records
+    yield from new_data.values()
+
+
+def append_transaction_rows(transaction_csv, rows):
+    """
+    Append rows to `transactions.csv`: the file is copied next to itself, appended to and moved back
+    """
+    # the compaction job swaps this file too
+    with transactions_lock:
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=pathlib.Path(transaction_csv).parent)
+        temp_path.close()
+        shutil.copyfile(transaction_csv, temp_path.name)
+        with open(temp_path.name, 'rb') as f:
+            bom = f.read(4)
+        # continue in the byte order of the file, a new file gets a BOM
+        encoding = {codecs.BOM_UTF32_LE: 'UTF-32-LE', codecs.BOM_UTF32_BE: 'UTF-32-BE'}.get(bom, 'UTF-32')
+        with open(temp_path.name, 'a', encoding=encoding) as csvtempfile:
+            csv.DictWriter(csvtempfile, fieldnames=PaymentManager.COLS['tx']['fields']).writerows(rows)
+        shutil.move(temp_path.name, transaction_csv)
+
+
+class LockedAccounts:
+    """
+    Bitset of locked client ids over the u16 client space (8KB).
+
+    Kept in sync with `client_accounts.csv` by `save_client_accounts` so rows for
+    frozen accounts can be rejected before any record is fetched from disk.
+    The bitset is rebuilt with a single scan whenever the file was changed by someone else.
+    """
+
+    def __init__(self, size=65536):
+        self.bits = bytearray((size + 7) // 8)
+        self.stamp = None  # (inode, size, mtime) of client_accounts when last synced
+        self.pinned = 0  # while pinned the writer keeps the bits current and `sync` does not rebuild them
+
+    def __contains__(self, cid) -> bool:
+        try:
+            i = int(str(cid).strip())
+        except ValueError:
+            return False
+        if not 0 <= i < len(self.bits) * 8:
+            return False
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def set(self, cid, locked=True):
+        i = int(str(cid).strip())
+        if not 0 <= i < len(self.bits) * 8:
+            return
+        if locked:
+            self.bits[i >> 3] |= 1 << (i & 7)
+        else:
+            self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+    def sync(self, path, encoding='UTF-16'):
+        """
+        Rebuild from `client_accounts.csv` if it changed since the last sync
+        """
+        if self.pinned:
+            return self
+        stamp = file_stamp(path)
+        if stamp == self.stamp:
+            return self
+
+        self.bits = bytearray(len(self.bits))
+        # read 20MB  chunks
+        with open(path, 'r', encoding=encoding, buffering=20000000) as f:
+            for row in csv.reader(f):
+                if len(row) < 5:
+                    continue
+                try:
+                    self.set(row[0], row[4].strip() == 'True')
+                except ValueError:
+                    continue
+        self.stamp = stamp
+        return self
+
+    def pin(self):
+        """
+        Stop rebuilding from the file e.g. while a background stage rewrites it behind the writer's changes
+        """
+        self.pinned += 1
+        return self
+
+    def unpin(self, path):
+        # the bits are current for the file as written
+        self.pinned -= 1
+        if not self.pinned:
+            self.stamp = file_stamp(path)
+
+
+# locked account bitsets shared by every PaymentManager of a process, keyed by client_accounts path
+locked_accounts = {}
+
+
+class ClientSnapshot:
+    """
+    A pinned generation of `client_accounts.csv`.
+
+    The generation stays readable through the open file even after it was garbage collected,
+    so balance queries see one consistent client table while the writer keeps committing.
+    """
+
+    def __init__(self, path, generation, encoding='UTF-16'):
+        self.generation = generation
+        self.file = open(path, 'r', encoding=encoding, buffering=20000000)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def rows(self):
+        self.file.seek(0)
+        for line in csv.DictReader(self.file, fieldnames=PaymentManager.COLS['client']['fields']):
+            yield {k: '' if v is None else str(v).strip() for k, v in line.items()}
+
+    def get_record(self, *keys) -> defaultdict:
+        """
+        keys: client ids
+        returns: client records of this generation by client id
+        """
+        keys = {k.strip() for k in keys}
+        records = defaultdict(list)
+        for row in self.rows():
+            if row['client'] in keys:
+                records[row['client']].append(row)
+        return records
+
+
+class ClientSnapshots:
+    """
+    Versioned generations of `client_accounts.csv` kept in `<client_accounts>.snapshots/`.
+
+    Enabled explicitly by creating the snapshot directory (see `enable`), from then on every
+    `save_client_accounts` publishes its result as a new generation. A generation is a hard link
+    to the saved file, saves replace the file by rename so published generations never change.
+    Only the newest `keep` generations are kept, pinned readers hold theirs open.
+    """
+    KEEP = 2
+
+    def __init__(self, client_csv, keep=KEEP, encoding='UTF-16'):
+        self.client_csv = pathlib.Path(client_csv)
+        self.path = self.client_csv.with_name(self.client_csv.name + '.snapshots')
+        self.keep = keep
+        self.encoding = encoding
+
+    @property
+    def enabled(self) -> bool:
+        return self.path.is_dir()
+
+    def generations(self) -> list:
+        if not self.enabled:
+            return []
+        return sorted(int(p.stem) for p in self.path.glob('*.csv') if p.stem.isdigit())
+
+    def generation_path(self, generation) -> pathlib.Path:
+        return self.path / '{:012d}.csv'.format(generation)
+
+    def enable(self) -> object:
+        self.path.mkdir(exist_ok=True)
+        if not self.generations():
+            self.publish()
+        return self
+
+    def publish(self) -> int:
+        """
+        Publish the current client table as the next generation (single writer)
+        """
+        gens = self.generations()
+        generation = (gens[-1] if gens else 0) + 1
+        try:
+            os.link(self.client_csv, self.generation_path(generation))
+        except OSError:
+            # no hard links on this file system
+            shutil.copyfile(self.client_csv, self.generation_path(generation))
+        self.gc()
+        return generation
+
+    def gc(self):
+        for generation in self.generations()[:-self.keep]:
+            try:
+                os.remove(self.generation_path(generation))
+            except OSError:
+                # still open by a reader on platforms that cannot unlink open files
+                pass
+
+    def pin(self, generation=None) -> ClientSnapshot:
+        """
+        Pin the latest (or the given) generation for reading
+        """
+        for _ in range(10):  # ten tries and quit
+            gens = self.generations()
+            if not gens:
+                raise FileNotFoundError(self.path)
+            target = generation or gens[-1]
+            try:
+                return ClientSnapshot(self.generation_path(target), target, self.encoding)
+            except FileNotFoundError:
+                if generation:
+                    raise
+        raise FileNotFoundError(self.path)
+
+
+class Prefetcher:
+    """
+    Read-ahead buffer of client and tx records for a window of upcoming rows.
+
+    `load` collects the client and tx ids of the window (and the owners of referenced txs) and fetches every
+    matching record with a single pass over each store. `get_record` then serves lookups of those ids from
+    the buffer. Saves are applied to the buffer the same way they are applied to the files, so later rows of
+    the window see earlier ones. Lookups of other ids, or after a file was changed by someone else,
+    fall back to reading the files.
+
+    With `write_back` saves only go to the buffer and `flush` writes them out with one pass over each store,
+    so a batch of rows costs one rewrite of each file instead of one per row. Pending changes are flushed
+    before anything has to read the files. Nobody else may write the ledger in the meantime.
+    """
+
+    def __init__(self, client_csv, transaction_csv, aggregate_csv=None, write_back=False):
+        self.paths = {'client': client_csv, 'tx': transaction_csv,
+                      'aggregate': aggregate_csv or aggregate_path(client_csv)}
+        self.write_back = write_back
+        # line number (client id for aggregates) -> row to write on `flush`
+        self.pending = {'client': {}, 'tx': {}, 'aggregate': {}}
+        self.clear()
+
+    def clear(self):
+        if any(self.pending.values()):
+            raise RuntimeError("Ledger was changed by another writer while changes were pending: " +
+                               pprint.pformat(self.paths))
+        self.keys = {'client': set(), 'tx': set(), 'aggregate': set()}  # ids whose records are all buffered
+        self.lines = {'client': {}, 'tx': {}}  # line number -> record, for lines matching a buffered id
+        self.aggregates = {}  # client id -> aggregates of buffered client ids
+        self.count = {'client': 0, 'tx': 0}  # lines in each file
+        self.stamp = {'client': None, 'tx': None, 'aggregate': None}
+
+    def discard(self):
+        """
+        Drop the buffer together with the changes pending in it
+        """
+        self.pending = {'client': {}, 'tx': {}, 'aggregate': {}}
+        self.clear()
+
+    def release(self):
+        """
+        Drop the buffer, pending changes are written first
+        """
+        self.flush()
+        self.clear()
+
+    def stamp_of(self, index):
+        try:
+            return file_stamp(self.paths[index])
+        except FileNotFoundError:
+            # aggregates are created by the first save
+            return None
+
+    def seen_stamp(self, index):
+        # compared with the stamp the buffer was read at to notice writes by someone else
+        return self.stamp_of(index)
+
+    @staticmethod
+    def row(line, fields) -> dict:
+        # the way `get_record` returns a line
+        return {f: str(line.get(f)).strip().replace('None', '') for f in fields}
+
+    def covered(self, index, value) -> bool:
+        return any(k in value.strip() for k in self.keys[index])
+
+    def scan(self, index, keys):
+        fields = PaymentManager.COLS[index]['fields']
+        self.stamp[index] = file_stamp(self.paths[index])
+        n = -1
+        # read 20MB  chunks
+        with open(self.paths[index], 'r', encoding=PaymentManager.COLS[index]['encoding'],
+                  buffering=20000000) as f:
+            for n, line in enumerate(csv.DictReader(f, fieldnames=fields)):
+                rec = self.row(line, fields)
+                if any(k in rec[index] for k in keys):
+                    self.lines[index][n] = rec
+        self.count[index] = n + 1
+        self.keys[index] = set(keys)
+
+    def scan_aggregates(self, keys):
+        fields = PaymentManager.COLS['aggregate']['fields']
+        self.stamp['aggregate'] = self.stamp_of('aggregate')
+        if self.stamp['aggregate'] is not None:
+            # read 20MB  chunks
+            with open(self.paths['aggregate'], 'r', encoding=PaymentManager.COLS['aggregate']['encoding'],
+                      buffering=20000000) as f:
+                for line in csv.DictReader(f, fieldnames=fields):
+                    row = {k: '' if v is None else str(v).strip() for k, v in line.items()}
+                    if row['client'] in keys:
+                        self.aggregates[row['client']] = row
+        self.keys['aggregate'] = set(keys)
+
+    def load(self, rows) -> object:
+        """
+        Buffer the records referenced by `rows`, one pass over each store
+        """
+        self.release()
+        self.scan('tx', {str(r.get('tx') or '').strip() for r in rows} - {''})
+        owners = {rec['client'] for rec in self.lines['tx'].values()}
+        self.scan('client', ({str(r.get('client') or '').strip() for r in rows} | owners) - {''})
+        self.scan_aggregates(self.keys['client'])
+        return self
+
+    def get_record(self, index, unique, *keys):
+        """
+        Same as `PaymentManager.get_record`
+        returns: None if any key is not buffered
+        """
+        if index not in self.lines or self.seen_stamp(index) != self.stamp[index]:
+            self.clear()
+            return None
+        if not all(isinstance(k, str) and k.strip() in self.keys[index] for k in keys):
+            return None
+
+        records = defaultdict(list)
+        for n in sorted(self.lines[index]):
+            line = self.lines[index][n]
+            for k in keys:
+                if k.strip() in line[index]:
+                    records[k.strip()].append(dict(line))
+                    if unique:
+                        break
+        return records
+
+    def get_aggregates(self, *cids):
+        """
+        Same as `PaymentManager.get_aggregates`
+        returns: None if any client id is not buffered
+        """
+        if not cids or not all(isinstance(c, str) and c.strip() in self.keys['aggregate'] for c in cids):
+            return None
+        if self.seen_stamp('aggregate') != self.stamp['aggregate']:
+            self.clear()
+            return None
+        keys = {c.strip() for c in cids}
+        return {c: dict(row) for c, row in self.aggregates.items() if c in keys}
+
+    def expected(self, index, stamp) -> bool:
+        # write-back saves leave the file alone, write-through saves replace it
+        return (stamp == self.stamp[index]) == self.write_back
+
+    def apply(self, index, merge, values):
+        """
+        Apply a save to the buffered lines, the saved `values` must all be covered by buffered ids
+        returns: the updated records or None if the buffer could not take the save
+        """
+        stamp = self.seen_stamp(index)
+        if not self.expected(index, stamp) or not all(self.covered(index, v) for v in values):
+            # not the save we expected or lines we do not hold may have changed
+            self.release()
+            return None
+
+        fields = PaymentManager.COLS[index]['fields']
+        numbers = sorted(self.lines[index])
+        upd = []
+        rows = list(merge(iter([dict(self.lines[index][n]) for n in numbers]), upd))
+        updated = {id(row) for row in upd}
+        for n, row in zip(numbers, rows):
+            self.lines[index][n] = self.row(row, fields)
+            if self.write_back and id(row) in updated:
+                self.pending[index][n] = row
+        for row in rows[len(numbers):]:
+            rec = self.row(row, fields)
+            # pending lines are kept whether covered or not, `flush` writes them from here
+            if self.write_back or self.covered(index, rec[index]):
+                self.lines[index][self.count[index]] = rec
+            if self.write_back:
+                self.pending[index][self.count[index]] = row
+            self.count[index] += 1
+        if not self.write_back:
+            self.stamp[index] = stamp
+        return upd
+
+    def saved_clients(self, clients):
+        values = [str(c.get('client')) for rec in clients.values() for c in rec]
+        return self.apply('client', lambda reader, upd: merge_client_rows(reader, clients, upd), values)
+
+    def saved_transactions(self, transactions):
+        values = [str(t.get('tx')) for rec in transactions.values() for t in rec]
+        return self.apply('tx', lambda reader, upd: merge_transaction_rows(reader, transactions, upd), values)
+
+    def saved_aggregates(self, aggregates):
+        stamp = self.seen_stamp('aggregate')
+        # records saved under another client's id (substring lookups) are appended again by every save
+        if not self.expected('aggregate', stamp) or \
+                not all(str(c).strip() in self.keys['aggregate'] and str(rec.get('client')).strip() == str(c).strip()
+                        for c, rec in aggregates.items()):
+            self.release()
+            return None
+
+        for cid, rec in aggregates.items():
+            self.aggregates[str(cid).strip()] = {k: '' if v is None else str(v).strip() for k, v in rec.items()}
+            if self.write_back:
+                self.pending['aggregate'][cid] = dict(rec)
+        if not self.write_back:
+            self.stamp['aggregate'] = stamp
+        return list(aggregates.values())
+
+    @staticmethod
+    def pending_lines(reader, pending, count):
+        # rows of the file with pending updates in place and pending appends up to `count` lines at the end
+        n = -1
+        for n, row in enumerate(reader):
+            yield pending.get(n, row)
+        for m in range(n + 1, count):
+            yield pending[m]
+
+    def rewrite(self, index, pending, merge):
+        """
+        Write the `pending` changes of one store with a single pass over the file
+        """
+        if not pending[index]:
+            return
+        path = pathlib.Path(self.paths[index])
+        fields = PaymentManager.COLS[index]['fields']
+        encoding = PaymentManager.COLS[index]['encoding']
+        if self.stamp_of(index) != self.stamp[index]:
+            raise RuntimeError("Ledger was changed by another writer while changes were pending: " + str(path))
+        if not path.exists():
+            path.touch()
+
+        # tmp file next to the ledger so the move is an atomic rename
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=path.parent)
+        # read 20MB  chunks
+        with open(path, 'r', encoding=encoding, buffering=20000000) as csvfile, \
+                open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
+            reader = csv.DictReader(csvfile, fieldnames=fields)
+            writer = csv.DictWriter(csvtempfile, fieldnames=fields)
+            for row in merge(reader):
+                writer.writerow(row)
+        shutil.move(csvtempfile.name, path)
+        pending[index] = {}
+        self.stamp[index] = file_stamp(path)
+
+    def flush(self):
+        """
+        Write the changes pending in a write-back buffer, one pass over each store
+        """
+        if not any(self.pending.values()):
+            return
+        self.write(self.pending, self.count)
+
+    def write(self, pending, count):
+        """
+        Write `pending` changes of the files with `count` lines each, the changes are dropped once written
+        """
+        # the compaction job swaps this file too
+        with transactions_lock:
+            self.rewrite('tx', pending, lambda reader: self.pending_lines(reader, pending['tx'], count['tx']))
+
+        before = self.stamp['client']
+        if pending['client']:
+            self.rewrite('client', pending,
+                         lambda reader: self.pending_lines(reader, pending['client'], count['client']))
+            # the locked bitset already holds the pending changes
+            locked = locked_accounts.get(str(pathlib.Path(self.paths['client']).resolve()))
+            if locked is not None and locked.stamp == before:
+                locked.stamp = self.stamp['client']
+            # publish a new generation for snapshot readers
+            snapshots = ClientSnapshots(self.paths['client'], encoding=PaymentManager.COLS['client']['encoding'])
+            if snapshots.enabled:
+                snapshots.publish()
+
+        self.rewrite('aggregate', pending, lambda reader: merge_aggregate_rows(reader, pending['aggregate'], []))
+
+
+def applied_record(tx, clients) -> dict:
+    """
+    The client record an applied transaction left behind, None if it saved none
+    clients: the records the transaction saved, as in `PaymentManager.clients`
+    """
+    cid = str(tx.get('client')).strip()
+    records = clients.get(cid) or clients.get(tx.get('client')) or []
+    # lookups match by substring, prefer the exact record
+    exact = [rec for rec in records if str(rec.get('client')).strip() == cid]
+    if exact or records:
+        return Prefetcher.row((exact or records)[0], PaymentManager.COLS['client']['fields'])
+    return None
+
+
+# serialises rewrites of `transactions.csv` between `save_transactions` and the compaction job
+transactions_lock = threading.RLock()
+
+
 class PaymentManager:
     MAX_UINT16 = 65535
     MAX_UINT32 = 4294967295
@@ -120,14 +734,32 @@ class PaymentManager:
                  'encoding': 'UTF-16'},
             'tx':
                 {'fields': ["type", "client", "tx", "amount"],
-                 'encoding': 'UTF-32'}
+                 'encoding': 'UTF-32'},
+            'aggregate':
+                {'fields': ["client", "opening_held", "opening_available", "opening_total",
+                            "deposited", "withdrawn", "disputed", "resolved", "charged_back",
+                            "deposits", "withdrawals", "disputes", "resolves", "chargebacks"],
+                 'encoding': 'UTF-16'}
             }
-
-    def __init__(self, client_csv=None, transaction_csv=None):
+    # aggregate (amount, count) fields maintained by each payment operation
+    AGGREGATES = {'deposit': ("deposited", "deposits"),
+                  'withdrawal': ("withdrawn", "withdrawals"),
+                  'dispute': ("disputed", "disputes"),
+                  'resolve': ("resolved", "resolves"),
+                  'chargeback': ("charged_back", "chargebacks")}
+
+    def __init__(self, client_csv=None, transaction_csv=None, aggregate_csv=None, prefetch=None, history=None,
+                 checkpoints=None, client_index=None, changes=None):
         """
         Creates `client_accounts.csv` and `transactions.csv` for tracking transactions
         while processing. Note that transactions and client records are persistent after program runs.
         To start clean please provide new paths or delete created files each time before running.
+        Per client aggregates are kept next to the client accounts (`client_accounts.aggregates.csv`)
+        prefetch: optional `Prefetcher` of the same ledger serving record lookups (and taking saves if write-back)
+        history: optional `main.history.DepositHistory` of `transaction_csv` serving tx lookups
+        checkpoints: optional `main.checkpoints.Checkpoints` of `transaction_csv` journaling every applied transaction
+        client_index: optional `main.client_index.ClientIndex` of `transaction_csv` serving `get_history`
+        changes: optional `main.replica.ChangeFeed` of `transaction_csv` taking every applied transaction
         """
         if not client_csv:
             self.client_csv = pathlib.Path.cwd() / "client_accounts.csv"
@@ -149,8 +781,52 @@ class PaymentManager:
         if not pathlib.Path(self.client_csv).exists():
             raise FileNotFoundError(self.client_csv)
 
+        self.aggregate_csv = aggregate_csv or aggregate_path(self.client_csv)
+
+        if prefetch is not None and \
+                [pathlib.Path(p).resolve() for p in (self.client_csv, self.transaction_csv, self.aggregate_csv)] != \
+                [pathlib.Path(p).resolve() for p in (prefetch.paths['client'], prefetch.paths['tx'],
+                                                     prefetch.paths['aggregate'])]:
+            raise ValueError("Prefetch buffer belongs to another ledger: " + pprint.pformat(prefetch.paths))
+        self.prefetch = prefetch
+        self.history = history
+        self.checkpoints = checkpoints
+        self.client_index = client_index
+        self.changes = changes
+
         self.clients = defaultdict(list)
         self.transactions = defaultdict(list)
+        self.aggregates = {}
+
+    @property
+    def locked(self) -> LockedAccounts:
+        """
+        Locked account bitset for this `client_accounts.csv`
+        """
+        key = str(pathlib.Path(self.client_csv).resolve())
+        if key not in locked_accounts:
+            locked_accounts[key] = LockedAccounts(self.MAX_UINT16 + 1)
+        return locked_accounts[key].sync(self.client_csv, self.COLS['client']['encoding'])
+
+    @property
+    def write_back(self) -> bool:
+        """
+        Saves go to the prefetch buffer and reach the files on `Prefetcher.flush`
+        """
+        return self.prefetch is not None and self.prefetch.write_back
+
+    def snapshot(self, generation=None) -> ClientSnapshot:
+        """
+        Pinned, consistent generation of the client table for balance queries during processing.
+        Generations are only published once snapshots were enabled (`ClientSnapshots.enable`)
+        """
+        snapshots = ClientSnapshots(self.client_csv, encoding=self.COLS['client']['encoding'])
+        if not snapshots.enabled:
+            raise FileNotFoundError("Client snapshots are not enabled, see `ClientSnapshots.enable`: {}".format(
+                snapshots.path))
+        if self.prefetch is not None:
+            self.prefetch.flush()
+        return snapshots.pin(generation)
 
     def new_client(self, *cid, **kwargs) -> object:
         # ignore if client exists
@@ -181,6 +857,20 @@ class PaymentManager:
         except KeyError:
             raise KeyError("unsupported csv fields.")
 
+        # tx lookups by id from the tiered history
+        if index == 'tx' and self.history is not None:
+            records = self.history.get_record(unique, *keys)
+            if records is not None:
+                return records
+
+        # serve from the read-ahead buffer if it holds all keys
+        if self.prefetch is not None:
+            records = self.prefetch.get_record(index, unique, *keys)
+            if records is not None:
+                return records
+            # pending saves must reach the file before reading it
+            self.prefetch.flush()
+
         # get csv path and encoding to write to
         rec_path = self.client_csv if index == 'client' else self.transaction_csv
         encoding = "UTF-16" if index == 'client' else "UTF-32"
@@ -208,39 +898,44 @@ class PaymentManager:
 
         fields = self.COLS['client']['fields']
         encoding = self.COLS['client']['encoding']
-        index = 'client'
-
-        # tmp file for saving after update
-        temp_path = NamedTemporaryFile(mode='w', delete=False)
-        upd = []  # tracks a list of new records
-
-        # read 20MB  chunks
-        with open(self.client_csv, 'r', encoding=encoding, buffering=20000000) as csvfile, \
-                open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
-            reader = csv.DictReader(csvfile, fieldnames=fields)
-            writer = csv.DictWriter(csvtempfile, fieldnames=fields)
-
-            for i, rec in self.clients.items():
-                merge = {}
-                [merge.update(c) for c in rec]
-                # update line in client_accounts if record exists
-                updated = False
-                for row in reader:
-                    # update existing record if exists
-                    if row[index].strip() == merge[index].strip():
-                        updated = True
-                        row.update(**merge)
-                        upd.append(row)
-                        writer.writerow(row)
-                        break
+        locked = self.locked
+
+        # a write-back buffer takes the save, the file is rewritten on flush
+        upd = self.prefetch.saved_clients(self.clients) if self.write_back else None
+        saved = upd is None
+        if saved:
+            # tmp file for saving after update, next to the accounts so the move is an atomic rename
+            temp_path = NamedTemporaryFile(mode='w', delete=False, dir=pathlib.Path(self.client_csv).parent)
+            upd = []  # tracks a list of new records
+
+            # read 20MB  chunks
+            with open(self.client_csv, 'r', encoding=encoding, buffering=20000000) as csvfile, \
+                    open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
+                reader = csv.DictReader(csvfile, fieldnames=fields)
+                writer = csv.DictWriter(csvtempfile, fieldnames=fields)
+                for row in merge_client_rows(reader, self.clients, upd):
                     writer.writerow(row)
-                # now write row to file with possible update
-                if not updated:
-                    writer.writerow(merge)
-            # copy the rest to temp file
-            [writer.writerow(row) for row in reader]
-        # save temp file to client_accounts
-        shutil.move(csvtempfile.name, self.client_csv)
+            # save temp file to client_accounts
+            shutil.move(csvtempfile.name, self.client_csv)
+            if self.prefetch is not None and not self.write_back:
+                self.prefetch.saved_clients(self.clients)
+
+        # keep the locked bitset in step with the saved records e.g. after a chargeback
+        for i, rec in self.clients.items():
+            merge = {}
+            [merge.update(c) for c in rec]
+            try:
+                locked.set(merge['client'], str(merge.get('locked')).strip() == 'True')
+            except (KeyError, ValueError):
+                continue
+        if not saved:
+            return upd
+        locked.stamp = file_stamp(self.client_csv)
+
+        # publish a new generation for snapshot readers
+        snapshots = ClientSnapshots(self.client_csv, encoding=encoding)
+        if snapshots.enabled:
+            snapshots.publish()
 
         return upd
 
@@ -257,42 +952,76 @@ class PaymentManager:
         fields = self.COLS['tx']['fields']
         encoding = self.COLS['tx']['encoding']
 
-        # tmp file for saving after update
-        temp_path = NamedTemporaryFile(mode='w', delete=False)
-        new_data = copy.deepcopy(self.transactions)
-        upd = []  # tracks a list of new records
+        # a write-back buffer takes the save, the file is rewritten on flush
+        upd = self.prefetch.saved_transactions(self.transactions) if self.write_back else None
+        if upd is None:
+            # the compaction job swaps this file too
+            with transactions_lock:
+                # tmp file for saving after update
+                temp_path = NamedTemporaryFile(mode='w', delete=False)
+                upd = []  # tracks a list of new records
+
+                # read 20MB  chunks
+                with open(self.transaction_csv, 'r', encoding=encoding, buffering=20000000) as csvfile, \
+                        open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
+                    reader = csv.DictReader(csvfile, fieldnames=fields)
+                    writer = csv.DictWriter(csvtempfile, fieldnames=fields)
+                    for row in merge_transaction_rows(reader, self.transactions, upd):
+                        writer.writerow(row)
 
-        # read 20MB  chunks
-        with open(self.transaction_csv, 'r', encoding=encoding, buffering=20000000) as csvfile, \
-                open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
-            reader = csv.DictReader(csvfile, fieldnames=fields)
-            writer = csv.DictWriter(csvtempfile, fieldnames=fields)
-            for row in reader:
-                # make a copy of each row read
-                writer.writerow(row)
-                for i, t in self.transactions.items():
-                    for rec in t:
-                        if equal_csv_row_dict(row, rec):
-                            # skip duplicate since row already written in line 256
-                            upd.append(rec)
-                            # remove updated record from new data
-                            for m in upd:
-                                for n in new_data[i]:
-                                    if equal_csv_row_dict(m, n):
-                                        new_data[i].remove(m)
-                                        break
-                            continue
-            # append new records
-            if new_data:
-                for _, l in new_data.items():
-                    for r in l:
-                        upd.append(r)
-                        writer.writerow(r)
-
-        shutil.move(csvtempfile.name, self.transaction_csv)
+                shutil.move(csvtempfile.name, self.transaction_csv)
+                if self.prefetch is not None and not self.write_back:
+                    self.prefetch.saved_transactions(self.transactions)
+                if self.client_index is not None:
+                    self.index_transactions(written=True)
+        elif self.client_index is not None:
+            self.index_transactions(written=False)
+
+        if self.history is not None:
+            for rows in self.transactions.values():
+                for row in rows:
+                    self.history.add(row)
         return upd
 
+    def index_transactions(self, written):
+        """
+        Add the saved records to the client index, `written`: the save replaced `transactions.csv`
+        """
+        for rows in self.transactions.values():
+            for row in rows:
+                self.client_index.add(row)
+        if written:
+            self.client_index.sync(self.transaction_csv)
+
+    def get_history(self, cid, offset=0, limit=100, newest_first=False) -> dict:
+        """
+        One page of a client's transactions, in log order unless `newest_first`
+        Served by the client index if there is one, otherwise by a scan of `transactions.csv` matching ids exactly
+        returns: the client, its number of transactions, the page and the offset of the next page (None if last)
+        """
+        if offset < 0 or limit < 0:
+            raise ValueError("Invalid page: offset {} limit {}".format(offset, limit))
+        cid = str(cid).strip()
+        if self.client_index is not None:
+            total = self.client_index.count(cid)
+            rows = self.client_index.page(cid, offset, limit, newest_first)
+        else:
+            if self.prefetch is not None:
+                # pending saves must reach the file before reading it
+                self.prefetch.flush()
+            fields = self.COLS['tx']['fields']
+            # read 20MB  chunks
+            with open(self.transaction_csv, 'r', encoding=self.COLS['tx']['encoding'], buffering=20000000) as f:
+                rows = [row for row in (Prefetcher.row(r, fields) for r in csv.DictReader(f, fieldnames=fields))
+                        if row['client'] == cid]
+            total = len(rows)
+            rows = (rows[::-1] if newest_first else rows)[offset:offset + limit]
+        return dict(client=cid, total=total, offset=offset, transactions=rows,
+                    next=offset + limit if offset + limit < total else None)
+
     def print_clients(self, with_header=False, encoding='UTF-16'):
+        if self.prefetch is not None:
+            self.prefetch.flush()
         writer = csv.DictWriter(sys.stdout, fieldnames=self.COLS['client']['fields'])
         if with_header:
             writer.writeheader()
@@ -303,6 +1032,127 @@ class PaymentManager:
             for row in reader:
                 writer.writerow(row)
 
+    def get_aggregates(self, *cids) -> dict:
+        """
+        cids: client ids, all clients if none given
+        returns: persisted aggregates by client id
+        """
+        if self.prefetch is not None:
+            records = self.prefetch.get_aggregates(*cids)
+            if records is not None:
+                return records
+            # pending saves must reach the file before reading it
+            self.prefetch.flush()
+
+        fields = self.COLS['aggregate']['fields']
+        keys = {k.strip() for k in cids}
+        records = {}
+        if not pathlib.Path(self.aggregate_csv).exists():
+            return records
+
+        # read 20MB  chunks
+        with open(self.aggregate_csv, 'r', encoding=self.COLS['aggregate']['encoding'], buffering=20000000) as f:
+            for line in csv.DictReader(f, fieldnames=fields):
+                row = {k: '' if v is None else str(v).strip() for k, v in line.items()}
+                if not keys or row['client'] in keys:
+                    records[row['client']] = row
+        return records
+
+    def load_aggregates(self, *cids):
+        """
+        Fetch aggregates of referenced clients. Clients without any open at their current balances
+        """
+        self.aggregates = self.get_aggregates(*cids)
+        for cid in cids:
+            if cid not in self.aggregates and self.clients.get(cid):
+                cx = self.clients[cid][0]
+                agg = {f: "0" for f in self.COLS['aggregate']['fields']}
+                agg.update(client=cx['client'], opening_held=cx['held'] or "0.00",
+                           opening_available=cx['available'] or "0.00", opening_total=cx['total'] or "0.00")
+                self.aggregates[cid] = agg
+
+    def aggregate(self, cid, typ, amount):
+        """
+        Count a successful payment operation, called next to every balance update
+        """
+        amount_field, count_field = self.AGGREGATES[typ]
+        agg = self.aggregates[cid]
+        agg[amount_field] = add(agg[amount_field], amount)
+        agg[count_field] = str(int(agg[count_field]) + 1)
+
+    def save_client_aggregates(self) -> list:
+        """
+        Update existing aggregate records or append new ones to the end of the file
+        returns: a list of successfully updated records
+        """
+        fields = self.COLS['aggregate']['fields']
+        encoding = self.COLS['aggregate']['encoding']
+
+        # a write-back buffer takes the save, the file is rewritten on flush
+        upd = self.prefetch.saved_aggregates(self.aggregates) if self.write_back else None
+        if upd is not None:
+            return upd
+
+        if not pathlib.Path(self.aggregate_csv).exists():
+            pathlib.Path(self.aggregate_csv).touch()
+
+        # tmp file for saving after update
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=pathlib.Path(self.aggregate_csv).parent)
+        upd = []  # tracks a list of updated records
+
+        # read 20MB  chunks
+        with open(self.aggregate_csv, 'r', encoding=encoding, buffering=20000000) as csvfile, \
+                open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
+            reader = csv.DictReader(csvfile, fieldnames=fields)
+            writer = csv.DictWriter(csvtempfile, fieldnames=fields)
+            for row in merge_aggregate_rows(reader, self.aggregates, upd):
+                writer.writerow(row)
+
+        shutil.move(csvtempfile.name, self.aggregate_csv)
+        if self.prefetch is not None and not self.write_back:
+            self.prefetch.saved_aggregates(self.aggregates)
+        return upd
+
+    def check_aggregates(self, *cids) -> list:
+        """
+        Verify aggregates against the client balances
+        - total = opening total + deposited - withdrawn - charged back
+        - held = opening held + disputed - resolved
+        - available = opening available + deposited - withdrawn - disputed + resolved - charged back
+        returns: ids of clients whose aggregates do not add up
+        """
+        aggregates = self.get_aggregates(*cids)
+        clients = self.get_record('client', True, *aggregates.keys())
+        mismatched = []
+        for cid, a in aggregates.items():
+            d = lambda f: Decimal(a[f] or 0)
+            total = d('opening_total') + d('deposited') - d('withdrawn') - d('charged_back')
+            held = d('opening_held') + d('disputed') - d('resolved')
+            available = d('opening_available') + d('deposited') - d('withdrawn') - d('disputed') \
+                + d('resolved') - d('charged_back')
+            cx = [c for c in clients.get(cid, []) if c['client'] == cid]
+            if not cx or (Decimal(cx[0]['total']), Decimal(cx[0]['held']), Decimal(cx[0]['available'])) \
+                    != (total, held, available):
+                mismatched.append(cid)
+        return mismatched
+
+    def print_aggregates(self, *cids, with_header=True):
+        """
+        Report per client aggregates followed by a `*` row with the totals over all reported clients
+        """
+        fields = self.COLS['aggregate']['fields']
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+        if with_header:
+            writer.writeheader()
+
+        totals = {f: "0" for f in fields}
+        totals['client'] = '*'
+        for cid, row in self.get_aggregates(*cids).items():
+            writer.writerow(row)
+            for f in fields[1:]:
+                totals[f] = add(totals[f], row[f] or "0")
+        writer.writerow(totals)
+
     def deposit(self, *data_dict):
         """
         Entry criteria
@@ -336,11 +1186,13 @@ class PaymentManager:
         # client must exist at this point
         if not self.clients:
             raise ClientNotFound("Could not save client record to disk: " + pprint.pformat(new_c))
+        self.load_aggregates(*cids)
 
         for i in data_dict:
             cx = self.clients[i['client']][0]
 
             # perform required operation
+            self.aggregate(i['client'], 'deposit', i['amount'])
             cx["total"] = add(cx["total"], i['amount'])
             cx["available"] = add(cx["available"], i['amount'])
 
@@ -355,14 +1207,18 @@ class PaymentManager:
         - Amount is +ve
         - Available amount > Withdrawal amount
         """
+        # get clients referenced in transactions, once so every row sees the ones before it
+        cids = [i['client'] for i in data_dict]
+        self.clients = self.get_record('client', True, *cids)
+        self.load_aggregates(*cids)
+
         for i in data_dict:
-            # get referenced client
-            self.clients = self.get_record('client', True, i['client'])
             cx = self.clients[i['client']][0]
             if cx['available'] and Decimal(cx['available']) < Decimal(i['amount']):
                 raise WithdrawalError("Insufficient funds: " + pprint.pformat(i))
 
             # perform withdrawal action
+            self.aggregate(i['client'], 'withdrawal', i['amount'])
             cx["total"] = subtract(cx["total"], i['amount'])
             cx["available"] = subtract(cx["available"], i['amount'])
 
@@ -385,6 +1241,7 @@ class PaymentManager:
 
         # get clients referenced  in  transactions
         self.clients = self.get_record('client', True, *ids)
+        self.load_aggregates(*ids)
 
         for i in data_dict:
             self.dispute_criteria_ok(i, self.clients, current)
@@ -397,6 +1254,7 @@ class PaymentManager:
             if cx['available'] and Decimal(cx['available']) < Decimal(disp_amount):
                 raise DisputeError("Insufficient funds :" + pprint.pformat(i))
             # hold disputed amount
+            self.aggregate(i['client'], 'dispute', disp_amount)
             cx["held"] = add(cx['held'], disp_amount)
             cx["available"] = subtract(cx["available"], disp_amount)
 
@@ -421,6 +1279,7 @@ class PaymentManager:
 
         # get clients referenced  in  transactions
         self.clients = self.get_record('client', True, *ids)
+        self.load_aggregates(*ids)
 
         for i in data_dict:
             self.dispute_pending(i, self.clients, cur)
@@ -434,6 +1293,7 @@ class PaymentManager:
                 ResolveError("Insufficient funds :" + pprint.pformat(i))
 
             # move held amount to available funds
+            self.aggregate(i['client'], 'resolve', disp_amount)
             cx["held"] = subtract(cx["held"], disp_amount)
             cx["available"] = add(cx["available"], disp_amount)
 
@@ -464,6 +1324,7 @@ class PaymentManager:
 
         # get clients referenced  in  transactions
         self.clients = self.get_record('client', True, *ids)
+        self.load_aggregates(*ids)
 
         for i in data_dict:
             cx = self.clients[i['client']][0]
@@ -473,6 +1334,7 @@ class PaymentManager:
             if cx["available"] and Decimal(cx["available"]) < disp_amt:
                 raise ChargeBackError("Insufficient Funds: " + pprint.pformat(i))
 
+            self.aggregate(i['client'], 'chargeback', disp_amt)
             cx["available"] = subtract(cx["available"], disp_amt)
             cx["total"] = subtract(cx["total"], disp_amt)
             cx["locked"] = "True"
@@ -576,26 +1438,33 @@ class PaymentManager:
         if not deposit_exist:
             raise DisputeError("Invalid tx: No deposit exist for this transaction: " + pprint.pformat(tx))
 
+    @staticmethod
+    def valid_id(i, limit) -> bool:
+        # decimal digits within [0, limit]
+        i = str(i).strip()
+        return i.isascii() and i.isdigit() and int(i) <= limit
+
     @staticmethod
     def valid_id_or_fail(tx):
         # get id from record
         c = tx.get('client')
         t = tx.get('tx')
 
-        if c and bin(int(str(c))).count('1') > 16:
+        if c and not PaymentManager.valid_id(c, PaymentManager.MAX_UINT16):
             raise ValueError("Invalid `{}` id in {}".format(c, tx))
 
-        if t and bin(int(str(t))).count('1') > 32:
+        if t and not PaymentManager.valid_id(t, PaymentManager.MAX_UINT32):
             raise ValueError("Invalid `{}` id in {}".format(t, tx))
         if not (c or t):
             raise ValueError("Missing transaction id(s) in `{}`".format(tx))
 
     def generate_id(self, typ):
-        m = self.MAX_UINT16 if typ == 'tx' else self.MAX_UINT32
+        # client ids are u16, tx ids u32
+        m = self.MAX_UINT16 if typ == 'client' else self.MAX_UINT32
         for i in range(10):  # ten tries and quit
-            i = randrange(1, m)
-            if not self.get_record('client', True, i):
-                return str(i)
+            i = str(randrange(1, m))
+            if not self.get_record(typ, True, i):
+                return i
         raise Exception("Cannot generate new `typ` id")
 
     def validate(self, tx):
@@ -620,6 +1489,10 @@ class PaymentManager:
         else:
             self.valid_id_or_fail(tx)
 
+        # reject frozen accounts before fetching any record
+        if tx.get('client') in self.locked:
+            raise ClientAccountLocked("Client account is locked: " + pprint.pformat(tx))
+
         # skip locked accounts
         client = self.get_record('client', True, tx['client'])
         if client:
@@ -754,6 +1627,236 @@ class PaymentManager:
         return True
 
 
+def compact_row(row, fields) -> dict:
+    """
+    Canonical form of a transaction row: known fields only, stripped, no `None`
+    """
+    return {f: '' if row.get(f) is None else str(row.get(f)).strip() for f in fields}
+
+
+def compact_transactions(transaction_csv, encoding='UTF-32') -> dict:
+    """
+    Rewrite `transactions.csv` into its compact canonical form and swap it in atomically.
+
+    Every saved row is a distinct (tx, type) pair that `validate` checks uniqueness against and
+    `get_disputed_amount` counts every amount of a tx (withdrawals included), so no row can be
+    dropped without changing a rule outcome. Compaction strips padding, `None` values and
+    columns the ledger does not read. Rows saved by `process` are canonical already, so a log
+    it wrote keeps its size; the amounts of charged-back txs, which no rule reads again, are
+    kept as well since the chain digests, `Checkpoints` and `reconcile` are taken over them.
+
+    Safe to run next to processing: rows saved after the snapshot are carried over
+    under `transactions_lock` right before the swap.
+    returns: stats of the run
+    """
+    fields = PaymentManager.COLS['tx']['fields']
+    path = pathlib.Path(transaction_csv)
+    stats = dict(rows=0, tail=0, bytes_before=path.stat().st_size, bytes_after=None, swapped=False)
+
+    # tmp file next to the ledger so the swap is an atomic rename
+    temp_path = NamedTemporaryFile(mode='w', delete=False, dir=path.parent, suffix='.compact')
+    temp_path.close()
+    digest = hashlib.sha1()
+
+    try:
+        with transactions_lock:
+            stamp = file_stamp(path)
+            csvfile = open(path, 'r', encoding=encoding, buffering=20000000)
+
+        with csvfile, open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
+            writer = csv.DictWriter(csvtempfile, fieldnames=fields)
+            for row in csv.DictReader(csvfile, fieldnames=fields):
+                row = compact_row(row, fields)
+                digest.update(repr(row).encode())
+                writer.writerow(row)
+                stats['rows'] += 1
+
+            with transactions_lock:
+                if file_stamp(path) != stamp:
+                    # saves only append so the snapshot must still be the head of the file
+                    head = hashlib.sha1()
+                    with open(path, 'r', encoding=encoding, buffering=20000000) as f:
+                        reader = csv.DictReader(f, fieldnames=fields)
+                        for _, row in zip(range(stats['rows']), reader):
+                            head.update(repr(compact_row(row, fields)).encode())
+                        if head.digest() != digest.digest():
+                            # rewritten by someone else, try again on the next run
+                            return stats
+                        for row in reader:
+                            writer.writerow(compact_row(row, fields))
+                            stats['tail'] += 1
+                csvtempfile.close()
+                os.replace(temp_path.name, path)
+                stats['swapped'] = True
+    finally:
+        if not stats['swapped']:
+            os.remove(temp_path.name)
+
+    stats['bytes_after'] = path.stat().st_size
+    return stats
+
+
+class Compactor(threading.Thread):
+    """
+    Runs `compact_transactions` in the background, once or every `interval` seconds.
+
+    A failing pass does not end the thread: its exception is kept in `error` (the latest) and `errors` (every
+    one) and the next pass runs as scheduled. `stop` re-raises the latest error once the thread is joined.
+    """
+
+    def __init__(self, transaction_csv, interval=None, encoding='UTF-32'):
+        super().__init__(daemon=True)
+        self.transaction_csv = transaction_csv
+        self.interval = interval
+        self.encoding = encoding
+        self.stats = None  # stats of the last run
+        self.error = None
+        self.errors = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.stats = compact_transactions(self.transaction_csv, self.encoding)
+            except Exception as err:
+                # e.g. csv.Error or ValueError on a malformed log, the next pass may succeed
+                self.error = err
+                self.errors.append(err)
+            if not self.interval:
+                break
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+class LatencyHistogram:
+    """
+    HDR style histogram of integer latencies (ns).
+
+    Values are counted in buckets of powers of two, each split into 2 ** `precision` linear sub-buckets, so any
+    recorded value is reported within a relative error of 2 ** -`precision` whatever its magnitude, with a few
+    hundred counters for anything from nanoseconds to hours.
+    """
+
+    def __init__(self, precision=7):
+        self.precision = precision
+        self.counts = defaultdict(int)  # (shift, sub-bucket) -> count
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def bucket(self, value) -> tuple:
+        shift = max(value.bit_length() - self.precision - 1, 0)
+        return shift, value >> shift
+
+    def record(self, value, count=1):
+        value = max(int(value), 0)
+        self.counts[self.bucket(value)] += count
+        self.count += count
+        self.total += value * count
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q) -> int:
+        """
+        returns: the highest value equivalent to the bucket holding the `q` (0-100) percentile, 0 if empty
+        """
+        if not self.count:
+            return 0
+        rank = max(1, -(-self.count * q // 100))
+        seen = 0
+        for shift, sub in sorted(self.counts, key=lambda k: k[1] << k[0]):
+            seen += self.counts[shift, sub]
+            if seen >= rank:
+                return min(((sub + 1) << shift) - 1, self.max)
+        return self.max
+
+    def summary(self, unit=1000) -> dict:
+        # microseconds by default
+        return dict(count=self.count, mean=round(self.total / self.count / unit, 3) if self.count else 0,
+                    **{'p{}'.format(q): round(self.percentile(q) / unit, 3) for q in (50, 95, 99)},
+                    max=round(self.max / unit, 3))
+
+
+class ProcessStats:
+    """
+    Latency histograms and outcome counts of every row applied by `process()` in this process, end to end
+    (validation, action and saves) and per operation type
+    """
+    TYPES = ('deposit', 'withdrawal', 'dispute', 'resolve', 'chargeback')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.latency = {'all': LatencyHistogram()}
+            self.latency.update((typ, LatencyHistogram()) for typ in self.TYPES)
+            self.rejected = defaultdict(int)
+
+    def record(self, typ, elapsed, rejected=False):
+        typ = typ if typ in self.TYPES else 'invalid'
+        with self.lock:
+            self.latency['all'].record(elapsed)
+            self.latency.setdefault(typ, LatencyHistogram()).record(elapsed)
+            if rejected:
+                self.rejected['all'] += 1
+                self.rejected[typ] += 1
+
+    def report(self) -> dict:
+        """
+        returns: rows, rows/sec and rejection rate overall and per operation type, latencies in microseconds
+        """
+        with self.lock:
+            seconds = time.perf_counter() - self.started
+            rows = self.latency['all'].count
+            return dict(rows=rows, seconds=round(seconds, 6), rows_per_sec=round(rows / seconds, 3) if seconds else 0,
+                        rejected=self.rejected['all'],
+                        rejection_rate=round(self.rejected['all'] / rows, 6) if rows else 0,
+                        types={typ: dict(h.summary(), rejection_rate=round(self.rejected[typ] / h.count, 6))
+                               for typ, h in self.latency.items() if typ != 'all' and h.count},
+                        latency_us=self.latency['all'].summary())
+
+    def dump(self, path):
+        """
+        Write the report as JSON, replacing `path` atomically so scrapers never read a partial file
+        """
+        path = pathlib.Path(path)
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=path.parent, suffix='.json')
+        with open(temp_path.name, 'w') as f:
+            json.dump(self.report(), f)
+        shutil.move(temp_path.name, path)
+
+    def dump_every(self, path, interval) -> threading.Event:
+        """
+        Dump the report every `interval` seconds in a background thread until the returned event is set
+        """
+        stop = threading.Event()
+
+        def dump_loop():
+            while not stop.wait(interval):
+                self.dump(path)
+
+        threading.Thread(target=dump_loop, daemon=True).start()
+        return stop
+
+
+# latencies of `process()`, see `--stats`
+process_stats = ProcessStats()
+
+
 def process(*data_dict, **kwargs):
     """
     Calls transaction action based on type field from csv 
@@ -761,6 +1864,8 @@ def process(*data_dict, **kwargs):
     p = PaymentManager(**kwargs)
 
     for d in data_dict:
+        start = time.perf_counter_ns()
+        rejected = True
         try:
             if not p.validate(d):
                 # ignore invalid transactions
@@ -772,6 +1877,16 @@ def process(*data_dict, **kwargs):
                 p.save_client_accounts()
             if p.transactions:
                 p.save_transactions()
+            if p.aggregates:
+                p.save_client_aggregates()
+            if p.checkpoints is not None:
+                p.checkpoints.record(d, p.clients)
+            if p.changes is not None:
+                p.changes.record(d, p.clients)
+                # a write-back buffer reaches the files later, its writer commits the feed after it
+                if not p.write_back:
+                    p.changes.commit()
+            rejected = False
 
         except PaymentError as err:
             # ignore if streaming a csv file as main
@@ -780,45 +1895,692 @@ def process(*data_dict, **kwargs):
                     print(err)
             else:
                 return p, err
+        finally:
+            process_stats.record(d.get('type'), time.perf_counter_ns() - start, rejected)
     return p
 
 
+def read_rows(f):
+    """
+    Stripped rows of an input file or stream, header skipped
+    """
+    reader = csv.DictReader(f, fieldnames=PaymentManager.COLS['tx']['fields'])
+    # skip header
+    next(reader, None)
+    for row in reader:
+        yield {k.strip(): str(v).strip().replace('None', '') for k, v in row.items()}
+
+
+def digit_strings(column):
+    """
+    True where a string column holds ASCII decimal digits only, one vectorized test over its code points
+    """
+    column = np.ascontiguousarray(column)
+    width = column.dtype.itemsize // 4
+    if not len(column) or not width:
+        return np.zeros(len(column), dtype=bool)
+    codes = column.view(np.uint32).reshape(len(column), width)
+    # shorter strings are padded with 0
+    return (((codes >= 48) & (codes <= 57)) | (codes == 0)).all(axis=1) & (codes[:, 0] != 0)
+
+
+def decimal_above_zero(amount) -> bool:
+    # what `validate` makes of an amount: a Decimal (`1e3`, `+1`, `1_000` too) above 0
+    try:
+        return Decimal(amount) > 0
+    except ArithmeticError:
+        # not a number, or NaN which cannot be compared
+        return False
+
+
+def ids_within(column, limit):
+    """
+    True where a string column holds an id in [0, limit] as decimal digits, see `PaymentManager.valid_id`
+    """
+    given = column != ''
+    column = np.char.lstrip(column, '0')
+    # all zeros is id 0
+    column = np.where(given & (column == ''), '0', column)
+    ok = given & digit_strings(column) & (np.char.str_len(column) <= len(str(limit)))
+    return ok & (np.where(ok, column, '0').astype(np.int64) <= limit)
+
+
+def prevalidate_rows(rows) -> tuple:
+    """
+    Checks of a parsed chunk that need no ledger state, one NumPy pass per column:
+
+    - client: u16 and tx: u32 as decimal digits, one of them given (`valid_id_or_fail`)
+    - type: a payment operation
+    - amount: a Decimal above 0 as `validate` parses it, required by deposits and withdrawals; plain decimals are
+      checked vectorized, other spellings (`1e3`, `+1`) one by one with `Decimal`
+
+    A row is only rejected here if `process()` would reject it too.
+    returns: the surviving rows in order and the rejected rows as (row, reason) pairs, reason being the first
+    failed check in the order above: `client`, `tx`, `type` or `amount`
+    """
+    if np is None:
+        raise ImportError("numpy is needed for pre-validation")
+    rows = list(rows)
+    if not rows:
+        return [], []
+    fields = PaymentManager.COLS['tx']['fields']
+    column = {f: np.char.strip(np.array([str(row.get(f) or '') for row in rows])) for f in fields}
+
+    client_ok = (column['client'] == '') | ids_within(column['client'], PaymentManager.MAX_UINT16)
+    tx_ok = ids_within(column['tx'], PaymentManager.MAX_UINT32) | ((column['tx'] == '') & (column['client'] != ''))
+    type_ok = np.isin(column['type'], list(PaymentManager.AGGREGATES))
+
+    whole, _, fraction = np.char.partition(column['amount'], '.').T
+    plain = (digit_strings(whole) | (whole == '')) & (digit_strings(fraction) | (fraction == '')) & \
+        (np.char.str_len(whole) + np.char.str_len(fraction) > 0)
+    positive = plain & (np.char.strip(np.char.add(whole, fraction), '0') != '')
+    other = np.flatnonzero(~plain & (column['amount'] != ''))
+    positive[other] = [decimal_above_zero(a) for a in column['amount'][other].tolist()]
+    required = np.isin(column['type'], ['deposit', 'withdrawal'])
+    amount_ok = np.where(column['amount'] == '', ~required, positive)
+
+    reason = np.select([~client_ok, ~tx_ok, ~type_ok, ~amount_ok], ['client', 'tx', 'type', 'amount'], '')
+    survivors, rejected = [], []
+    for row, r in zip(rows, reason.tolist()):
+        if r:
+            rejected.append((row, r))
+        else:
+            survivors.append(row)
+    return survivors, rejected
+
+
+def reject_invalid(row, reason, elapsed, reasons=None):
+    # a row failing the pre-validation checks, counted like a rejection by `process()`
+    process_stats.record(row.get('type'), elapsed, True)
+    if reasons is not None:
+        reasons[reason] += 1
+    if os.getenv('DEBUG'):
+        print("Invalid `{}`: {}".format(reason, pprint.pformat(row)))
+
+
+def prevalidated(rows, size=4096, reasons=None):
+    """
+    The rows that pass `prevalidate_rows`, checked `size` rows at a time. Rejected rows are counted by
+    `process_stats` (at their share of the pass) and by reason in `reasons`
+    """
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        start = time.perf_counter_ns()
+        survivors, rejected = prevalidate_rows(chunk)
+        elapsed = (time.perf_counter_ns() - start) // len(chunk)
+        for row, reason in rejected:
+            reject_invalid(row, reason, elapsed, reasons)
+        yield from survivors
+
+
+class MappedInput:
+    """
+    A UTF-32 input file read through an mmap with NumPy.
+
+    Every character of UTF-32 is one code point, so the file is viewed as a uint32 array (`numpy.frombuffer`):
+    one vectorized pass finds the newlines and commas, `columns` parses the type, client, tx and amount of a block
+    of rows straight into typed arrays from their code points, no `str` is made per field. `rows` hands on rows as
+    `read_rows` yields them, one decode per block; with `prevalidate` the checks of `prevalidate_rows` run on the
+    typed columns and only surviving rows are built. `process()` takes rows as dicts of strings, the columns
+    themselves (ids, types, fixed-point amounts) are consumed by `main.settle.settle_mapped`.
+
+    Files the vectorized parse does not cover are read with `read_rows` (`mapped` is False): quoted fields, `\\r`
+    line breaks, rows without exactly four fields and fields containing `None` (which `read_rows` drops).
+    """
+    TYPES = list(PaymentManager.AGGREGATES)
+    CHUNK = 1 << 24  # code points scanned at a time
+    SPACES = [c for c in range(0x3001) if chr(c).isspace()]
+
+    def __init__(self, path, block=65536):
+        if np is None:
+            raise ImportError("numpy is needed for mapped input")
+        self.path = path
+        self.block = block
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        bom = self.map[:4] if size else b''
+        offset = 4 if bom in (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE) else 0
+        # without a BOM the native byte order, as the UTF-32 codec
+        big = bom == codecs.BOM_UTF32_BE or (not offset and sys.byteorder == 'big')
+        self.encoding = 'UTF-32-BE' if big else 'UTF-32-LE'
+        self.codes = np.frombuffer(self.map, '>u4' if big else '<u4', (size - offset) // 4, offset) \
+            if size - offset >= 4 else np.zeros(0, '<u4')
+        self.starts, self.stops, self.commas = self.line_bounds()
+        self.mapped = self.starts is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # views of the map go before it
+        self.codes = self.starts = self.stops = self.commas = None
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def line_bounds(self) -> tuple:
+        """
+        returns: start, end (before `\\r\\n`) and the 3 comma positions of every non-blank line after the header,
+        all None if a line needs the csv module
+        """
+        codes = self.codes
+        ends, commas = [], []
+        for i in range(0, len(codes), self.CHUNK):
+            window = codes[i:i + self.CHUNK]
+            # the few code points that matter to the structure are all below '-'
+            low = np.flatnonzero(window <= 44)
+            kind = window[low]
+            if (kind == 34).any():
+                return None, None, None
+            cr = low[kind == 13] + i
+            if len(cr) and (cr[-1] + 1 >= len(codes) or (codes[cr + 1] != 10).any()):
+                return None, None, None
+            n = np.flatnonzero(window == 78) + i
+            n = n[n + 3 < len(codes)]
+            if ((codes[n + 1] == 111) & (codes[n + 2] == 110) & (codes[n + 3] == 101)).any():
+                return None, None, None
+            ends.append(low[kind == 10] + i)
+            commas.append(low[kind == 44] + i)
+        ends = np.concatenate(ends) if ends else np.zeros(0, np.int64)
+        commas = np.concatenate(commas) if commas else np.zeros(0, np.int64)
+        if len(codes) and (not len(ends) or ends[-1] != len(codes) - 1):
+            # last line without a newline
+            ends = np.append(ends, len(codes))
+        starts = np.r_[0, ends[:-1] + 1].astype(np.int64)
+        stops = ends - ((ends > starts) & (codes[np.maximum(ends - 1, 0)] == 13)) if len(codes) else ends
+        blank = stops == starts
+        starts, stops = starts[~blank], stops[~blank]
+        header = stops[0] if len(stops) else 0
+        starts, stops = starts[1:], stops[1:]
+        commas = commas[commas > header]
+        first = np.searchsorted(commas, starts)
+        if (np.searchsorted(commas, stops) - first != 3).any():
+            return None, None, None
+        return starts, stops, commas.reshape(-1, 3)
+
+    def spaces(self, c):
+        # what `str.strip` removes
+        space = ((c >= 9) & (c <= 13)) | ((c >= 28) & (c <= 32))
+        return space | (c > 127) & np.isin(c, self.SPACES)
+
+    @staticmethod
+    def scan(codes, count, dots, s, e, digits=18) -> dict:
+        """
+        Digit counts of the fields [s, e) of `codes`, `count` being the prefix count of its digits and `dots` the
+        positions of its dots
+        returns: per field, `digits`, `dots`, position of the first `dot` (e if none), digits after it (`places`),
+        position of the `first` significant digit (past leading zeros and dots, e if none), `significant` digits from
+        there on and their `value` if there are at most `digits` of them (else 0)
+        """
+        out = dict(digits=count[e] - count[s])
+        out['dots'] = np.searchsorted(dots, e) - np.searchsorted(dots, s)
+        if len(dots):
+            i = np.minimum(np.searchsorted(dots, s), len(dots) - 1)
+            out['dot'] = np.where((dots[i] >= s) & (dots[i] < e), dots[i], e)
+        else:
+            out['dot'] = e
+        out['places'] = count[e] - count[out['dot']]
+        first = s.copy()
+        active = np.flatnonzero(first < e)
+        while len(active):
+            c = codes[first[active]]
+            active = active[(c == 48) | (c == 46)]
+            first[active] += 1
+            active = active[first[active] < e[active]]
+        out['first'] = first
+        significant = out['significant'] = count[e] - count[first]
+        # fields grouped by their number of significant digits, one gather per digit, a dot after the first skipped
+        out['value'] = value = np.zeros(len(s), dtype=np.int64)
+        skip = np.where(out['dot'] > first, out['dot'], -1)
+        for n in np.unique(significant[(significant > 0) & (significant <= digits)]):
+            rows = np.flatnonzero(significant == n)
+            at, dot, v = first[rows], skip[rows], np.zeros(len(rows), dtype=np.int64)
+            for _ in range(n):
+                at = at + (at == dot)
+                v = v * 10 + codes[at] - 48
+                at = at + 1
+            value[rows] = v
+        return out
+
+    def columns(self, lo, hi) -> dict:
+        """
+        Typed columns of rows `lo` to `hi`: `type` (index into TYPES, -1 if unknown), `client` and `tx` (int64,
+        -1 if not an id in range), `amount` (int64 multiples of 10 ** -`scale`, 0 if not a plain decimal or
+        beyond 18 digits), its decimal `places`, `decimal` where it is digits[.digits] held exactly in `amount`, and
+        the `reason` each row fails pre-validation ('' if it passes, see `prevalidate_rows`)
+        """
+        base = self.starts[lo]
+        codes = self.codes[base:self.stops[hi - 1]]
+        commas = self.commas[lo:hi] - base
+        bounds = zip(PaymentManager.COLS['tx']['fields'],
+                     [self.starts[lo:hi] - base] + [commas[:, k] + 1 for k in range(3)],
+                     [commas[:, k] for k in range(3)] + [self.stops[lo:hi] - base])
+        trimmed = {}
+        for f, s, e in bounds:
+            for edge, step in ((s, 0), (e, -1)):
+                active = np.flatnonzero(s < e)
+                while len(active):
+                    active = active[self.spaces(codes[edge[active] + step])]
+                    edge[active] += 1 if step == 0 else -1
+                    active = active[s[active] < e[active]]
+            trimmed[f] = s, e
+
+        s, e = trimmed['type']
+        typ = np.full(len(s), -1, dtype=np.int8)
+        for k, name in enumerate(self.TYPES):
+            match = np.flatnonzero(e - s == len(name))
+            for j, c in enumerate(name):
+                match = match[codes[s[match] + j] == ord(c)]
+            typ[match] = k
+
+        count = np.zeros(len(codes) + 1, dtype=np.int32)
+        np.cumsum((codes - 48) < 10, out=count[1:])  # unsigned, wraps below '0'
+        dots = np.flatnonzero(codes == 46)
+
+        def ids(f, limit):
+            s, e = trimmed[f]
+            scan = self.scan(codes, count, dots, s, e, len(str(limit)))
+            ok = (e > s) & (scan['digits'] == e - s) & (scan['significant'] <= len(str(limit))) & \
+                (scan['value'] <= limit)
+            return np.where(ok, scan['value'], -1), e > s
+
+        client, client_given = ids('client', PaymentManager.MAX_UINT16)
+        tx, tx_given = ids('tx', PaymentManager.MAX_UINT32)
+
+        s, e = trimmed['amount']
+        scan = self.scan(codes, count, dots, s, e)
+        plain = (scan['digits'] + scan['dots'] == e - s) & (scan['dots'] <= 1) & (scan['digits'] > 0)
+        positive = plain & (scan['first'] < e)
+        # other spellings `Decimal` accepts are parsed as `validate` does
+        other = np.flatnonzero(~plain & (e > s))
+        positive[other] = [decimal_above_zero(codes[s[i]:e[i]].tobytes().decode(self.encoding)) for i in other]
+        scale = int(scan['places'][plain].max()) if plain.any() else 0
+        shift = scale - scan['places'].astype(np.int64)
+        # fixed point in int64 for up to 18 digits
+        exact = plain & (scan['significant'] + shift <= 18)
+        amount = np.where(exact, scan['value'] * 10 ** np.where(exact, shift, 0), 0)
+        decimal = exact & (scan['digits'] > scan['places']) & ((scan['dots'] == 0) | (scan['places'] > 0))
+
+        required = np.isin(typ, [self.TYPES.index('deposit'), self.TYPES.index('withdrawal')])
+        amount_ok = np.where(e == s, ~required, positive)
+        client_ok = ~client_given | (client >= 0)
+        tx_ok = (tx >= 0) | (~tx_given & client_given)
+        reason = np.select([~client_ok, ~tx_ok, typ < 0, ~amount_ok], ['client', 'tx', 'type', 'amount'], '')
+        return dict(type=typ, client=client, tx=tx, amount=amount, scale=scale,
+                    places=np.where(plain, scan['places'], 0).astype(np.int64), decimal=decimal, reason=reason)
+
+    def lines(self, lo, hi) -> list:
+        # one decode for the block, blank lines are not rows
+        text = self.codes[self.starts[lo]:self.stops[hi - 1]].tobytes().decode(self.encoding)
+        return [line for line in text.split('\n') if line and line != '\r']
+
+    @staticmethod
+    def row(line) -> dict:
+        return dict(zip(PaymentManager.COLS['tx']['fields'], (v.strip() for v in line.split(','))))
+
+    def rows(self, prevalidate=False, reasons=None):
+        """
+        The rows as `read_rows` yields them, with `prevalidate` only those passing the checks of `prevalidate_rows`
+        (rejected ones are counted as by `prevalidated`)
+        """
+        if not self.mapped:
+            # read 20MB  chunks
+            with open(self.path, 'r', encoding='UTF-32', buffering=20000000) as csvfile:
+                rows = read_rows(csvfile)
+                yield from prevalidated(rows, self.block, reasons) if prevalidate else rows
+            return
+        for lo in range(0, len(self), self.block):
+            hi = min(lo + self.block, len(self))
+            lines = self.lines(lo, hi)
+            if not prevalidate:
+                yield from map(self.row, lines)
+                continue
+            start = time.perf_counter_ns()
+            reason = self.columns(lo, hi)['reason']
+            elapsed = (time.perf_counter_ns() - start) // (hi - lo)
+            for i in np.flatnonzero(reason != ''):
+                reject_invalid(self.row(lines[i]), str(reason[i]), elapsed, reasons)
+            yield from (self.row(lines[i]) for i in np.flatnonzero(reason == ''))
+
+
+def expand_globs(args) -> list:
+    """
+    `args` in order, globs replaced by their matches in sorted order
+    """
+    return [path for arg in args for path in (sorted(glob.glob(arg)) if glob.has_magic(arg) else [arg])]
+
+
+def input_paths(args) -> list:
+    """
+    Input files named by `args` in order, globs expanded; a name that does not exist is looked up in `assets`
+    """
+    paths = []
+    for arg in expand_globs(args):
+        path = pathlib.Path(arg)
+        if not path.exists():
+            path = pathlib.Path(__file__).resolve().parent.parent / "assets" / arg
+        if not path.exists():
+            raise FileNotFoundError(arg)
+        paths.append(path)
+    return paths
+
+
+def count_rows(path, index) -> int:
+    if not pathlib.Path(path).exists():
+        return 0
+    with open(path, 'r', encoding=PaymentManager.COLS[index]['encoding'], buffering=20000000) as f:
+        return sum(1 for line in f if line.strip())
+
+
+def process_files(paths, window=0, partition=None, history=None, depth=None, fingerprint=None, prevalidate=None,
+                  mapped=False, **kwargs) -> dict:
+    """
+    Apply the input files one after the other to one ledger, the prefetch buffer and the history are shared by
+    all files so each file only pays for its rows. With a queue `depth` the rows go through `pipeline`.
+    With `fingerprint` (average chunk rows) rows applied before are skipped, see `main.fingerprint.InputRegistry`.
+    With `prevalidate` (chunk rows) rows failing `prevalidate_rows` are rejected before any ledger check.
+    With `mapped` the files are decoded from an mmap, see `MappedInput`.
+    kwargs: ledger paths as for `PaymentManager`
+    returns: stats and the `PaymentManager` of the last row
+    """
+    from main.fingerprint import InputRegistry, skip_chunks
+    from main.partition import partition_rows
+    from main.pipeline import pipeline
+    from main.stream import batches
+
+    ledger = PaymentManager(**kwargs)
+    ledger_paths = dict(kwargs, client_csv=ledger.client_csv, transaction_csv=ledger.transaction_csv)
+    # PREFETCH=N reads the records of the next N rows with one pass over each store
+    prefetch = Prefetcher(ledger.client_csv, ledger.transaction_csv, kwargs.get('aggregate_csv')) \
+        if window and not depth else None
+    stats = dict(files=0, rows=0, applied=-count_rows(ledger.transaction_csv, 'tx'), manager=None)
+    start = time.perf_counter()
+    registry = InputRegistry.load(ledger.transaction_csv, -stats['applied']) if fingerprint else None
+    if registry is not None:
+        stats.update(skipped=0, inputs=[])
+    if prevalidate:
+        stats['invalid'] = defaultdict(int)
+
+    def file_rows():
+        for path in paths:
+            skip = []
+            if registry is not None:
+                # FINGERPRINT=N skips the rows applied before, matched in chunks of about N rows
+                plan = registry.plan(pathlib.Path(path), fingerprint)
+                skip = plan['skip']
+                stats['inputs'].append(plan['report'])
+                stats['skipped'] += plan['report']['skipped_rows']
+            # read 20MB  chunks
+            with (MappedInput(path, prevalidate or 65536) if mapped else
+                  open(path, 'r', encoding='UTF-32', buffering=20000000)) as source:
+                if mapped and not skip:
+                    # MMAP_INPUT=1 decodes the input from an mmap, pre-validation runs on its typed columns
+                    rows = source.rows(prevalidate, stats.get('invalid'))
+                else:
+                    rows = source.rows() if mapped else read_rows(source)
+                    rows = skip_chunks(rows, skip) if skip else rows
+                    if prevalidate:
+                        # PREVALIDATE=N rejects rows with bad ids, types or amounts N rows at a time
+                        rows = prevalidated(rows, prevalidate, stats['invalid'])
+                if partition:
+                    # PARTITION=N processes the input grouped by ranges of N client ids
+                    rows = (row for _, row in partition_rows(rows, span=partition))
+                yield from rows
+            stats['files'] += 1
+
+    if depth:
+        stats['pipeline'] = pipeline(file_rows(), window or 256, depth, history=history, **ledger_paths)
+        stats['rows'] = stats['pipeline']['rows']
+        stats['manager'] = PaymentManager(**ledger_paths) if stats['rows'] else None
+    else:
+        for batch in batches(file_rows(), window or 1):
+            if prefetch:
+                prefetch.load(batch)
+            for row in batch:
+                stats['rows'] += 1
+                try:
+                    mgr = process(row, prefetch=prefetch, history=history, **ledger_paths)
+                except PaymentError as err:
+                    if os.getenv('DEBUG'):
+                        print(err)
+                    continue
+                # module mode returns the error instead
+                stats['manager'] = mgr[0] if isinstance(mgr, tuple) else mgr
+
+    if prevalidate:
+        stats['rows'] += sum(stats['invalid'].values())
+    position = count_rows(ledger.transaction_csv, 'tx')
+    stats['applied'] += position
+    stats['rejected'] = stats['rows'] - stats['applied']
+    if registry is not None:
+        registry.commit(position)
+    stats['seconds'] = round(time.perf_counter() - start, 6)
+    return stats
+
+
+def process_ledger(directory, pattern='*.csv', window=0, partition=None, horizon=None, depth=None) -> dict:
+    """
+    Process the input files matching `pattern` in `directory` against the ledger kept in that directory
+    (`client_accounts.csv`, `transactions.csv`), created if missing
+    returns: stats of the ledger, `error` if it failed
+    """
+    from main.history import DepositHistory
+
+    directory = pathlib.Path(directory)
+    ledger = dict(client_csv=directory / "client_accounts.csv", transaction_csv=directory / "transactions.csv")
+    store = set(ledger.values()) | {aggregate_path(ledger['client_csv'])}
+    paths = [path for path in sorted(directory.glob(pattern)) if path not in store and path.is_file()]
+    stats = dict(ledger=str(directory), files=0, rows=0, applied=0, rejected=0, seconds=0)
+    process_stats.reset()
+    try:
+        for path in ledger.values():
+            path.touch()
+        # HISTORY=N keeps the rows of the N most recent txs in memory and spills older ones to disk
+        with (DepositHistory.load(ledger['transaction_csv'], horizon) if horizon else
+              contextlib.nullcontext()) as history:
+            result = process_files(paths, window, partition, history, depth, **ledger)
+        result.pop('manager')
+        stats.update(result)
+    except Exception as err:
+        # one failing ledger does not stop the others
+        stats['error'] = "{}: {}".format(type(err).__name__, err)
+    stats['clients'] = count_rows(ledger['client_csv'], 'client')
+    stats['latency_us'] = process_stats.latency['all'].summary()
+    # merged into the stats of the parent process
+    stats['process_stats'] = process_stats.latency, dict(process_stats.rejected)
+    return stats
+
+
+def process_ledgers(directories, pattern='*.csv', workers=None, **kwargs) -> dict:
+    """
+    Process independent ledger directories in parallel worker processes, see `process_ledger`
+    returns: stats of each ledger and their totals
+    """
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(process_ledger, directory, pattern, **kwargs) for directory in directories]
+        ledgers = [future.result() for future in futures]
+    for stats in ledgers:
+        latency, rejected = stats.pop('process_stats')
+        with process_stats.lock:
+            for typ, histogram in latency.items():
+                process_stats.latency.setdefault(typ, LatencyHistogram()).merge(histogram)
+            for typ, count in rejected.items():
+                process_stats.rejected[typ] += count
+    totals = {key: sum(stats.get(key, 0) for stats in ledgers)
+              for key in ('files', 'rows', 'applied', 'rejected', 'clients')}
+    totals.update(ledgers=len(ledgers), failed=sum('error' in stats for stats in ledgers),
+                  seconds=round(time.perf_counter() - start, 6))
+    return dict(totals=totals, ledgers=ledgers)
+
+
 if __name__ == "__main__":
+    # run as a script: the modules next to this one import it as `main.payment_gateway` and get this module
+    # rather than a second copy with its own ledger state
+    sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+    sys.modules.setdefault('main.payment_gateway', sys.modules[__name__])
+    from main.chain import LedgerChain, chain_key, chain_path
+    from main.checkpoints import Checkpoints
+    from main.client_index import ClientIndex
+    from main.history import DepositHistory
+    from main.replica import ChangeFeed, Replica
+    from main.stream import stream
+
+    if '--stats' in sys.argv:
+        # latency percentiles, rows/sec and rejection rates on stderr at exit
+        sys.argv.remove('--stats')
+        atexit.register(lambda: pprint.pprint(process_stats.report(), stream=sys.stderr, sort_dicts=False))
+    if os.getenv('STATS_JSON'):
+        # STATS_JSON=path dumps the same report as JSON every STATS_INTERVAL seconds (default 10) and at exit
+        process_stats.dump_every(os.getenv('STATS_JSON'), float(os.getenv('STATS_INTERVAL') or 10))
+        atexit.register(process_stats.dump, os.getenv('STATS_JSON'))
+
     if len(sys.argv) < 2:
         sys.exit(0)
 
-    if len(sys.argv) == 2:
-        if not pathlib.Path(sys.argv[1]).exists():
-            tx_path = pathlib.Path(sys.argv[0]).parent.parent / "assets" / sys.argv[1]
-        else:
-            tx_path = sys.argv[1]
-    else:
+    if sys.argv[1] == '--compact':
+        # offline compaction of the transaction history
+        tx_path = sys.argv[2] if len(sys.argv) > 2 else pathlib.Path.cwd() / "transactions.csv"
+        pprint.pprint(compact_transactions(tx_path))
         sys.exit(0)
-    if not pathlib.Path(tx_path).exists():
-        raise FileNotFoundError(tx_path)
 
-    # read 20MB  chunks
-    data_dict = []
+    if sys.argv[1] in ('--seal', '--verify'):
+        # hash chain of the tx log: seal the rows appended since the last seal, or verify the segments sealed since
+        # the last verify (`--verify --full`: all of them in WORKERS processes)
+        ledger = PaymentManager()
+        # CHAIN_KEY=path of an HMAC key kept outside the ledger directory
+        chain = LedgerChain(ledger.transaction_csv, ledger.client_csv, int(os.getenv('SEGMENT_ROWS') or 4096),
+                            key=chain_key(os.getenv('CHAIN_KEY'), ledger.transaction_csv))
+        if sys.argv[1] == '--seal':
+            pprint.pprint(chain.seal(), sort_dicts=False)
+            sys.exit(0)
+        result = chain.verify(full='--full' in sys.argv[2:], workers=int(os.getenv('WORKERS') or 0) or None)
+        pprint.pprint(result, sort_dicts=False)
+        sys.exit(0 if result['ok'] else 1)
+
+    if sys.argv[1] == '--as-of':
+        # balance of a client as of the N-th row of the tx log, from the nearest checkpoint
+        ledger = PaymentManager()
+        with Checkpoints.load(ledger.transaction_csv, int(os.getenv('CHECKPOINTS') or 1000)) as checkpoints:
+            rec = checkpoints.as_of(sys.argv[2], int(sys.argv[3]))
+        writer = csv.DictWriter(sys.stdout, fieldnames=PaymentManager.COLS['client']['fields'])
+        writer.writeheader()
+        if rec:
+            writer.writerow(rec)
+        sys.exit(0 if rec else 1)
+
+    if sys.argv[1] == '--transactions':
+        # one page of a client's transactions from the client index: CLIENT [OFFSET [LIMIT]]
+        ledger = PaymentManager()
+        with ClientIndex.load(ledger.transaction_csv) as client_index:
+            ledger.client_index = client_index
+            page = ledger.get_history(sys.argv[2], *[int(a) for a in sys.argv[3:5]])
+        writer = csv.DictWriter(sys.stdout, fieldnames=PaymentManager.COLS['tx']['fields'])
+        writer.writeheader()
+        writer.writerows(page['transactions'])
+        sys.stderr.write("{total} transactions, next page: {next}\n".format(**page))
+        sys.exit(0)
 
-    with open(tx_path, 'r', encoding='UTF-32', buffering=20000000) as csvfile:
-        print(','.join(PaymentManager.COLS['client']['fields']))
-        reader = csv.DictReader(csvfile, fieldnames=PaymentManager.COLS['tx']['fields'])
+    if sys.argv[1] in ('--replica', '--promote'):
+        # warm standby ledger in this directory following the change feed FEED of a primary (CHANGES=1 there),
+        # polled every REPLICA_INTERVAL seconds until `--promote` is run here, then a primary itself
+        ledger = PaymentManager()
+        if sys.argv[1] == '--promote':
+            Replica.request_promotion(ledger.transaction_csv)
+            sys.exit(0)
+        replica = Replica(sys.argv[2], ledger.client_csv, ledger.transaction_csv)
+        pprint.pprint(replica.follow(float(os.getenv('REPLICA_INTERVAL') or 1)), sort_dicts=False)
+        sys.exit(0)
 
-        # skip header
-        next(reader)
-        mgr = None
-        for row in reader:
-            #  process row by row
-            try:
-                mgr = process({k.strip(): str(v).strip().replace('None', '') for k, v in row.items()})
-            except PaymentError as err:
-                # print(err)
-                if os.getenv('DEBUG'):
-                    print(err)
+    if sys.argv[1] == '--report':
+        # per client aggregates, optionally for the given client ids only
+        PaymentManager().print_aggregates(*sys.argv[2:])
+        sys.exit(0)
+
+    if sys.argv[1] == '-' or pathlib.Path(sys.argv[1]).is_fifo():
+        # unbounded stream from stdin or a named pipe, committed every PREFETCH rows or COMMIT_INTERVAL seconds
+        if sys.argv[1] == '-':
+            f = io.TextIOWrapper(sys.stdin.buffer, encoding='UTF-32')
+        else:
+            f = open(sys.argv[1], 'r', encoding='UTF-32')
+        ledger = PaymentManager()
+        # HISTORY=N keeps the rows of the N most recent txs in memory and spills older ones to disk
+        history = DepositHistory.load(ledger.transaction_csv, int(os.getenv('HISTORY'))) \
+            if os.getenv('HISTORY') else None
+        # CHECKPOINTS=K journals every applied transaction for `--as-of` queries, with a checkpoint every K
+        checkpoints = Checkpoints.load(ledger.transaction_csv, int(os.getenv('CHECKPOINTS'))) \
+            if os.getenv('CHECKPOINTS') else None
+        # CLIENT_INDEX=1 keeps the client index of `--transactions` in step while processing
+        client_index = ClientIndex.load(ledger.transaction_csv) if os.getenv('CLIENT_INDEX') else None
+        # CHANGES=1 appends every applied transaction to the change feed replicas follow
+        changes = ChangeFeed.load(ledger.transaction_csv) if os.getenv('CHANGES') else None
+        with f:
+            stream(read_rows(f), window=int(os.getenv('PREFETCH') or 256),
+                   interval=float(os.getenv('COMMIT_INTERVAL') or 1), history=history, checkpoints=checkpoints,
+                   client_index=client_index, changes=changes, prevalidate=int(os.getenv('PREVALIDATE') or 0))
+        if changes is not None:
+            changes.close()
+        if chain_path(ledger.transaction_csv).exists():
+            # sealing is enabled by `--seal`, cover the rows of this run
+            LedgerChain(ledger.transaction_csv, ledger.client_csv,
+                        key=chain_key(os.getenv('CHAIN_KEY'), ledger.transaction_csv)).seal()
+        sys.exit(0)
+
+    if sys.argv[1] == '--parallel':
+        # independent ledger directories in WORKERS processes, their INPUT files applied in name order
+        pprint.pprint(process_ledgers(expand_globs(sys.argv[2:]), os.getenv('INPUT') or '*.csv',
+                                      int(os.getenv('WORKERS') or 0) or None,
+                                      window=int(os.getenv('PREFETCH') or 0),
+                                      partition=int(os.getenv('PARTITION') or 0),
+                                      horizon=int(os.getenv('HISTORY') or 0),
+                                      depth=int(os.getenv('PIPELINE') or 0)), sort_dicts=False)
+        sys.exit(0)
 
-            # write to stdout
-            # if mgr.clients:
-            #    mgr.print_clients()
-            # print client_accounts to stdout
-        if mgr:
-            mgr.print_clients()
+    # any number of input files or globs, applied in order to one ledger
+    tx_paths = input_paths(sys.argv[1:])
+
+    print(','.join(PaymentManager.COLS['client']['fields']))
+    ledger = PaymentManager()
+    # HISTORY=N keeps the rows of the N most recent txs in memory and spills older ones to disk
+    history = DepositHistory.load(ledger.transaction_csv, int(os.getenv('HISTORY'))) \
+        if os.getenv('HISTORY') else None
+    # CHECKPOINTS=K journals every applied transaction for `--as-of` queries, with a checkpoint every K
+    checkpoints = Checkpoints.load(ledger.transaction_csv, int(os.getenv('CHECKPOINTS'))) \
+        if os.getenv('CHECKPOINTS') else None
+    # CLIENT_INDEX=1 keeps the client index of `--transactions` in step while processing
+    client_index = ClientIndex.load(ledger.transaction_csv) if os.getenv('CLIENT_INDEX') else None
+    # CHANGES=1 appends every applied transaction to the change feed replicas follow
+    changes = ChangeFeed.load(ledger.transaction_csv) if os.getenv('CHANGES') else None
+    # PIPELINE=N overlaps parsing, applying and writing with N windows queued between the stages
+    stats = process_files(tx_paths, window=int(os.getenv('PREFETCH') or 0),
+                          partition=int(os.getenv('PARTITION') or 0), history=history,
+                          depth=int(os.getenv('PIPELINE') or 0), fingerprint=int(os.getenv('FINGERPRINT') or 0),
+                          prevalidate=int(os.getenv('PREVALIDATE') or 0), mapped=bool(os.getenv('MMAP_INPUT')),
+                          checkpoints=checkpoints, client_index=client_index, changes=changes)
+    if changes is not None:
+        changes.close()
+    if 'pipeline' in stats:
+        pprint.pprint(stats['pipeline'], stream=sys.stderr, sort_dicts=False)
+    if 'inputs' in stats:
+        # what FINGERPRINT=N skipped, per input file
+        pprint.pprint(dict(skipped=stats['skipped'], inputs=stats['inputs']), stream=sys.stderr, sort_dicts=False)
+    if 'invalid' in stats:
+        # rows PREVALIDATE=N rejected, per failed check
+        pprint.pprint(dict(invalid=dict(stats['invalid'])), stream=sys.stderr, sort_dicts=False)
+    if chain_path(ledger.transaction_csv).exists():
+        # sealing is enabled by `--seal`, cover the rows of this run
+        LedgerChain(ledger.transaction_csv, ledger.client_csv,
+                    key=chain_key(os.getenv('CHAIN_KEY'), ledger.transaction_csv)).seal()
+
+    # print client_accounts to stdout, also when no row was applied e.g. a re-sent file FINGERPRINT=N skipped
+    (stats['manager'] or PaymentManager(ledger.client_csv, ledger.transaction_csv)).print_clients()
@@ -0,0 +1,246 @@
+"""
+Pipelined processing
+
+Applies input rows in three overlapping stages connected by bounded queues: a thread parses the input ahead,
+rows are validated and applied in input order against a write-back buffer, and a second thread rewrites each file
+once per window while the next window is applied. Each stage reports the time it was busy and the time it
+stalled on its neighbours.
+
+$ PIPELINE=4 PREFETCH=256 python3 main/payment_gateway.py assets/tx1.csv
+"""
+import csv
+import itertools
+import os
+import pathlib
+import pprint
+import queue
+import threading
+import time
+
+from main.payment_gateway import PaymentError, PaymentManager, Prefetcher, process
+
+
+class PipelinedPrefetcher(Prefetcher):
+    """
+    Write-back buffer whose changes are written by a background persist stage.
+
+    `commit` hands the pending changes to the persist thread, which writes them in commit order while the next
+    window is applied. The buffer stays the authoritative view meanwhile: `load` only adds the records of new ids
+    to it (buffered lines are newer than any version of the files) and the file stamps are not checked, the persist
+    stage being the only writer. Once more than `limit` ids are buffered the written files are waited for and
+    the buffer is read afresh, which keeps lookups over the buffer cheap.
+
+    The lines a `changes` feed queued for a window are committed by the persist stage once the window is written,
+    a crash in between leaves the feed behind the files, never ahead.
+    """
+
+    def __init__(self, client_csv, transaction_csv, aggregate_csv=None, depth=2, limit=1024, changes=None):
+        super().__init__(client_csv, transaction_csv, aggregate_csv, write_back=True)
+        # (pending changes, line counts, feed lines) waiting to be written
+        self.outbox = queue.Queue(depth)
+        self.limit = limit
+        self.changes = changes
+        self.error = None
+        self.stats = dict(commits=0, busy=0.0, idle=0.0, blocked=0.0, drained=0.0)
+        self.thread = threading.Thread(target=self.persist, daemon=True)
+        self.thread.start()
+
+    def seen_stamp(self, index):
+        # the files are only written behind the buffer
+        return self.stamp[index]
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Persist stage failed: " + pprint.pformat(self.paths)) from self.error
+
+    def extend(self, index, keys):
+        fields = PaymentManager.COLS[index]['fields']
+        # read 20MB  chunks
+        with open(self.paths[index], 'r', encoding=PaymentManager.COLS[index]['encoding'],
+                  buffering=20000000) as f:
+            for n, line in enumerate(csv.DictReader(f, fieldnames=fields)):
+                if n in self.lines[index]:
+                    continue
+                rec = self.row(line, fields)
+                if any(k in rec[index] for k in keys):
+                    self.lines[index][n] = rec
+        self.keys[index] |= keys
+
+    def extend_aggregates(self, keys):
+        fields = PaymentManager.COLS['aggregate']['fields']
+        if keys and pathlib.Path(self.paths['aggregate']).exists():
+            # read 20MB  chunks
+            with open(self.paths['aggregate'], 'r', encoding=PaymentManager.COLS['aggregate']['encoding'],
+                      buffering=20000000) as f:
+                for line in csv.DictReader(f, fieldnames=fields):
+                    row = {k: '' if v is None else str(v).strip() for k, v in line.items()}
+                    if row['client'] in keys:
+                        self.aggregates[row['client']] = row
+        self.keys['aggregate'] |= keys
+
+    def load(self, rows) -> object:
+        """
+        Add the records referenced by `rows` to the buffer, read afresh if nothing is being written
+        """
+        self.check()
+        if not self.outbox.unfinished_tasks or sum(map(len, self.keys.values())) > self.limit:
+            self.drain()
+            return super().load(rows)
+
+        self.extend('tx', {str(r.get('tx') or '').strip() for r in rows} - {''} - self.keys['tx'])
+        owners = {rec['client'] for rec in self.lines['tx'].values()}
+        clients = ({str(r.get('client') or '').strip() for r in rows} | owners) - {''} - self.keys['client']
+        self.extend('client', clients)
+        self.extend_aggregates(clients)
+        return self
+
+    def commit(self):
+        """
+        Hand the pending changes to the persist stage, blocks while `depth` commits are waiting
+        """
+        self.check()
+        lines = self.changes.take() if self.changes is not None else []
+        if not any(self.pending.values()) and not lines:
+            return
+        changes = self.pending, dict(self.count), lines
+        self.pending = {'client': {}, 'tx': {}, 'aggregate': {}}
+        start = time.perf_counter()
+        self.outbox.put(changes)
+        self.stats['blocked'] += time.perf_counter() - start
+        self.stats['commits'] += 1
+
+    def drain(self):
+        """
+        Wait until every commit is written
+        """
+        start = time.perf_counter()
+        self.outbox.join()
+        self.stats['drained'] += time.perf_counter() - start
+        self.check()
+
+    def flush(self):
+        self.commit()
+        self.drain()
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception:
+            # the rows of lines still queued were not written
+            if self.changes is not None:
+                self.changes.take()
+            raise
+        finally:
+            self.outbox.put(None)
+            self.thread.join()
+
+    def persist(self):
+        while True:
+            start = time.perf_counter()
+            changes = self.outbox.get()
+            self.stats['idle'] += time.perf_counter() - start
+            if changes is None:
+                self.outbox.task_done()
+                return
+            start = time.perf_counter()
+            try:
+                # later commits build on this one, stop writing after a failure
+                if self.error is None:
+                    pending, count, lines = changes
+                    self.write(pending, count)
+                    if lines:
+                        self.changes.commit(lines)
+            except Exception as err:
+                self.error = err
+            finally:
+                self.stats['busy'] += time.perf_counter() - start
+                self.outbox.task_done()
+
+
+def pipeline(rows, window=256, depth=4, persist_depth=2, limit=None, **kwargs) -> dict:
+    """
+    Apply rows in three overlapping stages connected by bounded queues:
+
+    - parse: a thread reads and parses `rows` into windows of `window` rows, up to `depth` windows ahead
+    - apply: `validate()` and the action of every row in input order, so each client's rows keep their order,
+      against a write-back buffer of the window's records
+    - persist: a thread rewrites each file once per window, up to `persist_depth` windows behind
+
+    Reading the input, computing and writing the files overlap. Each stage reports the time it was busy and the
+    time it stalled waiting for the stage before (starved/idle) or for the stage after (blocked).
+    kwargs: ledger paths (and history) as for `PaymentManager`
+    returns: stats and the stall report
+    """
+    ledger = PaymentManager(**kwargs)
+    paths = dict(kwargs, client_csv=ledger.client_csv, transaction_csv=ledger.transaction_csv)
+    prefetch = PipelinedPrefetcher(ledger.client_csv, ledger.transaction_csv, kwargs.get('aggregate_csv'),
+                                   depth=persist_depth, limit=limit or 4 * window, changes=kwargs.get('changes'))
+    # saves keep the bitset current, the persist stage rewrites the file behind them
+    locked = ledger.locked.pin()
+    parsed = queue.Queue(depth)
+    stop = threading.Event()
+    stalls = dict(parse=dict(busy=0.0, blocked=0.0), apply=dict(busy=0.0, starved=0.0, blocked=0.0))
+    stats = dict(rows=0, windows=0)
+
+    def parse():
+        try:
+            it = iter(rows)
+            while not stop.is_set():
+                start = time.perf_counter()
+                batch = list(itertools.islice(it, window))
+                stalls['parse']['busy'] += time.perf_counter() - start
+                start = time.perf_counter()
+                parsed.put(('rows', batch) if batch else ('end', None))
+                stalls['parse']['blocked'] += time.perf_counter() - start
+                if not batch:
+                    return
+        except Exception as err:
+            parsed.put(('error', err))
+
+    started = time.perf_counter()
+    thread = threading.Thread(target=parse, daemon=True)
+    thread.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            kind, batch = parsed.get()
+            stalls['apply']['starved'] += time.perf_counter() - start
+            if kind == 'end':
+                break
+            if kind == 'error':
+                raise batch
+
+            start, drained = time.perf_counter(), prefetch.stats['drained']
+            prefetch.load(batch)
+            for row in batch:
+                try:
+                    process(row, prefetch=prefetch, **paths)
+                except PaymentError as err:
+                    if os.getenv('DEBUG'):
+                        print(err)
+            waited = prefetch.stats['drained'] - drained
+            stalls['apply']['busy'] += time.perf_counter() - start - waited
+            stalls['apply']['blocked'] += waited
+            stats['rows'] += len(batch)
+            stats['windows'] += 1
+
+            start = time.perf_counter()
+            prefetch.commit()
+            stalls['apply']['blocked'] += time.perf_counter() - start
+    finally:
+        stop.set()
+        # make room for a parser blocked on the queue, it stops after that
+        while not parsed.empty():
+            parsed.get_nowait()
+        try:
+            start = time.perf_counter()
+            prefetch.close()
+            stalls['apply']['blocked'] += time.perf_counter() - start
+        finally:
+            locked.unpin(ledger.client_csv)
+
+    stalls['persist'] = dict(busy=prefetch.stats['busy'], idle=prefetch.stats['idle'])
+    stats.update(seconds=round(time.perf_counter() - started, 6), commits=prefetch.stats['commits'],
+                 bottleneck=max(stalls, key=lambda stage: stalls[stage]['busy']),
+                 stalls={stage: {k: round(v, 6) for k, v in times.items()} for stage, times in stalls.items()})
+    return stats
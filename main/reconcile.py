@@ -0,0 +1,143 @@
+"""
+Balance reconciliation
+
+Nightly audit that `client_accounts.csv` agrees with `transactions.csv`. The transaction log is loaded into
+NumPy columns (client, type, tx, amount) and the balances are recomputed with grouped, vectorized reductions
+instead of replaying every row through `PaymentManager`:
+
+- deposit:    available += amount, total += amount
+- withdrawal: available -= amount, total -= amount
+- dispute:    held += disputed, available -= disputed
+- resolve:    held -= disputed, available += disputed
+- chargeback: available -= disputed, total -= disputed, account locked
+
+The log only holds applied rows. The disputed amount of a tx is the amount of its first row with an amount
+(`get_disputed_amount` rejects a dispute once a tx has more than one). Amounts are summed as fixed-point
+integers so the result is exact; amounts with more than `MAX_SCALE` decimal places or balances out
+of the int64 range raise `ValueError`. Ids are matched exactly, as they are when all ids have the same width,
+and the ledger is assumed to have started empty.
+
+$ python3 -m main.reconcile [--client-csv client_accounts.csv] [--transaction-csv transactions.csv]
+"""
+import argparse
+import csv
+import sys
+import time
+
+import numpy as np
+
+from main.columnar import MAX_SCALE, decimals, fixed_point, load_columns
+from main.payment_gateway import PaymentManager
+
+BALANCES = ['held', 'available', 'total']
+
+
+def expected_balances(tx, scale) -> dict:
+    """
+    Balances implied by the transaction log columns
+    returns: clients (sorted ids) and their held, available, total (fixed point) and locked columns
+    """
+    clients, owner = np.unique(tx['client'], return_inverse=True)
+    amount = fixed_point(tx['amount'], scale)
+    typ = tx['type']
+
+    # disputed amount of every tx: the amount of its first row with an amount
+    txs, tx_code = np.unique(tx['tx'], return_inverse=True)
+    with_amount = np.flatnonzero(amount != 0)
+    codes, first = np.unique(tx_code[with_amount], return_index=True)
+    disputed = np.zeros(len(txs), dtype=np.int64)
+    disputed[codes] = amount[with_amount[first]]
+    disputed = disputed[tx_code]
+    # no running balance of a client exceeds the sum of its |delta|, int64 sums would wrap silently
+    reach = np.zeros(len(clients))
+    np.add.at(reach, owner, np.maximum(np.abs(amount), np.abs(disputed)).astype(float))
+    if len(reach) and reach.max() >= 2 ** 62:
+        raise ValueError("Balances out of the int64 range at scale {}".format(scale))
+
+    deposit, withdrawal = typ == 'deposit', typ == 'withdrawal'
+    dispute, resolve, chargeback = typ == 'dispute', typ == 'resolve', typ == 'chargeback'
+    moved = np.where(deposit, amount, 0) - np.where(withdrawal, amount, 0)
+    held = np.where(dispute, disputed, 0) - np.where(resolve, disputed, 0)
+    available = moved - held - np.where(chargeback, disputed, 0)
+    total = moved - np.where(chargeback, disputed, 0)
+
+    balances = dict(client=clients, locked=np.zeros(len(clients), dtype=bool))
+    for name, delta in (('held', held), ('available', available), ('total', total)):
+        balances[name] = np.zeros(len(clients), dtype=np.int64)
+        np.add.at(balances[name], owner, delta)
+    balances['locked'][owner[chargeback]] = True
+    return balances
+
+
+def reconcile(client_csv, transaction_csv) -> dict:
+    """
+    Recompute the balances from `transaction_csv` and compare them with `client_csv`
+    returns: stats and the mismatched clients with their recorded and expected balances
+    """
+    start = time.perf_counter()
+    tx = load_columns(transaction_csv, 'tx')
+    accounts = load_columns(client_csv, 'client')
+    scale = max([decimals(tx['amount'])] + [decimals(accounts[f]) for f in BALANCES])
+    if scale > MAX_SCALE:
+        raise ValueError("Amounts with more than {} decimal places".format(MAX_SCALE))
+
+    expected = expected_balances(tx, scale)
+    # one record per client, the first as `get_record` would find it
+    ids, first = np.unique(accounts['client'], return_index=True)
+    recorded = {f: fixed_point(accounts[f][first], scale) for f in BALANCES}
+    recorded['locked'] = accounts['locked'][first] == 'True'
+
+    # align both sides on the union of client ids, clients missing on one side are all zero and unlocked
+    clients = np.union1d(ids, expected['client'])
+    rec_at = np.searchsorted(ids, clients)
+    exp_at = np.searchsorted(expected['client'], clients)
+    in_rec = np.isin(clients, ids)
+    in_exp = np.isin(clients, expected['client'])
+
+    mismatched = np.zeros(len(clients), dtype=bool)
+    sides = {}
+    for f in BALANCES + ['locked']:
+        dtype = bool if f == 'locked' else np.int64
+        got = np.zeros(len(clients), dtype=dtype)
+        want = np.zeros(len(clients), dtype=dtype)
+        got[in_rec] = recorded[f][rec_at[in_rec]]
+        want[in_exp] = expected[f][exp_at[in_exp]]
+        mismatched |= got != want
+        sides[f] = got, want
+
+    def amount(value):
+        text = str(abs(int(value))).rjust(scale + 1, '0')
+        text = text[:-scale] + '.' + text[-scale:] if scale else text
+        return ('-' if value < 0 else '') + text
+
+    report = []
+    for i in np.flatnonzero(mismatched):
+        rec = dict(client=str(clients[i]), missing=not in_rec[i])
+        for f in BALANCES:
+            rec[f], rec['expected_' + f] = amount(sides[f][0][i]), amount(sides[f][1][i])
+        rec['locked'], rec['expected_locked'] = bool(sides['locked'][0][i]), bool(sides['locked'][1][i])
+        report.append(rec)
+
+    return dict(rows=len(tx['tx']), clients=len(clients), mismatched=report,
+                seconds=round(time.perf_counter() - start, 6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--client-csv', help="default: ./client_accounts.csv")
+    parser.add_argument('--transaction-csv', help="default: ./transactions.csv")
+    args = parser.parse_args(argv)
+
+    ledger = PaymentManager(args.client_csv, args.transaction_csv)
+    result = reconcile(ledger.client_csv, ledger.transaction_csv)
+    fields = ['client', 'missing'] + [p + f for f in BALANCES + ['locked'] for p in ('', 'expected_')]
+    writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(result['mismatched'])
+    sys.stderr.write("{rows} rows, {clients} clients, {} mismatched in {seconds}s\n".format(
+        len(result['mismatched']), **result))
+    return 1 if result['mismatched'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+Change feed and warm standby
+
+Appends every accepted operation to an ordered feed of the ledger, and follows the feed of a primary in a standby
+ledger that applies the changes in order and can be promoted to a primary itself.
+
+$ CHANGES=1 python3 main/payment_gateway.py assets/tx1.csv
+$ python3 main/payment_gateway.py --replica /mnt/primary/transactions.csv.changes
+"""
+import csv
+import io
+import json
+import os
+import pathlib
+import shutil
+import time
+from tempfile import NamedTemporaryFile
+
+from main.payment_gateway import ClientSnapshots, PaymentManager, append_transaction_rows, applied_record, \
+    count_rows, replace_client_rows
+
+
+def changes_path(transaction_csv) -> pathlib.Path:
+    """
+    Default directory of the change feed e.g. `transactions.csv.changes/`
+    """
+    path = pathlib.Path(transaction_csv)
+    return path.with_name(path.name + '.changes')
+
+
+class ChangeFeed:
+    """
+    Ordered feed of the accepted operations for consumers tailing the ledger, e.g. a warm standby (`Replica`).
+
+    Every accepted operation appends one line to `<transactions>.changes/feed.csv`: its position in the tx log, the
+    tx row and the client record it left behind (held, available, total, locked). Lines are written whole and
+    flushed on `commit`, a consumer reads up to the last line ending in a newline. With a write-back buffer the
+    manager leaves the commit to the writer of the buffer (`stream` after each flush, the persist stage of
+    `pipeline` after it wrote each window), so a stream's feed does not run ahead of its files.
+
+    New lines continue at the position of the tx log, the feed is never rebuilt: when it is enabled on an existing
+    ledger or misses rows its positions jump and replicas refuse the gap until they are seeded with a copy of the
+    ledger.
+    """
+    FIELDS = ['position'] + ["type", "client", "tx", "amount"] + ["held", "available", "total", "locked"]
+
+    def __init__(self, path, position=0):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.feed = open(self.path / 'feed.csv', 'a+b')
+        self.position = position
+        self.pending = []  # lines not committed yet
+
+    @classmethod
+    def load(cls, transaction_csv, path=None) -> object:
+        """
+        Open the change feed of `transactions.csv`, new lines continue at the number of rows of the tx log
+        """
+        feed = cls(path or changes_path(transaction_csv), count_rows(transaction_csv, 'tx'))
+        last = feed.last()
+        if last > feed.position:
+            feed.close()
+            raise ValueError("Change feed is ahead of the tx log ({} > {} rows): {}".format(
+                last, feed.position, feed.path))
+        return feed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.commit()
+        self.feed.close()
+
+    def last(self) -> int:
+        """
+        returns: position of the last line, a line torn by a crash is cut off
+        """
+        size = self.feed.seek(0, os.SEEK_END)
+        start, tail = size, b''
+        while start and tail.count(b'\n') < 2:
+            start = max(0, start - 4096)
+            self.feed.seek(start)
+            tail = self.feed.read(size - start)
+        end = tail.rfind(b'\n') + 1
+        if start + end < size:
+            self.feed.truncate(start + end)
+        lines = tail[:end].splitlines()
+        return int(lines[-1].split(b',', 1)[0]) if lines else 0
+
+    def record(self, tx, clients):
+        """
+        Queue the line of an applied transaction
+        clients: the records the transaction saved, as in `PaymentManager.clients`
+        """
+        rec = applied_record(tx, clients)
+        if rec is None:
+            return
+        self.position += 1
+        line = io.StringIO()
+        entry = dict({f: rec[f] for f in self.FIELDS[5:]}, position=self.position)
+        entry.update({f: tx.get(f) for f in PaymentManager.COLS['tx']['fields']})
+        csv.DictWriter(line, fieldnames=self.FIELDS).writerow(entry)
+        self.pending.append(line.getvalue())
+
+    def take(self) -> list:
+        """
+        Remove the queued lines, e.g. to commit them once the files holding their rows are written
+        """
+        lines, self.pending = self.pending, []
+        return lines
+
+    def rollback(self, transaction_csv):
+        """
+        Drop the queued lines of rows that were not persisted, new lines continue at the rows of the tx log
+        """
+        self.take()
+        self.position = count_rows(transaction_csv, 'tx')
+
+    def commit(self, lines=None):
+        """
+        Append the queued lines, or `lines` taken before, with one write
+        """
+        lines = self.take() if lines is None else lines
+        if not lines:
+            return
+        self.feed.seek(0, os.SEEK_END)
+        self.feed.write(''.join(lines).encode())
+        self.feed.flush()
+
+    @classmethod
+    def read(cls, path, offset=0, limit=None):
+        """
+        Lines of the feed file `path` after byte `offset`, up to the last complete one
+        returns: (line, byte offset after it) pairs
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for n, line in enumerate(f):
+                if not line.endswith(b'\n') or n == limit:
+                    # being written
+                    return
+                offset += len(line)
+                yield dict(zip(cls.FIELDS, next(csv.reader([line.decode()])))), offset
+
+
+def replica_path(transaction_csv) -> pathlib.Path:
+    """
+    Default directory of the replica state e.g. `transactions.csv.replica/`
+    """
+    path = pathlib.Path(transaction_csv)
+    return path.with_name(path.name + '.replica')
+
+
+class Replica:
+    """
+    Warm standby ledger kept current from the change feed of a primary.
+
+    The replica is a ledger of its own (`client_accounts.csv`, `transactions.csv`). `apply` reads the feed lines
+    after the last one it applied (byte offset in `<transactions>.replica/state.json`) and writes each file once:
+    the client records the lines left behind, then their tx rows. A line applies at the next row of the replica's
+    tx log: lines it already has are skipped, so an interrupted apply or a feed replaced by the one of a promoted
+    peer continues where the tx log ends, and a gap raises ValueError.
+
+    Promotion is requested with a `promote` file in the state directory (`request_promotion`, e.g. from another
+    process): the follower applies what is left of the feed and stops, the replica is a primary from then on.
+    Aggregates are not in the feed, a promoted replica opens them at the client balances.
+    """
+
+    def __init__(self, feed, client_csv, transaction_csv, path=None):
+        # the feed file or its directory, which need not exist yet
+        self.feed = pathlib.Path(feed)
+        if self.feed.suffix != '.csv':
+            self.feed = self.feed / 'feed.csv'
+        self.client_csv = client_csv
+        self.transaction_csv = transaction_csv
+        self.path = pathlib.Path(path or replica_path(transaction_csv))
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.state = dict(feed=str(self.feed.resolve()), offset=0, promoted=False)
+        if (self.path / 'state.json').exists():
+            with open(self.path / 'state.json') as f:
+                state = json.load(f)
+            if state['feed'] == self.state['feed'] or state['promoted']:
+                self.state = state
+        self.position = count_rows(transaction_csv, 'tx')
+
+    @classmethod
+    def request_promotion(cls, transaction_csv, path=None):
+        (pathlib.Path(path or replica_path(transaction_csv)) / 'promote').touch()
+
+    @property
+    def promotion_requested(self) -> bool:
+        return (self.path / 'promote').exists()
+
+    def save(self):
+        # tmp file next to the state so the move is an atomic rename
+        temp_path = NamedTemporaryFile(mode='w', delete=False, dir=self.path, suffix='.tmp')
+        with open(temp_path.name, 'w') as f:
+            json.dump(self.state, f)
+        shutil.move(temp_path.name, self.path / 'state.json')
+
+    def apply(self, limit=100000) -> int:
+        """
+        Apply up to `limit` complete feed lines after the last applied one
+        returns: the number of lines applied
+        """
+        if self.state['promoted']:
+            raise ValueError("Replica was promoted: {}".format(self.path))
+        if not self.feed.exists():
+            return 0
+        offset = self.state['offset']
+        if offset > self.feed.stat().st_size:
+            # another feed in its place, the positions tell what is new
+            offset = 0
+        clients, rows, gap = {}, [], None
+        for entry, end in ChangeFeed.read(self.feed, offset, limit):
+            position = int(entry['position'])
+            if position > self.position + len(rows) + 1:
+                gap = position
+                break
+            offset = end
+            if position <= self.position + len(rows):
+                # applied before
+                continue
+            rows.append({f: entry[f] for f in PaymentManager.COLS['tx']['fields']})
+            cid = entry['client'].strip()
+            clients[cid] = dict({f: entry[f] for f in ChangeFeed.FIELDS[5:]}, client=cid)
+
+        if rows:
+            # client records first: they are the state after the line, applying them again changes nothing
+            fields = PaymentManager.COLS['client']['fields']
+            encoding = PaymentManager.COLS['client']['encoding']
+            temp_path = NamedTemporaryFile(mode='w', delete=False, dir=pathlib.Path(self.client_csv).parent)
+            with open(self.client_csv, 'r', encoding=encoding, buffering=20000000) as csvfile, \
+                    open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
+                writer = csv.DictWriter(csvtempfile, fieldnames=fields)
+                writer.writerows(replace_client_rows(csv.DictReader(csvfile, fieldnames=fields), clients))
+            shutil.move(temp_path.name, self.client_csv)
+            # publish a new generation for snapshot readers of the replica
+            snapshots = ClientSnapshots(self.client_csv, encoding=encoding)
+            if snapshots.enabled:
+                snapshots.publish()
+            append_transaction_rows(self.transaction_csv, rows)
+            self.position += len(rows)
+        self.state['offset'] = offset
+        self.save()
+        if gap is not None:
+            raise ValueError("Change feed gap: replica at row {}, next line at {}, seed it with a copy of the "
+                             "ledger: {}".format(self.position, gap, self.feed))
+        return len(rows)
+
+    def promote(self) -> dict:
+        """
+        Apply the rest of the feed and stop following it
+        returns: the replica state
+        """
+        while self.apply():
+            pass
+        self.state['promoted'] = True
+        self.save()
+        if self.promotion_requested:
+            (self.path / 'promote').unlink()
+        return dict(self.state, rows=self.position)
+
+    def follow(self, interval=1.0) -> dict:
+        """
+        Apply the feed as it grows, polling every `interval` seconds, until promotion is requested
+        returns: the replica state after promotion
+        """
+        while not self.promotion_requested:
+            if not self.apply():
+                time.sleep(interval)
+        return self.promote()
+
@@ -0,0 +1,330 @@
+"""
+Ingestion server
+
+Accepts newline delimited transaction rows from many concurrent connections over a local
+unix or TCP socket and applies them to the ledger through `process()`.
+
+A line is a CSV row (`type,client,tx,amount`) or a JSON object with the same keys, `balance <client>`
+(or `{"balance": "<client>"}`) queries a client record. Blank and header lines are skipped, any other line gets
+one reply line in its own format: `accepted`, `rejected` with the error's class name, or the client record.
+
+Rows of all connections are applied one at a time in arrival order by a single writer thread, which keeps
+the order of each client's rows. The writer takes up to `batch` queued lines at a time, buffers their records
+with one pass over each store (`Prefetcher`), applies them with saves going to the write-back buffer and
+rewrites each file once before replying. The queue is bounded: while it is full connections are not read,
+which pushes back on senders through the socket. A batch that cannot be persisted is rejected as a whole and the
+state derived from its rows (locked bitset, tx history, client index, checkpoints, change feed) is read again
+from the files.
+
+$ python3 -m main.server --unix /tmp/ledger.sock
+$ python3 -m main.server --tcp 127.0.0.1:8700 --batch 256 --queue 1024
+"""
+import argparse
+import asyncio
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from main.payment_gateway import PaymentManager, Prefetcher, process
+
+FIELDS = PaymentManager.COLS['tx']['fields']
+
+
+def parse_line(line) -> tuple:
+    """
+    returns: (kind, payload, format) kind is `row`, `balance` or `error`, None for blank and header lines
+    """
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        try:
+            obj = json.loads(line)
+            if not isinstance(obj, dict):
+                raise ValueError("Expected a JSON object: " + line)
+        except ValueError as err:
+            return 'error', err, 'json'
+        if 'balance' in obj:
+            return 'balance', str(obj['balance']).strip(), 'json'
+        return 'row', {f: '' if obj.get(f) is None else str(obj.get(f)).strip() for f in FIELDS}, 'json'
+
+    values = [v.strip() for v in next(csv.reader([line]))]
+    if values == FIELDS:
+        return None
+    if values[0] == 'balance' or values[0].startswith('balance '):
+        cid = values[1] if len(values) > 1 else values[0][len('balance'):]
+        return 'balance', cid.strip(), 'csv'
+    # missing trailing fields are empty e.g. the amount of a dispute
+    return 'row', dict(zip(FIELDS, values + [''] * (len(FIELDS) - len(values)))), 'csv'
+
+
+def format_reply(reply, fmt) -> bytes:
+    if fmt == 'json':
+        return (json.dumps(reply) + '\n').encode()
+    if reply['status'] == 'balance':
+        fields = ['status'] + PaymentManager.COLS['client']['fields']
+    else:
+        fields = ['status', 'type', 'client', 'tx', 'error']
+    return (','.join(str(reply.get(f, '')) for f in fields) + '\n').encode()
+
+
+class IngestServer:
+    """
+    The ledger's single writer behind a bounded queue of parsed lines
+    """
+
+    def __init__(self, client_csv=None, transaction_csv=None, batch=256, queue=1024, **hooks):
+        """
+        hooks: optional `history`, `checkpoints`, `client_index` and `changes` as for `PaymentManager`
+        """
+        ledger = PaymentManager(client_csv, transaction_csv)
+        self.ledger = dict(hooks, client_csv=ledger.client_csv, transaction_csv=ledger.transaction_csv)
+        self.prefetch = Prefetcher(ledger.client_csv, ledger.transaction_csv, write_back=True)
+        self.batch = batch
+        self.depth = queue
+        self.queue = None
+        self.server = None
+        self.applier = None
+        self.connections = {}  # handler task -> (reader, writer)
+        self.closing = False
+        self.executor = ThreadPoolExecutor(1)
+        self.stats = dict(rows=0, accepted=0, rejected=0, queries=0, batches=0)
+
+    async def start(self, path=None, host=None, port=None) -> object:
+        self.queue = asyncio.Queue(self.depth)
+        self.applier = asyncio.ensure_future(self.apply_loop())
+        if path:
+            self.server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self, timeout=10):
+        """
+        Stop accepting and reading: the lines already received are applied and answered, then each connection is
+        closed. Connections that have not taken their replies after `timeout` seconds are aborted, losing them.
+        """
+        self.server.close()
+        self.closing = True
+        connections = dict(self.connections)
+        for reader, writer in connections.values():
+            # the handler sees the end of its stream after the lines already buffered
+            writer.transport.pause_reading()
+            reader.feed_eof()
+        if connections:
+            _, pending = await asyncio.wait(connections, timeout=timeout)
+            for task in pending:
+                connections[task][1].transport.abort()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self.server.wait_closed()
+        self.applier.cancel()
+        self.executor.shutdown()
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = reader, writer
+        # replies go out in the order of the connection's lines
+        replies = asyncio.Queue(self.depth)
+        sender = asyncio.ensure_future(self.send_replies(replies, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or (self.closing and not line.endswith(b'\n')):
+                    # a line cut off by `close` was never received in full
+                    break
+                item = parse_line(line.decode())
+                if item is None:
+                    continue
+                future = asyncio.get_running_loop().create_future()
+                await replies.put((future, item[2]))
+                # blocks while the writer is behind
+                await self.queue.put((item, future))
+            await replies.put(None)
+            await sender
+        except ConnectionError:
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            self.connections.pop(task, None)
+
+    @staticmethod
+    async def send_replies(replies, writer):
+        while True:
+            entry = await replies.get()
+            if entry is None:
+                break
+            future, fmt = entry
+            writer.write(format_reply(await future, fmt))
+            await writer.drain()
+
+    async def apply_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entries = [await self.queue.get()]
+            while len(entries) < self.batch and not self.queue.empty():
+                entries.append(self.queue.get_nowait())
+            replies = await loop.run_in_executor(self.executor, self.apply, [item for item, _ in entries])
+            for (_, future), reply in zip(entries, replies):
+                if not future.cancelled():
+                    future.set_result(reply)
+
+    def apply(self, items) -> list:
+        """
+        Apply a batch of parsed lines in order and persist them with one rewrite per file
+        returns: one reply per line
+        """
+        rows = [payload for kind, payload, _ in items if kind == 'row']
+        queried = [dict(client=payload) for kind, payload, _ in items if kind == 'balance']
+        try:
+            self.prefetch.load(rows + queried)
+            replies = [self.apply_item(kind, payload) for kind, payload, _ in items]
+            self.prefetch.flush()
+            if self.ledger.get('changes') is not None:
+                self.ledger['changes'].commit()
+        except Exception as err:
+            # the batch could not be applied or persisted as a whole
+            self.prefetch.discard()
+            self.reload()
+            replies = [dict(status='rejected', error=type(err).__name__, message=str(err)) for _ in items]
+        self.stats['batches'] += 1
+        return replies
+
+    def reload(self):
+        """
+        Drop the state derived from the rows of a batch that was not persisted
+        """
+        transaction_csv = self.ledger['transaction_csv']
+        # the bitset took the saves of the batch, read it again from `client_accounts.csv`
+        PaymentManager(**self.ledger).locked.stamp = None
+        history = self.ledger.get('history')
+        if history is not None:
+            history.close()
+            self.ledger['history'] = type(history).load(transaction_csv, history.horizon, history.path)
+        if self.ledger.get('client_index') is not None:
+            self.ledger['client_index'].rebuild(transaction_csv)
+        if self.ledger.get('checkpoints') is not None:
+            self.ledger['checkpoints'].replay(transaction_csv)
+        if self.ledger.get('changes') is not None:
+            self.ledger['changes'].rollback(transaction_csv)
+
+    def apply_item(self, kind, payload) -> dict:
+        if kind == 'error':
+            self.stats['rejected'] += 1
+            return dict(status='rejected', error=type(payload).__name__, message=str(payload))
+        if kind == 'balance':
+            self.stats['queries'] += 1
+            return self.balance(payload)
+
+        self.stats['rows'] += 1
+        reply = dict(status='accepted', type=payload['type'], client=payload['client'], tx=payload['tx'])
+        try:
+            result = process(dict(payload), prefetch=self.prefetch, **self.ledger)
+            err = result[1] if isinstance(result, tuple) else None
+        except OSError:
+            # a save failed part way through the row, the batch is not persisted
+            raise
+        except Exception as exc:
+            # e.g. ValueError for invalid ids
+            err = exc
+        if err is not None:
+            reply.update(status='rejected', error=type(err).__name__, message=str(err))
+            self.stats['rejected'] += 1
+        else:
+            self.stats['accepted'] += 1
+        return reply
+
+    def balance(self, cid) -> dict:
+        records = PaymentManager(prefetch=self.prefetch, **self.ledger).get_record('client', True, cid)
+        for rec in records.get(cid, []):
+            if rec['client'] == cid:
+                return dict(status='balance', **rec)
+        return dict(status='rejected', type='balance', client=cid, error='ClientNotFound')
+
+
+class LedgerClient:
+    """
+    Local client standing in for the upstream: sends lines and collects their replies
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, path=None, host=None, port=None) -> object:
+        if path:
+            return cls(*await asyncio.open_unix_connection(path))
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def send(self, *rows) -> list:
+        """
+        rows: dicts are sent as JSON, strings as they are (CSV or a `balance` query)
+        returns: the reply of each row, JSON replies as dicts and CSV replies as lists
+        """
+        lines = [(json.dumps(r) if isinstance(r, dict) else r).strip() + '\n' for r in rows]
+        # blank and header lines get no reply
+        lines = [line for line in lines if parse_line(line) is not None]
+
+        async def write():
+            for line in lines:
+                self.writer.write(line.encode())
+                await self.writer.drain()
+
+        # replies are read while writing so a full server queue cannot deadlock the sender
+        writing = asyncio.ensure_future(write())
+        replies = []
+        for _ in lines:
+            line = (await self.reader.readline()).decode().strip()
+            replies.append(json.loads(line) if line.startswith('{') else next(csv.reader([line])))
+        await writing
+        return replies
+
+    async def balance(self, cid):
+        return (await self.send(json.dumps(dict(balance=cid))))[0]
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def serve(args):
+    server = IngestServer(args.client_csv, args.transaction_csv, batch=args.batch, queue=args.queue)
+    if args.unix:
+        await server.start(path=args.unix)
+    else:
+        host, port = args.tcp.rsplit(':', 1)
+        await server.start(host=host, port=int(port))
+    print("listening on", server.address, flush=True)
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--unix', help="unix socket path")
+    address.add_argument('--tcp', help="host:port")
+    parser.add_argument('--client-csv', help="default: ./client_accounts.csv")
+    parser.add_argument('--transaction-csv', help="default: ./transactions.csv")
+    parser.add_argument('--batch', type=int, default=256, help="lines applied and persisted together")
+    parser.add_argument('--queue', type=int, default=1024, help="queued lines before connections are paused")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
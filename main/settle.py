@@ -0,0 +1,361 @@
+"""
+Batched deposit/withdrawal settlement
+
+Settles runs of deposits and withdrawals together instead of one `process()` call per row:
+
+- one pass over each file looks up the clients, txs and aggregates of a run
+- rows are rejected in the order `validate` checks them: locked account, amount not above 0, same operation
+  for the tx id, withdrawal for a client that does not exist (yet)
+- the running available balance of every client over the run is a grouped NumPy cumulative sum of fixed-point
+  amounts; the first withdrawal of every client that it does not cover is rejected and the rest of the client's
+  rows settled again without it until every withdrawal is covered, so each insufficient funds point is the one
+  the row by row rules find
+- the client accounts, the transaction log and the aggregates are written once per run, then the applied rows
+  go to the tx history, client index, checkpoints and change feed of the ledger in order, as after `process()`
+
+Other rows (disputes, resolves, chargebacks, deposits without a client, amounts that are not plain decimals)
+go through `process()` in their place. Decisions and files are the same as row by row as long as all ids have
+the same width. Requires `numpy`.
+
+With `--mapped` the inputs are read by `MappedInput` (`settle_mapped`): which rows join a run and the clients,
+types and fixed-point amounts of a run come from its typed columns instead of the row strings.
+
+$ python3 -m main.settle assets/tx1.csv [more.csv ...] [--window 1024] [--mapped]
+"""
+import argparse
+import csv
+import pathlib
+import re
+import shutil
+from decimal import Decimal
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+
+from main.payment_gateway import ClientSnapshots, MappedInput, PaymentManager, add, append_transaction_rows, \
+    file_stamp, input_paths, process, read_rows, replace_client_rows, subtract
+
+RUN_TYPES = ('deposit', 'withdrawal')
+AMOUNT = re.compile(r'\d+(\.\d+)?')
+BALANCE = re.compile(r'-?\d+(\.\d+)?')
+LIMIT = 1 << 62  # fixed-point sums stay clear of int64 overflow
+
+
+def scale_of(amount) -> int:
+    return len(amount.partition('.')[2])
+
+
+def fixed(amount, scale) -> int:
+    whole, _, fraction = amount.partition('.')
+    return int(whole + fraction.ljust(scale, '0'))
+
+
+def text(value, scale) -> str:
+    # the way `add` and `subtract` print the Decimal result
+    return str(Decimal(int(value)).scaleb(-scale))
+
+
+def batchable(row) -> bool:
+    """
+    A deposit or withdrawal the batched path settles exactly the way `process()` would
+    """
+    if row.get('type') not in RUN_TYPES or not AMOUNT.fullmatch(str(row.get('amount'))):
+        return False
+    if not row.get('client') or not row.get('tx') or \
+            any(str(row.get(f)) != str(row.get(f)).strip() for f in ('client', 'tx')):
+        return False
+    try:
+        PaymentManager.valid_id_or_fail(row)
+    except ValueError:
+        return False
+    return True
+
+
+def decision(result) -> str:
+    return type(result[1]).__name__ if isinstance(result, tuple) else 'ok'
+
+
+def cut_runs(txs, window):
+    """
+    Cut positions into runs of up to `window`; `txs` is the tx id of every row, None for rows that cannot join one
+    yields: the positions of a run as a list, or the position of a row for `process()`
+    """
+    run, seen = [], set()
+    for i, tx in enumerate(txs):
+        if tx is not None and tx not in seen and len(run) < window:
+            # a tx id repeated in a run is settled after the run, it must see the rows before it
+            run.append(i)
+            seen.add(tx)
+            continue
+        if run:
+            yield run
+            run, seen = [], set()
+        if tx is not None:
+            run.append(i)
+            seen.add(tx)
+        else:
+            yield i
+    if run:
+        yield run
+
+
+def settle(rows, window=1024, **ledger):
+    """
+    Apply `rows` in order, runs of up to `window` deposits and withdrawals at a time
+    kwargs: ledger paths as for `PaymentManager`
+    returns: the decision of every row in order, `ok` or the class name of its rejection
+    """
+    pending = {}  # position -> row, until its run or the row itself is settled
+
+    def txs():
+        for i, row in enumerate(rows):
+            pending[i] = row
+            yield row['tx'] if batchable(row) else None
+
+    for part in cut_runs(txs(), window):
+        if isinstance(part, list):
+            yield from settle_run([pending.pop(i) for i in part], **ledger)
+        else:
+            yield decision(process(pending.pop(part), **ledger))
+
+
+def settle_mapped(reader, window=1024, **ledger):
+    """
+    `settle` over a `MappedInput`: `batchable`, the tx ids cutting runs and the clients, types and amounts of a
+    run are taken from the typed columns of each block, rows are still decoded for the ledger files.
+    Runs end at block boundaries.
+    returns: the decision of every row in order
+    """
+    if not reader.mapped:
+        yield from settle(reader.rows(), window, **ledger)
+        return
+    types = [MappedInput.TYPES.index(t) for t in RUN_TYPES]
+    for lo in range(0, len(reader), reader.block):
+        hi = min(lo + reader.block, len(reader))
+        columns = reader.columns(lo, hi)
+        rows = [reader.row(line) for line in reader.lines(lo, hi)]
+        joins = np.isin(columns['type'], types) & (columns['client'] >= 0) & (columns['tx'] >= 0) & columns['decimal']
+        for part in cut_runs([tx if join else None for tx, join in zip(columns['tx'].tolist(), joins)], window):
+            if isinstance(part, list):
+                places = columns['places'][part]
+                run = dict(client=columns['client'][part], places=places,
+                           withdrawal=columns['type'][part] == MappedInput.TYPES.index('withdrawal'),
+                           amount=columns['amount'][part] // 10 ** (columns['scale'] - places))
+                yield from settle_run([rows[i] for i in part], run, **ledger)
+            else:
+                yield decision(process(rows[part], **ledger))
+
+
+def run_columns(rows) -> dict:
+    """
+    The arrays `settle_run` works on, from the row strings: client, withdrawal, amount as an integer at its own
+    decimal places
+    """
+    places = np.array([scale_of(r['amount']) for r in rows], dtype=np.int64)
+    return dict(client=np.array([r['client'] for r in rows]), places=places,
+                withdrawal=np.array([r['type'] == 'withdrawal' for r in rows]),
+                amount=np.array([fixed(r['amount'], p) for r, p in zip(rows, places.tolist())], dtype=object))
+
+
+def first_short(code, amount, withdrawal, accepted, opening) -> np.ndarray:
+    """
+    Running available balance of every client over the rows sorted by client, rows in order within a client
+    returns: the first withdrawal of every client that its balance does not cover
+    """
+    delta = np.where(accepted, np.where(withdrawal, -amount, amount), 0)
+    starts = np.r_[True, code[1:] != code[:-1]]
+    group = np.maximum.accumulate(np.where(starts, np.arange(len(code)), 0))
+    before = np.cumsum(delta) - delta
+    available = opening[code] + before - before[group]
+    short = accepted & withdrawal & (available < amount)
+    count = np.cumsum(short)
+    return short & (count - (count - short)[group] == 1)
+
+
+def settle_run(rows, columns=None, **ledger) -> list:
+    """
+    Settle a run of `batchable` rows with distinct tx ids
+    columns: `run_columns` of the rows, made from them if not given
+    returns: the decision of every row
+    """
+    columns = run_columns(rows) if columns is None else columns
+    pm = PaymentManager(**ledger)
+    _, first, code = np.unique(columns['client'], return_index=True, return_inverse=True)
+    code = code.reshape(-1)
+    cids = [rows[i]['client'] for i in first]
+    records = pm.get_record('client', True, *cids)
+    existing = pm.get_record('tx', False, *[r['tx'] for r in rows])
+    start = {c: records[c][0] for c in cids if records.get(c)}
+    aggregates = pm.get_aggregates(*cids)
+    numbers = [rec[f] for rec in start.values() for f in ('available', 'total')] + \
+              [rec[f] for rec in aggregates.values() for f in ('deposited', 'withdrawn')]
+    if not all(BALANCE.fullmatch(n) for n in numbers):
+        # balances the row by row rules would trip over
+        return [decision(process(row, **ledger)) for row in rows]
+
+    # rejections that do not depend on the balance, in the order `validate` checks them
+    locked = pm.locked
+    decisions = [None] * len(rows)
+    created = {}  # new client -> row of its first deposit
+    for i, r in enumerate(rows):
+        c = r['client']
+        if c in locked or (c in start and start[c]['locked'].strip() == 'True'):
+            decisions[i] = 'ClientAccountLocked'
+        elif not columns['amount'][i]:
+            decisions[i] = 'PaymentError'
+        elif any(t['type'] == r['type'] for t in existing[r['tx']]):
+            decisions[i] = 'TransactionIDAlreadyExists'
+        elif r['type'] == 'withdrawal' and c not in start and c not in created:
+            decisions[i] = 'ClientNotFound'
+        elif c not in start:
+            created.setdefault(c, i)
+
+    places = columns['places'].tolist()
+    scale = max(places + [scale_of(n) for n in numbers] + [2])
+    amounts = [int(a) * 10 ** (scale - p) for a, p in zip(columns['amount'].tolist(), places)]
+    opening = [fixed(start[c]['available'], scale) if c in start else 0 for c in cids]
+    if sum(amounts) + max(abs(v) for v in opening) >= LIMIT:
+        return [decision(process(row, **ledger)) for row in rows]
+
+    amount = np.array(amounts, dtype=np.int64)
+    withdrawal = np.asarray(columns['withdrawal'], dtype=bool)
+    accepted = np.array([d is None for d in decisions])
+    order = np.argsort(code, kind='stable')
+    code_s, amount_s, withdrawal_s, accepted_s = code[order], amount[order], withdrawal[order], accepted[order]
+    opening = np.array(opening, dtype=np.int64)
+    while True:
+        short = first_short(code_s, amount_s, withdrawal_s, accepted_s, opening)
+        if not short.any():
+            break
+        accepted_s &= ~short
+        for i in order[short]:
+            decisions[i] = 'WithdrawalError'
+    accepted[order] = accepted_s
+    for i in np.flatnonzero(accepted):
+        decisions[i] = 'ok'
+
+    applied = np.flatnonzero(accepted).tolist()
+    if applied:
+        save_run(pm, [rows[i] for i in applied], [amounts[i] for i in applied], [places[i] for i in applied],
+                 start, aggregates, scale)
+    return decisions
+
+
+def save_run(pm, applied, amounts, places, start, aggregates, scale):
+    """
+    Write the balances, tx rows and aggregates of the applied rows, one rewrite of each file
+    amounts: of the applied rows at `scale`, places: their decimal places
+    """
+    sums = {}  # client -> type -> [amount, rows, places]
+    for r, amount, row_places in zip(applied, amounts, places):
+        s = sums.setdefault(r['client'], {t: [0, 0, 0] for t in RUN_TYPES})[r['type']]
+        s[0] += amount
+        s[1] += 1
+        s[2] = max(s[2], row_places)
+
+    clients = {}
+    for c, s in sums.items():
+        rec = dict(start.get(c) or dict(client=c, held="0.00", available="0.00", total="0.00", locked="False"))
+        opening = dict(rec)
+        net = s['deposit'][0] - s['withdrawal'][0]
+        places = max(s['deposit'][2] if s['deposit'][1] else 0, s['withdrawal'][2] if s['withdrawal'][1] else 0)
+        for f in ('available', 'total'):
+            field_scale = max(scale_of(rec[f]), places)
+            rec[f] = text((fixed(rec[f], scale) + net) // 10 ** (scale - field_scale), field_scale)
+        clients[c] = rec
+
+        agg = aggregates.get(c)
+        if agg is None:
+            agg = {f: "0" for f in PaymentManager.COLS['aggregate']['fields']}
+            agg.update(client=opening['client'], opening_held=opening['held'] or "0.00",
+                       opening_available=opening['available'] or "0.00", opening_total=opening['total'] or "0.00")
+        for typ, (total, count, places) in s.items():
+            if count:
+                amount_field, count_field = PaymentManager.AGGREGATES[typ]
+                field_scale = max(scale_of(agg[amount_field]), places)
+                agg[amount_field] = text((fixed(agg[amount_field], scale) + total) // 10 ** (scale - field_scale),
+                                         field_scale)
+                agg[count_field] = str(int(agg[count_field]) + count)
+        pm.aggregates[c] = agg
+
+    fields = PaymentManager.COLS['client']['fields']
+    encoding = PaymentManager.COLS['client']['encoding']
+    # tmp file next to the accounts so the move is an atomic rename
+    temp_path = NamedTemporaryFile(mode='w', delete=False, dir=pathlib.Path(pm.client_csv).parent)
+    with open(pm.client_csv, 'r', encoding=encoding, buffering=20000000) as csvfile, \
+            open(temp_path.name, 'w', encoding=encoding) as csvtempfile:
+        writer = csv.DictWriter(csvtempfile, fieldnames=fields)
+        # new clients are appended in the order of their first deposit
+        writer.writerows(replace_client_rows(csv.DictReader(csvfile, fieldnames=fields), clients))
+    locked = pm.locked
+    shutil.move(temp_path.name, pm.client_csv)
+    locked.stamp = file_stamp(pm.client_csv)
+    snapshots = ClientSnapshots(pm.client_csv, encoding=encoding)
+    if snapshots.enabled:
+        snapshots.publish()
+
+    # the log is append only
+    append_transaction_rows(pm.transaction_csv, applied)
+    pm.save_client_aggregates()
+    record_run(pm, applied, start)
+
+
+def record_run(pm, applied, start):
+    """
+    Hand the applied rows in order to the hooks of the ledger, as `process()` does after each save: tx history,
+    client index, checkpoint journal and change feed
+    start: the client records before the run
+    """
+    for row in applied:
+        if pm.history is not None:
+            pm.history.add(row)
+        if pm.client_index is not None:
+            pm.client_index.add(row)
+    if pm.client_index is not None:
+        pm.client_index.sync(pm.transaction_csv)
+    if pm.checkpoints is None and pm.changes is None:
+        return
+
+    # the record every row left behind, the way `deposit` and `withdrawal` compute it
+    records = {}
+    for row in applied:
+        c = row['client']
+        rec = dict(records.get(c) or start.get(c) or
+                   dict(client=c, held="0.00", available="0.00", total="0.00", locked="False"))
+        change = add if row['type'] == 'deposit' else subtract
+        rec['total'], rec['available'] = change(rec['total'], row['amount']), change(rec['available'], row['amount'])
+        records[c] = rec
+        if pm.checkpoints is not None:
+            pm.checkpoints.record(row, {c: [rec]})
+        if pm.changes is not None:
+            pm.changes.record(row, {c: [rec]})
+    if pm.changes is not None:
+        pm.changes.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="input files or globs, applied in order")
+    parser.add_argument('--window', type=int, default=1024, help="rows settled together at most")
+    parser.add_argument('--client-csv', help="default: ./client_accounts.csv")
+    parser.add_argument('--transaction-csv', help="default: ./transactions.csv")
+    parser.add_argument('--mapped', action='store_true', help="read the inputs through an mmap into typed columns")
+    args = parser.parse_args(argv)
+
+    ledger = PaymentManager(args.client_csv, args.transaction_csv)
+    paths = dict(client_csv=ledger.client_csv, transaction_csv=ledger.transaction_csv)
+    for path in input_paths(args.inputs):
+        if args.mapped:
+            with MappedInput(path) as reader:
+                for _ in settle_mapped(reader, args.window, **paths):
+                    pass
+            continue
+        # read 20MB  chunks
+        with open(path, 'r', encoding='UTF-32', buffering=20000000) as csvfile:
+            for _ in settle(read_rows(csvfile), args.window, **paths):
+                pass
+    ledger.print_clients(with_header=True)
+
+
+if __name__ == '__main__':
+    main()
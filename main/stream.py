@@ -0,0 +1,120 @@
+"""
+Streaming input
+
+Applies an unbounded stream of rows (stdin or a named pipe) with bounded memory: rows are grouped in batches cut
+every `window` rows or `interval` seconds, each batch is prefetched, applied to a write-back buffer and committed
+with one rewrite of each file, and the client records it changed are written out as a stream of deltas.
+`batches` also groups the rows of input files for `process_files`.
+
+$ upstream | python3 main/payment_gateway.py -
+"""
+import csv
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+
+from main.payment_gateway import PaymentError, PaymentManager, Prefetcher, prevalidated, process
+
+
+def batches(rows, size, interval=None):
+    """
+    Group `rows` into lists of up to `size` rows. With an `interval` a group is also cut that many seconds
+    after its first row, so a slow stream is still committed regularly; rows are then read ahead by a thread
+    into a queue of `size` rows.
+    """
+    if not interval:
+        batch = list(itertools.islice(rows, size))
+        while batch:
+            yield batch
+            batch = list(itertools.islice(rows, size))
+        return
+
+    ahead = queue.Queue(size)
+    end = []  # marks the end of the stream, holds the reader's error if any
+
+    def read():
+        try:
+            for row in rows:
+                ahead.put(row)
+        except Exception as err:
+            end.append(err)
+        ahead.put(end)
+
+    threading.Thread(target=read, daemon=True).start()
+    batch, deadline = [], None
+    while True:
+        try:
+            row = ahead.get(timeout=max(0, deadline - time.monotonic()) if batch else None)
+        except queue.Empty:
+            yield batch
+            batch = []
+            continue
+        if row is end:
+            break
+        if not batch:
+            deadline = time.monotonic() + interval
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+    if end:
+        raise end[0]
+
+
+def stream(rows, window=256, interval=1.0, out=None, prevalidate=False, **kwargs):
+    """
+    Apply an unbounded stream of rows with bounded memory.
+
+    Rows are committed every `window` rows or `interval` seconds, whatever comes first: each batch is
+    prefetched, applied to a write-back buffer and written with one rewrite of each file. After every commit
+    the client records it changed are written to `out` (after a header), so the output is a stream of deltas.
+    With `prevalidate` each batch goes through `prevalidate_rows` first.
+    kwargs: ledger paths (and history) as for `PaymentManager`
+    returns: the number of commits
+    """
+    ledger = PaymentManager(**kwargs)
+    paths = dict(kwargs, client_csv=ledger.client_csv, transaction_csv=ledger.transaction_csv)
+    prefetch = Prefetcher(ledger.client_csv, ledger.transaction_csv, write_back=True)
+    reader = PaymentManager(prefetch=prefetch, **paths)
+    writer = csv.DictWriter(out or sys.stdout, fieldnames=PaymentManager.COLS['client']['fields'])
+    writer.writeheader()
+
+    def current(cids) -> dict:
+        # exact client records, lookups match by substring
+        records = reader.get_record('client', True, *cids)
+        found = {}
+        for cid in cids:
+            for rec in records.get(cid, []):
+                if rec['client'] == cid:
+                    found[cid] = rec
+                    break
+        return found
+
+    commits = 0
+    for batch in batches(rows, window, interval):
+        if prevalidate:
+            batch = list(prevalidated(batch, len(batch)))
+        prefetch.load(batch)
+        cids = sorted({row.get('client') or '' for row in batch} - {''})
+        before = current(cids)
+        for row in batch:
+            try:
+                process(row, prefetch=prefetch, **paths)
+            except PaymentError as err:
+                if os.getenv('DEBUG'):
+                    print(err)
+        prefetch.flush()
+        if kwargs.get('changes') is not None:
+            kwargs['changes'].commit()
+        commits += 1
+
+        for cid, rec in current(cids).items():
+            if before.get(cid) != rec:
+                writer.writerow(rec)
+        (out or sys.stdout).flush()
+    return commits
@@ -6,9 +6,20 @@ Created on Aug 7, 2021
 
 import unittest
 from main.payment_gateway import *
+from main.chain import *
+from main.checkpoints import *
+from main.client_index import *
+from main.fingerprint import *
+from main.history import *
+from main.partition import *
+from main.pipeline import *
+from main.replica import *
+from main.stream import *
 import tempfile
 import io
 import csv
+import subprocess
+from unittest import mock
 
 
 class Test(unittest.TestCase):
@@ -16,9 +27,11 @@ class Test(unittest.TestCase):
     def setUp(self):
         client_accounts_path = pathlib.Path(__name__).resolve().parent / 'client_accounts.csv'
         transactions_path = pathlib.Path(__name__).resolve().parent / 'transactions.csv'
+        aggregates_path = pathlib.Path(__name__).resolve().parent / 'client_accounts.aggregates.csv'
         # flush file
         open(client_accounts_path, 'w').close()
         open(transactions_path, 'w').close()
+        open(aggregates_path, 'w').close()
 
         self.pm_args = dict(client_csv=client_accounts_path, transaction_csv=transactions_path)
 
@@ -566,3 +579,796 @@ class Test(unittest.TestCase):
         os.remove(utf32[1])
 
         self.assertDictEqual(expected_c, clients)
+
+    def test_locked_bitset_after_chargeback(self):
+        t = """type,       client,     tx,      amount
+               deposit,     001,       001,     20.00
+               dispute,     001,       001,
+               resolve,     001,       001,
+               chargeback,   001,       001,
+            """
+        pm = process(*self.get_csv_params(t.strip(), 'tx'), **self.pm_args)
+
+        self.assertIn('001', pm.locked)
+        self.assertNotIn('002', pm.locked)
+
+        # rows for frozen accounts are rejected before any record is fetched
+        td = dict(type="deposit", client="001", tx="002", amount="10.00")
+        with mock.patch.object(PaymentManager, 'get_record', side_effect=AssertionError("record fetched")):
+            with self.assertRaises(ClientAccountLocked):
+                PaymentManager(**self.pm_args).validate(td)
+
+    def test_locked_bitset_follows_external_changes(self):
+        c = """client,  held,    available, total,  locked
+                001,     0.00,    0.00,      0.00,    True
+            """
+        kw = self.get_csv_params(c.strip(), 'client')
+        PaymentManager(**self.pm_args).new_client('001', **kw[0]).save_client_accounts()
+        self.assertIn('001', PaymentManager(**self.pm_args).locked)
+
+        # flush file outside of the payment manager
+        open(self.pm_args['client_csv'], 'w').close()
+        self.assertNotIn('001', PaymentManager(**self.pm_args).locked)
+
+    def test_compact_transactions_keeps_outcomes(self):
+        rows = [dict(type="deposit", client="001", tx="001 ", amount="  20.00"),
+                dict(type="deposit", client="001", tx="002", amount="10.00"),
+                dict(type="dispute", client="001", tx="002", amount="")]
+        pm = process(*rows, **self.pm_args)
+        before = pm.get_record('tx', False, '001', '002')
+        size = os.path.getsize(self.pm_args['transaction_csv'])
+
+        stats = compact_transactions(self.pm_args['transaction_csv'])
+
+        self.assertTrue(stats['swapped'])
+        self.assertEqual(stats['rows'], 3)
+        self.assertLess(os.path.getsize(self.pm_args['transaction_csv']), size)
+        self.assertDictEqual(pm.get_record('tx', False, '001', '002'), before)
+
+        # rule outcomes are unchanged on the compacted history
+        td = dict(type="dispute", client="001", tx="002", amount="")
+        pm, e = process(td, **self.pm_args)
+        self.assertIsInstance(e, TransactionIDAlreadyExists)
+
+    def test_compact_transactions_carries_over_rows_saved_while_running(self):
+        process(dict(type="deposit", client="001", tx="001", amount="20.00"), **self.pm_args)
+        saved = []
+        compact = compact_row
+
+        def save_while_compacting(row, fields):
+            if not saved:
+                saved.append(process(dict(type="deposit", client="001", tx="002", amount="5.00"), **self.pm_args))
+            return compact(row, fields)
+
+        with mock.patch('main.payment_gateway.compact_row', side_effect=save_while_compacting):
+            stats = compact_transactions(self.pm_args['transaction_csv'])
+
+        self.assertTrue(stats['swapped'])
+        self.assertEqual((stats['rows'], stats['tail']), (1, 1))
+        transactions = PaymentManager(**self.pm_args).get_record('tx', False, '001', '002')
+        self.assertEqual(transactions['002'][0]['amount'], "5.00")
+
+    def test_compactor_runs_in_background(self):
+        process(dict(type="deposit", client="001", tx="001", amount="20.00"), **self.pm_args)
+        job = Compactor(self.pm_args['transaction_csv'])
+        job.start()
+        job.join()
+
+        self.assertIsNone(job.error)
+        self.assertTrue(job.stats['swapped'])
+
+    def test_compactor_records_every_failed_pass(self):
+        job = Compactor(self.pm_args['transaction_csv'], interval=0.01)
+        with mock.patch('main.payment_gateway.compact_transactions', side_effect=csv.Error("bad row")):
+            job.start()
+            while len(job.errors) < 2:
+                time.sleep(0.01)
+            # the thread keeps running after a failed pass
+            self.assertTrue(job.is_alive())
+            with self.assertRaises(csv.Error):
+                job.stop()
+        self.assertFalse(job.is_alive())
+
+    def test_snapshot_readers_pin_a_generation(self):
+        snapshots = ClientSnapshots(self.pm_args['client_csv'])
+        shutil.rmtree(snapshots.path, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, snapshots.path, True)
+
+        process(dict(type="deposit", client="001", tx="001", amount="10.00"), **self.pm_args)
+        # queries do not turn publishing on
+        with self.assertRaises(FileNotFoundError):
+            PaymentManager(**self.pm_args).snapshot()
+        self.assertFalse(snapshots.enabled)
+
+        snapshots.enable()
+        pinned = PaymentManager(**self.pm_args).snapshot()
+        self.addCleanup(pinned.close)
+
+        # writer keeps committing while the reader holds its generation
+        process(dict(type="deposit", client="001", tx="002", amount="5.00"), **self.pm_args)
+        process(dict(type="deposit", client="002", tx="003", amount="1.00"), **self.pm_args)
+        process(dict(type="deposit", client="002", tx="004", amount="1.00"), **self.pm_args)
+
+        self.assertEqual(pinned.get_record('001')['001'][0]['available'], "10.00")
+        self.assertNotIn('002', pinned.get_record('001', '002'))
+
+        with PaymentManager(**self.pm_args).snapshot() as latest:
+            self.assertGreater(latest.generation, pinned.generation)
+            self.assertEqual(latest.get_record('001')['001'][0]['available'], "15.00")
+
+        # old generations are garbage collected
+        self.assertEqual(len(snapshots.generations()), ClientSnapshots.KEEP)
+        self.assertNotIn(pinned.generation, snapshots.generations())
+        self.assertEqual(pinned.get_record('001')['001'][0]['total'], "10.00")
+
+    def test_aggregates_follow_each_operation(self):
+        t = """type,       client,     tx,      amount
+               deposit,     001,       001,     20.00
+               deposit,     001,       002,     10.00
+               withdrawal,  001,       003,     5.00
+               dispute,     001,       002,
+               resolve,     001,       002,
+               chargeback,   001,       002,
+               deposit,     002,       004,     1.50
+            """
+        pm = process(*self.get_csv_params(t.strip(), 'tx'), **self.pm_args)
+
+        agg = pm.get_aggregates('001')['001']
+        self.assertEqual((agg['deposited'], agg['withdrawn'], agg['disputed'], agg['resolved'], agg['charged_back']),
+                         ("30.00", "5.00", "10.00", "10.00", "10.00"))
+        self.assertEqual((agg['deposits'], agg['withdrawals'], agg['disputes'], agg['resolves'], agg['chargebacks']),
+                         ("2", "1", "1", "1", "1"))
+        self.assertEqual(pm.get_aggregates('002')['002']['deposited'], "1.50")
+        self.assertEqual(pm.check_aggregates(), [])
+
+    def test_aggregates_open_at_existing_balances(self):
+        c = """client,  held,    available, total,  locked
+                001,     0.00,    10.00,      10.00,    False
+            """
+        kw = self.get_csv_params(c.strip(), 'client')
+        PaymentManager(**self.pm_args).new_client('001', **kw[0]).save_client_accounts()
+
+        pm = process(dict(type="withdrawal", client="001", tx="002", amount="4.00"), **self.pm_args)
+
+        agg = pm.get_aggregates('001')['001']
+        self.assertEqual((agg['opening_total'], agg['withdrawn'], agg['withdrawals']), ("10.00", "4.00", "1"))
+        self.assertEqual(pm.check_aggregates('001'), [])
+
+        # rejected rows are not counted
+        pm, e = process(dict(type="withdrawal", client="001", tx="003", amount="40.00"), **self.pm_args)
+        self.assertIsInstance(e, WithdrawalError)
+        self.assertEqual(pm.get_aggregates('001')['001']['withdrawals'], "1")
+
+    def test_withdrawals_of_one_call_add_up(self):
+        process(dict(type="deposit", client="001", tx="001", amount="10.00"), **self.pm_args)
+
+        pm = PaymentManager(**self.pm_args)
+        pm.withdrawal(dict(type="withdrawal", client="001", tx="002", amount="3.00"),
+                      dict(type="withdrawal", client="001", tx="003", amount="4.00"))
+        pm.save_client_accounts()
+        pm.save_client_aggregates()
+
+        self.assertEqual(pm.get_record('client', True, '001')['001'][0]['available'], "3.00")
+        agg = pm.get_aggregates('001')['001']
+        self.assertEqual((agg['withdrawn'], agg['withdrawals']), ("7.00", "2"))
+        self.assertEqual(pm.check_aggregates('001'), [])
+
+    def test_prefetch_serves_window_lookups(self):
+        process(dict(type="deposit", client="001", tx="001", amount="20.00"), **self.pm_args)
+        t = """type,       client,     tx,      amount
+               dispute,     001,       001,
+               deposit,     002,       002,     5.00
+               withdrawal,  002,       003,     2.00
+            """
+        window = self.get_csv_params(t.strip(), 'tx')
+        prefetch = Prefetcher(self.pm_args['client_csv'], self.pm_args['transaction_csv']).load(window)
+
+        self.assertEqual(prefetch.get_record('tx', False, '001')['001'][0]['amount'], "20.00")
+        self.assertIsNone(prefetch.get_record('tx', False, '999'))
+
+        with mock.patch.object(Prefetcher, 'scan', side_effect=AssertionError("store scanned")):
+            for row in window:
+                pm = process(row, prefetch=prefetch, **self.pm_args)
+                self.assertNotIsInstance(pm, tuple)
+                # saves are applied to the buffer as well
+                self.assertDictEqual(prefetch.get_record('client', True, row['client']),
+                                     PaymentManager(**self.pm_args).get_record('client', True, row['client']))
+
+        clients = pm.get_record('client', True, '001', '002')
+        self.assertEqual(clients['001'][0]['held'], "20.00")
+        self.assertEqual(clients['002'][0]['available'], "3.00")
+
+    def test_prefetch_falls_back_after_external_change(self):
+        process(dict(type="deposit", client="001", tx="001", amount="20.00"), **self.pm_args)
+        prefetch = Prefetcher(self.pm_args['client_csv'], self.pm_args['transaction_csv'])
+        prefetch.load([dict(type="withdrawal", client="001", tx="002", amount="5.00")])
+
+        open(self.pm_args['client_csv'], 'w').close()
+
+        self.assertIsNone(prefetch.get_record('client', True, '001'))
+        pm, e = process(dict(type="withdrawal", client="001", tx="002", amount="5.00"), prefetch=prefetch,
+                        **self.pm_args)
+        self.assertIsInstance(e, ClientNotFound)
+
+    def test_stream_commits_and_writes_deltas(self):
+        t = """type,       client,     tx,      amount
+               deposit,     001,       001,     20.00
+               deposit,     002,       002,     5.00
+               withdrawal,  001,       003,     50.00
+               withdrawal,  002,       004,     2.00
+               deposit,     003,       005,     1.00
+            """
+        out = io.StringIO()
+
+        commits = stream(iter(self.get_csv_params(t.strip(), 'tx')), window=2, out=out, **self.pm_args)
+
+        self.assertEqual(commits, 3)
+        # every commit lists the clients it changed, the rejected withdrawal changes nothing
+        self.assertEqual(out.getvalue().splitlines(), ["client,held,available,total,locked",
+                                                       "001,0.00,20.00,20.00,False",
+                                                       "002,0.00,5.00,5.00,False",
+                                                       "002,0.00,3.00,3.00,False",
+                                                       "003,0.00,1.00,1.00,False"])
+        clients = PaymentManager(**self.pm_args).get_record('client', True, '001', '002', '003')
+        self.assertEqual([clients[c][0]['total'] for c in ('001', '002', '003')], ["20.00", "3.00", "1.00"])
+
+    def test_batches_cut_on_interval(self):
+        def trickle():
+            # an endless stream that only delivers a few rows per interval
+            for n in itertools.count(1):
+                if n % 3 == 0:
+                    time.sleep(0.2)
+                yield dict(type="deposit", client="001", tx=str(n), amount="1.00")
+
+        groups = batches(trickle(), size=100, interval=0.05)
+
+        self.assertEqual([len(next(groups)) for _ in range(3)], [2, 3, 3])
+
+    def test_cli_reads_stdin(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        rows = "type,client,tx,amount\ndeposit,1,1,10.00\nwithdrawal,1,2,4.00\n"
+        script = pathlib.Path(__file__).resolve().parent.parent / 'main' / 'payment_gateway.py'
+
+        out = subprocess.run([sys.executable, str(script), '-'], input=rows.encode('UTF-32'), cwd=tmp.name,
+                             stdout=subprocess.PIPE, check=True).stdout.decode()
+
+        self.assertEqual(out.splitlines(), ["client,held,available,total,locked", "1,0.00,6.00,6.00,False"])
+
+    def test_history_serves_spilled_deposits(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        history = DepositHistory.load(self.pm_args['transaction_csv'], horizon=2, path=tmp.name)
+        self.addCleanup(history.close)
+
+        for tx in range(1, 9):
+            process(dict(type="deposit", client="001", tx="{:03d}".format(tx), amount="10.00"), history=history,
+                    **self.pm_args)
+        process(dict(type="dispute", client="001", tx="001", amount=""), history=history, **self.pm_args)
+
+        # only the newest txs stay in memory, the oldest deposit is found in the spilled segment
+        self.assertLessEqual(len(history.hot), 3)
+        self.assertNotIn("001", history.hot)
+        self.assertGreater(history.stats['cold'], 0)
+        self.assertEqual(PaymentManager(**self.pm_args).get_record('client', True, '001')['001'][0]['held'], "10.00")
+        self.assertEqual(history.get_record(False, '001', '008'),
+                         PaymentManager(**self.pm_args).get_record('tx', False, '001', '008'))
+        self.assertIsNone(history.get_record(False, ''))
+
+    def test_partition_keeps_client_order(self):
+        rows = [dict(type="deposit", client="00300", tx="0000000001", amount="1.00"),
+                dict(type="deposit", client="00001", tx="0000000002", amount="1.00"),
+                dict(type="withdrawal", client="00300", tx="0000000003", amount="1.00"),
+                dict(type="deposit", client="00001", tx="0000000004", amount="1.00")]
+
+        order = list(partition_rows(iter(rows), span=100, memory_rows=1))
+
+        # client 00001 comes first, each client in its input order
+        self.assertEqual([position for position, _ in order], [1, 3, 0, 2])
+        self.assertEqual([row for _, row in order], [rows[1], rows[3], rows[0], rows[2]])
+
+    def test_partition_merges_ranges_sharing_a_tx(self):
+        rows = [dict(type="deposit", client="00200", tx="0000000005", amount="1.00"),
+                dict(type="deposit", client="00300", tx="0000000006", amount="1.00"),
+                dict(type="deposit", client="00001", tx="0000000005", amount="1.00")]
+
+        order = [position for position, _ in partition_rows(iter(rows), span=100, memory_rows=1)]
+
+        # the deposit of 00200 must still win the tx id over the later one of 00001
+        self.assertEqual(order, [0, 2, 1])
+
+    def test_cli_processes_many_files_against_one_ledger(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        header = "type,client,tx,amount\n"
+        files = {'a.csv': "deposit,1,1,10.00\n", 'b1.csv': "withdrawal,1,2,4.00\n", 'b2.csv': "deposit,1,3,1.50\n"}
+        for name, rows in files.items():
+            (pathlib.Path(tmp.name) / name).write_bytes((header + rows).encode('UTF-32'))
+        script = pathlib.Path(__file__).resolve().parent.parent / 'main' / 'payment_gateway.py'
+
+        out = subprocess.run([sys.executable, str(script), 'a.csv', 'b*.csv'], cwd=tmp.name,
+                             stdout=subprocess.PIPE, check=True).stdout.decode()
+
+        self.assertEqual(out.splitlines(), ["client,held,available,total,locked", "1,0.00,7.50,7.50,False"])
+
+    def test_parallel_ledgers_are_independent(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        header = "type,client,tx,amount\n"
+        inputs = {'x': ["deposit,1,1,10.00\n", "withdrawal,1,2,4.00\n"],
+                  'y': ["deposit,1,1,3.00\ndeposit,2,2,1.00\n", "withdrawal,2,3,5.00\n"]}
+        for name, files in inputs.items():
+            (pathlib.Path(tmp.name) / name).mkdir()
+            for i, rows in enumerate(files):
+                (pathlib.Path(tmp.name) / name / 'in{}.csv'.format(i)).write_bytes((header + rows).encode('UTF-32'))
+
+        summary = process_ledgers([pathlib.Path(tmp.name) / name for name in inputs] + ['missing'], workers=2)
+
+        x, y, missing = summary['ledgers']
+        self.assertEqual((x['files'], x['rows'], x['applied'], x['clients']), (2, 2, 2, 1))
+        self.assertEqual((y['rows'], y['applied'], y['rejected'], y['clients']), (3, 2, 1, 2))
+        self.assertIn('error', missing)
+        self.assertEqual(summary['totals']['rows'], 5)
+        self.assertEqual(summary['totals']['failed'], 1)
+        ledger = PaymentManager(pathlib.Path(tmp.name) / 'x' / 'client_accounts.csv',
+                                pathlib.Path(tmp.name) / 'x' / 'transactions.csv')
+        self.assertEqual(ledger.get_record('client', True, '1')['1'][0]['total'], "6.00")
+
+    def test_pipeline_matches_sequential_processing(self):
+        rows = [dict(type="deposit", client="00{}".format(c), tx="{:04d}".format(t), amount="10.00")
+                for t, c in zip(range(1, 41), itertools.cycle("123"))]
+        rows += [dict(type="withdrawal", client="001", tx="0041", amount="5.00"),
+                 dict(type="dispute", client="002", tx="0002", amount=""),
+                 dict(type="resolve", client="002", tx="0002", amount=""),
+                 dict(type="chargeback", client="002", tx="0002", amount=""),
+                 dict(type="deposit", client="002", tx="0042", amount="1.00"),
+                 dict(type="dispute", client="003", tx="0003", amount=""),
+                 dict(type="resolve", client="003", tx="0003", amount="")]
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        ledger = dict(client_csv=pathlib.Path(tmp.name) / 'client_accounts.csv',
+                      transaction_csv=pathlib.Path(tmp.name) / 'transactions.csv')
+        for path in ledger.values():
+            path.touch()
+        for row in rows:
+            process(dict(row), **self.pm_args)
+
+        write = Prefetcher.write
+
+        def slow_write(prefetch, *args):
+            # keep the persist stage behind so windows are applied while earlier ones are written
+            time.sleep(0.01)
+            return write(prefetch, *args)
+
+        with mock.patch.object(Prefetcher, 'write', slow_write):
+            stats = pipeline(iter(dict(row) for row in rows), window=4, depth=2, persist_depth=2, **ledger)
+
+        self.assertEqual(stats['rows'], len(rows))
+        self.assertGreater(stats['commits'], 1)
+        for key in ('client_csv', 'transaction_csv'):
+            self.assertEqual(pathlib.Path(ledger[key]).read_bytes(), pathlib.Path(self.pm_args[key]).read_bytes())
+        # the locked bitset followed the chargeback
+        self.assertIn('002', PaymentManager(**ledger).locked)
+        self.assertEqual(set(stats['stalls']), {'parse', 'apply', 'persist'})
+        self.assertGreater(stats['stalls']['persist']['busy'], 0)
+
+    def test_pipeline_surfaces_persist_failures(self):
+        rows = [dict(type="deposit", client="001", tx="{:03d}".format(t), amount="1.00") for t in range(1, 9)]
+
+        with mock.patch.object(Prefetcher, 'write', side_effect=OSError("disk full")):
+            with self.assertRaises(RuntimeError) as ctx:
+                pipeline(iter(rows), window=2, depth=1, persist_depth=1, **self.pm_args)
+        self.assertIsInstance(ctx.exception.__cause__, OSError)
+        self.assertFalse(PaymentManager(**self.pm_args).locked.pinned)
+
+    def test_pipeline_feed_stays_behind_the_files(self):
+        rows = [dict(type="deposit", client="00{}".format(t % 3 + 1), tx="{:03d}".format(t), amount="1.00")
+                for t in range(1, 25)]
+        feed_csv = changes_path(self.pm_args['transaction_csv']) / 'feed.csv'
+        shutil.rmtree(feed_csv.parent, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, feed_csv.parent, ignore_errors=True)
+        write = Prefetcher.write
+        ahead = []
+
+        def slow_write(prefetch, *args):
+            time.sleep(0.02)
+            # feed lines published while the window holding their rows is not written yet
+            ahead.append(len(list(ChangeFeed.read(feed_csv))) - count_rows(self.pm_args['transaction_csv'], 'tx'))
+            return write(prefetch, *args)
+
+        with ChangeFeed.load(self.pm_args['transaction_csv']) as changes, \
+                mock.patch.object(Prefetcher, 'write', slow_write):
+            pipeline(iter(rows), window=2, depth=2, persist_depth=4, changes=changes, **self.pm_args)
+
+        self.assertGreater(len(ahead), 1)
+        self.assertLessEqual(max(ahead), 0)
+        self.assertEqual([int(entry['position']) for entry, _ in ChangeFeed.read(feed_csv)], list(range(1, 25)))
+
+        # a failed window is not published
+        shutil.rmtree(feed_csv.parent)
+        with ChangeFeed.load(self.pm_args['transaction_csv']) as changes, \
+                mock.patch.object(Prefetcher, 'write', side_effect=OSError("disk full")):
+            with self.assertRaises(RuntimeError):
+                pipeline(iter([dict(type="deposit", client="001", tx="100", amount="1.00")]), window=2, depth=1,
+                         persist_depth=1, changes=changes, **self.pm_args)
+        self.assertEqual(list(ChangeFeed.read(feed_csv)), [])
+
+    def test_latency_histogram_percentiles(self):
+        histogram = LatencyHistogram(precision=7)
+        for us in range(1, 1001):
+            histogram.record(us * 1000)
+        histogram.record(5 * 10 ** 9)  # one 5s outlier
+
+        # within the 2 ** -7 relative error of the exact percentiles
+        self.assertAlmostEqual(histogram.percentile(50), 500000, delta=500000 / 128)
+        self.assertAlmostEqual(histogram.percentile(99), 991000, delta=991000 / 128)
+        self.assertEqual(histogram.percentile(100), 5 * 10 ** 9)
+        self.assertLess(len(histogram.counts), 1000)
+        merged = LatencyHistogram()
+        merged.merge(histogram)
+        self.assertEqual(merged.summary(), histogram.summary())
+
+    def test_process_records_latency_and_rejections(self):
+        process_stats.reset()
+        process(dict(type="deposit", client="001", tx="001", amount="10.00"), **self.pm_args)
+        process(dict(type="withdrawal", client="001", tx="002", amount="50.00"), **self.pm_args)
+        process(dict(type="withdrawal", client="001", tx="003", amount="5.00"), **self.pm_args)
+
+        report = process_stats.report()
+        self.assertEqual(report['rows'], 3)
+        self.assertEqual(report['rejected'], 1)
+        self.assertEqual(report['types']['deposit']['rejection_rate'], 0)
+        self.assertEqual(report['types']['withdrawal']['rejection_rate'], 0.5)
+        self.assertGreater(report['latency_us']['max'], 0)
+        self.assertLessEqual(report['latency_us']['p50'], report['latency_us']['max'])
+
+    def test_cli_stats_report_and_json_dump(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        rows = "type,client,tx,amount\ndeposit,1,1,10.00\nwithdrawal,1,2,40.00\n"
+        (pathlib.Path(tmp.name) / 'tx.csv').write_bytes(rows.encode('UTF-32'))
+        script = pathlib.Path(__file__).resolve().parent.parent / 'main' / 'payment_gateway.py'
+
+        result = subprocess.run([sys.executable, str(script), '--stats', 'tx.csv'], cwd=tmp.name,
+                                env=dict(os.environ, STATS_JSON='stats.json'), capture_output=True, check=True)
+
+        self.assertEqual(result.stdout.decode().splitlines()[0], "client,held,available,total,locked")
+        self.assertIn("'p99'", result.stderr.decode())
+        with open(pathlib.Path(tmp.name) / 'stats.json') as f:
+            report = json.load(f)
+        self.assertEqual((report['rows'], report['rejected']), (2, 1))
+        self.assertEqual(set(report['types']), {'deposit', 'withdrawal'})
+
+    def test_checkpoints_answer_as_of_queries_from_the_tail(self):
+        rows = [dict(type="deposit", client="00{}".format(c), tx="{:03d}".format(t), amount="10.00")
+                for t, c in zip(range(1, 21), itertools.cycle("12"))]
+        rows += [dict(type="withdrawal", client="001", tx="021", amount="5.00"),
+                 dict(type="dispute", client="002", tx="002", amount=""),
+                 dict(type="resolve", client="002", tx="002", amount=""),
+                 dict(type="chargeback", client="002", tx="002", amount="")]
+        expected = {}  # position -> client -> record after the row at that position
+        with Checkpoints.load(self.pm_args['transaction_csv'], every=4) as checkpoints:
+            for row in rows:
+                pm = process(dict(row), checkpoints=checkpoints, **self.pm_args)
+                expected[checkpoints.position] = {
+                    c: {k: v.strip() for k, v in pm.get_record('client', True, c)[c][0].items()}
+                    for c in ('001', '002') if pm.get_record('client', True, c)}
+
+            self.assertEqual(checkpoints.position, len(rows))
+            for position, records in expected.items():
+                for client, record in records.items():
+                    self.assertEqual(checkpoints.as_of(client, position), record)
+                    # never more than the rows since the nearest checkpoint
+                    self.assertLess(checkpoints.stats['read'], checkpoints.every)
+            self.assertIsNone(checkpoints.as_of('002', 1))
+            self.assertEqual(checkpoints.as_of('002', len(rows))['locked'], 'True')
+
+        # rebuilt from the tx log when the journal is gone
+        shutil.rmtree(checkpoints_path(self.pm_args['transaction_csv']))
+        with Checkpoints.load(self.pm_args['transaction_csv'], every=5) as checkpoints:
+            for position, records in expected.items():
+                for client, record in records.items():
+                    self.assertEqual(checkpoints.as_of(client, position), record)
+
+    def test_checkpoints_between_full_bases_hold_changed_clients(self):
+        rows = [dict(type="deposit", client="{:03d}".format(c), tx="{:03d}".format(t), amount="1.00")
+                for t, c in zip(range(1, 41), itertools.cycle(range(1, 11)))]
+        with Checkpoints.load(self.pm_args['transaction_csv'], every=2, base=4) as checkpoints:
+            for row in rows:
+                process(dict(row), checkpoints=checkpoints, **self.pm_args)
+
+            self.assertEqual([full for _, _, full in checkpoints.index], [True, False, False, False] * 5)
+            self.assertEqual([len(list(checkpoints.read_checkpoint(*entry))) for entry in checkpoints.index],
+                             [min(position, 10) if full else 2 for position, _, full in checkpoints.index])
+            # client 005 last changed at row 25, found in the base at 26 after the deltas at 32, 30 and 28
+            self.assertEqual(checkpoints.as_of('005', 33)['available'], "3.00")
+            self.assertEqual(checkpoints.stats['checkpoints'], 4)
+            self.assertEqual(checkpoints.as_of('010', 39)['available'], "3.00")
+            self.assertIsNone(checkpoints.as_of('011', 40))
+            latest = dict(checkpoints.latest)
+
+        with Checkpoints.load(self.pm_args['transaction_csv'], every=2, base=4) as checkpoints:
+            self.assertEqual((checkpoints.position, checkpoints.latest), (40, latest))
+
+    def test_cli_as_of_query(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        rows = "type,client,tx,amount\ndeposit,001,001,10.00\ndeposit,001,002,5.00\nwithdrawal,001,003,2.00\n"
+        (pathlib.Path(tmp.name) / 'tx.csv').write_bytes(rows.encode('UTF-32'))
+        script = pathlib.Path(__file__).resolve().parent.parent / 'main' / 'payment_gateway.py'
+        env = dict(os.environ, CHECKPOINTS='2')
+
+        subprocess.run([sys.executable, str(script), 'tx.csv'], cwd=tmp.name, env=env, capture_output=True, check=True)
+        result = subprocess.run([sys.executable, str(script), '--as-of', '001', '2'], cwd=tmp.name, env=env,
+                                capture_output=True, check=True)
+
+        self.assertEqual(result.stdout.decode().splitlines()[1], "001,0.00,15.00,15.00,False")
+
+    def test_client_history_pages_from_the_index(self):
+        rows = [dict(type="deposit", client="00{}".format(c), tx="{:03d}".format(t), amount="10.00")
+                for t, c in zip(range(1, 13), itertools.cycle("12"))]
+        rows += [dict(type="withdrawal", client="001", tx="013", amount="5.00"),
+                 dict(type="dispute", client="002", tx="002", amount=""),
+                 dict(type="deposit", client="001", tx="001", amount="10.00")]  # duplicate, not saved
+        with ClientIndex.load(self.pm_args['transaction_csv']) as client_index:
+            for row in rows:
+                process(dict(row), client_index=client_index, **self.pm_args)
+
+            scan = PaymentManager(**self.pm_args).get_history('001', 0, 100)
+            self.assertEqual(scan['total'], 7)
+            self.assertEqual([t['tx'] for t in scan['transactions']], ["001", "003", "005", "007", "009", "011", "013"])
+
+            pm = PaymentManager(client_index=client_index, **self.pm_args)
+            self.assertEqual(pm.get_history('001', 0, 100), scan)
+            page = pm.get_history('001', 2, 3)
+            self.assertEqual(page['transactions'], scan['transactions'][2:5])
+            self.assertEqual((page['next'], client_index.stats['read']), (5, 3))
+            self.assertIsNone(pm.get_history('001', 5, 3)['next'])
+            self.assertEqual(pm.get_history('002', 0, 2, newest_first=True)['transactions'][0]['type'], "dispute")
+            self.assertEqual(pm.get_history('009', 0, 10)['total'], 0)
+
+        # reopened as is, rebuilt once the tx log changed behind its back
+        with ClientIndex.load(self.pm_args['transaction_csv']) as client_index:
+            self.assertEqual(PaymentManager(client_index=client_index, **self.pm_args).get_history('001', 0, 100), scan)
+        compact_transactions(self.pm_args['transaction_csv'])
+        with ClientIndex.load(self.pm_args['transaction_csv']) as client_index:
+            self.assertEqual(len(client_index), 14)
+            self.assertEqual(PaymentManager(client_index=client_index, **self.pm_args).get_history('001', 0, 100), scan)
+
+    def test_hash_chain_verifies_new_segments_and_finds_tampering(self):
+        rows = [dict(type="deposit", client="00{}".format(c), tx="{:03d}".format(t), amount="10.00")
+                for t, c in zip(range(1, 26), itertools.cycle("123"))]
+        shutil.rmtree(chain_path(self.pm_args['transaction_csv']), ignore_errors=True)
+        self.addCleanup(shutil.rmtree, chain_path(self.pm_args['transaction_csv']), ignore_errors=True)
+        for row in rows[:20]:
+            process(dict(row), **self.pm_args)
+        chain = LedgerChain(self.pm_args['transaction_csv'], self.pm_args['client_csv'], segment_rows=4)
+        self.assertEqual(chain.seal()['rows'], 20)
+        self.assertTrue(chain.verify()['ok'])
+
+        for row in rows[20:]:
+            process(dict(row), **self.pm_args)
+        result = chain.verify()
+        self.assertEqual((result['ok'], result['unsealed'], result['client']), (True, 5, 'unsealed'))
+        self.assertEqual(chain.seal()['segments'], 1)
+        result = chain.verify()
+        # only the segment and the tail sealed since the last verify are read again
+        self.assertEqual((result['ok'], result['checked'], result['client']), (True, 2, 'ok'))
+
+        # compaction moves the rows but keeps them
+        compact_transactions(self.pm_args['transaction_csv'])
+        self.assertTrue(LedgerChain(self.pm_args['transaction_csv']).verify(full=True, workers=2)['ok'])
+
+        # an amount changed in place, in a segment verified before
+        data = pathlib.Path(self.pm_args['transaction_csv']).read_bytes()
+        pathlib.Path(self.pm_args['transaction_csv']).write_bytes(
+            data.replace("006,10.00".encode('UTF-32-LE'), "006,90.00".encode('UTF-32-LE')))
+        chain = LedgerChain(self.pm_args['transaction_csv'])
+        self.assertTrue(chain.verify()['ok'])
+        result = chain.verify(full=True)
+        self.assertEqual((result['ok'], result['broken']), (False, 1))
+
+    def test_keyed_hash_chain_finds_rewritten_digests(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        shutil.rmtree(chain_path(self.pm_args['transaction_csv']), ignore_errors=True)
+        self.addCleanup(shutil.rmtree, chain_path(self.pm_args['transaction_csv']), ignore_errors=True)
+        key_path = pathlib.Path(tmp.name) / 'chain.key'
+        key_path.write_bytes(b'0123456789abcdef')
+        key = chain_key(key_path, self.pm_args['transaction_csv'])
+        for t in range(1, 11):
+            process(dict(type="deposit", client="001", tx="{:03d}".format(t), amount="10.00"), **self.pm_args)
+        LedgerChain(self.pm_args['transaction_csv'], segment_rows=4, key=key).seal()
+        self.assertEqual(LedgerChain(self.pm_args['transaction_csv'], key=key).verify(full=True)['head'], 'ok')
+
+        # the key is needed and must not sit next to the ledger
+        with self.assertRaises(ValueError):
+            LedgerChain(self.pm_args['transaction_csv'])
+        with self.assertRaises(ValueError):
+            chain_key(pathlib.Path(self.pm_args['transaction_csv']).with_name('chain.key'),
+                      self.pm_args['transaction_csv'])
+
+        # a row changed together with the digest of its segment breaks the chain
+        path = pathlib.Path(self.pm_args['transaction_csv'])
+        original = path.read_bytes()
+        path.write_bytes(original.replace("006,10.00".encode('UTF-32-LE'), "006,90.00".encode('UTF-32-LE')))
+        chain = LedgerChain(path, key=key)
+        segment = chain.segments[1]
+        segment['rows'], segment['digest'] = segment_digest(path, segment['offset'], segment['length'])
+        (chain.path / 'segments.csv').unlink()
+        chain.save(chain.segments)
+        result = LedgerChain(path, key=key).verify(full=True)
+        self.assertEqual((result['ok'], result['broken']), (False, 1))
+
+        # a tail row changed together with the tail digest of `head.json`
+        path.write_bytes(original.replace("010,10.00".encode('UTF-32-LE'), "010,90.00".encode('UTF-32-LE')))
+        head_path = chain_path(path) / 'head.json'
+        head = json.loads(head_path.read_text())
+        head['tail']['digest'] = segment_digest(path, head['tail']['offset'], head['tail']['length'])[1]
+        head_path.write_text(json.dumps(head))
+        result = LedgerChain(path, key=key).verify(full=True)
+        self.assertEqual((result['ok'], result['head']), (False, 'changed'))
+        with self.assertRaises(ValueError):
+            LedgerChain(path, key=key).seal()
+
+    def test_fingerprints_skip_chunks_applied_before(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        ledger = dict(client_csv=pathlib.Path(tmp.name) / 'client_accounts.csv',
+                      transaction_csv=pathlib.Path(tmp.name) / 'transactions.csv')
+        for path in ledger.values():
+            path.touch()
+        header = "type,client,tx,amount\n"
+        rows = ["deposit,{},{},1.00\n".format(1 + t % 3, t) for t in range(1, 41)]
+        (pathlib.Path(tmp.name) / 'day1.csv').write_bytes((header + "".join(rows[:30])).encode('UTF-32'))
+        # re-sent tail of day1 with new rows
+        (pathlib.Path(tmp.name) / 'day2.csv').write_bytes((header + "".join(rows[10:])).encode('UTF-32'))
+
+        first = process_files([pathlib.Path(tmp.name) / 'day1.csv'], fingerprint=4, **ledger)
+        self.assertEqual((first['rows'], first['applied'], first['skipped']), (30, 30, 0))
+
+        again = process_files([pathlib.Path(tmp.name) / 'day1.csv'], fingerprint=4, **ledger)
+        self.assertEqual((again['rows'], again['skipped'], again['inputs'][0]['seen']), (0, 30, True))
+
+        # the overlap starts and ends inside chunks of day1, its edges are matched row by row
+        tail = process_files([pathlib.Path(tmp.name) / 'day2.csv'], fingerprint=4, **ledger)
+        self.assertNotIn(10, [first for first, _, _, _ in input_chunks(pathlib.Path(tmp.name) / 'day1.csv', 4)[1]])
+        self.assertGreater(tail['inputs'][0]['skipped_chunks'], 0)
+        self.assertEqual((tail['skipped'], tail['rows'], tail['applied'], tail['rejected']), (20, 10, 10, 0))
+        self.assertEqual(PaymentManager(**ledger).get_record('client', True, '1')['1'][0]['total'], "13.00")
+
+        # a new ledger does not inherit the fingerprints
+        ledger['transaction_csv'].write_bytes(b'')
+        self.assertEqual(process_files([pathlib.Path(tmp.name) / 'day1.csv'], fingerprint=4, **ledger)['applied'], 30)
+
+    def test_resent_file_skipped_by_fingerprint_still_prints_the_accounts(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        rows = "".join("deposit,{},{},1.00\n".format(1 + t % 3, t) for t in range(1, 21))
+        (pathlib.Path(tmp.name) / 'tx.csv').write_bytes(("type,client,tx,amount\n" + rows).encode('UTF-32'))
+        script = pathlib.Path(__file__).resolve().parent.parent / 'main' / 'payment_gateway.py'
+        env = dict(os.environ, FINGERPRINT='4')
+
+        first, again = (subprocess.run([sys.executable, str(script), 'tx.csv'], cwd=tmp.name, env=env,
+                                       capture_output=True, check=True) for _ in range(2))
+
+        self.assertIn("skipped': 20", again.stderr.decode())
+        self.assertEqual(len(first.stdout.decode().splitlines()), 4)
+        self.assertEqual(again.stdout, first.stdout)
+
+    def test_replica_follows_the_change_feed_and_promotes(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        primary, standby = pathlib.Path(tmp.name) / 'primary', pathlib.Path(tmp.name) / 'standby'
+        primary.mkdir()
+        standby.mkdir()
+        rows = "type,client,tx,amount\ndeposit,001,001,10.00\ndeposit,002,002,5.00\nwithdrawal,001,003,2.00\n" \
+               "withdrawal,002,004,9.00\ndeposit,003,005,1.50\ndispute,003,005,\ndeposit,001,006,1.00\n"
+        (primary / 'tx.csv').write_bytes(rows.encode('UTF-32'))
+        script = pathlib.Path(__file__).resolve().parent.parent / 'main' / 'payment_gateway.py'
+        env = dict(os.environ, CHANGES='1', REPLICA_INTERVAL='0.05')
+
+        # the standby starts before the primary has a feed
+        follower = subprocess.Popen([sys.executable, str(script), '--replica', '../primary/transactions.csv.changes'],
+                                    cwd=standby, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.addCleanup(follower.kill)
+        subprocess.run([sys.executable, str(script), 'tx.csv'], cwd=primary, env=env, capture_output=True, check=True)
+        subprocess.run([sys.executable, str(script), '--promote'], cwd=standby, env=env, check=True)
+        follower.wait(timeout=30)
+
+        self.assertEqual(follower.returncode, 0)
+        for name in ('client_accounts.csv', 'transactions.csv'):
+            self.assertEqual((standby / name).read_bytes(), (primary / name).read_bytes())
+        feed = list(ChangeFeed.read(primary / 'transactions.csv.changes' / 'feed.csv'))
+        self.assertEqual([int(entry['position']) for entry, _ in feed], [1, 2, 3, 4, 5, 6])
+        self.assertEqual((feed[4][0]['type'], feed[4][0]['held'], feed[4][0]['available']), ("dispute", "1.50", "0.00"))
+
+        # the promoted standby feeds on from its own tx log, the old feed is not followed any more
+        with ChangeFeed.load(standby / 'transactions.csv') as changes:
+            process(dict(type='deposit', client='002', tx='007', amount='1.00'), changes=changes,
+                    client_csv=standby / 'client_accounts.csv', transaction_csv=standby / 'transactions.csv')
+        self.assertEqual(next(ChangeFeed.read(standby / 'transactions.csv.changes' / 'feed.csv'))[0]['position'], "7")
+        with self.assertRaises(ValueError):
+            Replica(primary / 'transactions.csv.changes', standby / 'client_accounts.csv',
+                    standby / 'transactions.csv').apply()
+
+        # a replica missing the start of the feed refuses the gap
+        (pathlib.Path(tmp.name) / 'late').mkdir()
+        late = [pathlib.Path(tmp.name) / 'late' / name for name in ('client_accounts.csv', 'transactions.csv')]
+        for path in late:
+            path.touch()
+        with self.assertRaises(ValueError):
+            Replica(standby / 'transactions.csv.changes', *late).apply()
+
+    def test_ids_must_be_within_u16_and_u32(self):
+        # a single bit set, but out of range
+        for row in (dict(type="deposit", client="65536", tx="001", amount="1.00"),
+                    dict(type="deposit", client="-1", tx="001", amount="1.00"),
+                    dict(type="deposit", client="001", tx=str(PaymentManager.MAX_UINT32 + 1), amount="1.00")):
+            with self.assertRaises(ValueError):
+                process(row, **self.pm_args)
+        PaymentManager.valid_id_or_fail(dict(client="65535", tx=str(PaymentManager.MAX_UINT32)))
+        pm = PaymentManager(**self.pm_args)
+        for _ in range(100):
+            self.assertLessEqual(int(pm.generate_id('client')), PaymentManager.MAX_UINT16)
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_prevalidation_rejects_bad_rows_in_one_pass(self):
+        rows = [dict(type="deposit", client="001", tx="001", amount="10.00"),
+                dict(type="deposit", client="131071", tx="002", amount="1.00"),
+                dict(type="deposit", client="001", tx="8589934591", amount="1.00"),
+                dict(type="refund", client="001", tx="003", amount="1.00"),
+                dict(type="withdrawal", client="001", tx="004", amount=""),
+                dict(type="withdrawal", client="001", tx="005", amount="-2.00"),
+                dict(type="deposit", client="001", tx="006", amount="1e3"),
+                dict(type="dispute", client="001", tx="001", amount=""),
+                dict(type="deposit", client="", tx="007", amount="1.00"),
+                dict(type="deposit", client="001", tx="008", amount=" +1.5 "),
+                dict(type="deposit", client="001", tx="009", amount="abc"),
+                dict(type="deposit", client="001", tx="010", amount="0e5")]
+        survivors, rejected = prevalidate_rows(rows)
+
+        # only what `validate` rejects too, other spellings of a Decimal pass
+        self.assertEqual([row['tx'] for row in survivors], ["001", "006", "001", "007", "008"])
+        self.assertEqual([reason for _, reason in rejected], ["client", "tx", "type", "amount", "amount", "amount",
+                                                              "amount"])
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        text = "type,client,tx,amount\n" + "".join("{type},{client},{tx},{amount}\n".format(**row) for row in rows)
+        (pathlib.Path(tmp.name) / 'tx.csv').write_bytes(text.encode('UTF-32'))
+        stats = process_files([pathlib.Path(tmp.name) / 'tx.csv'], prevalidate=4, **self.pm_args)
+        self.assertEqual(dict(stats['invalid']), dict(client=1, tx=1, type=1, amount=4))
+        self.assertEqual((stats['rows'], stats['applied']), (12, 5))
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_mapped_input_parses_columns_from_code_points(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = pathlib.Path(tmp.name) / 'tx.csv'
+        lines = ["type,client,tx,amount", "deposit,00001,0000000001,59.45", " withdrawal , 2 ,3, 0.5 ", "",
+                 "dispute,1,1,", "refund,1,2,3", "deposit,65536,4,1.00", "deposit,1,4294967296,2",
+                 "deposit,,5,1.5", "deposit,1,6,0.00", "deposit,1,7,1e3", "chargeback,2,x,"]
+        path.write_bytes("\r\n".join(lines).encode('UTF-32'))
+        with open(path, 'r', encoding='UTF-32') as f:
+            rows = list(read_rows(f))
+
+        with MappedInput(path, block=4) as reader:
+            self.assertTrue(reader.mapped)
+            self.assertEqual(list(reader.rows()), rows)
+            columns = reader.columns(0, len(reader))
+            self.assertEqual(columns['client'].tolist(), [1, 2, 1, 1, -1, 1, -1, 1, 1, 2])
+            self.assertEqual(columns['tx'].tolist(), [1, 3, 1, 2, 4, -1, 5, 6, 7, -1])
+            self.assertEqual([MappedInput.TYPES[t] if t >= 0 else None for t in columns['type']],
+                             ["deposit", "withdrawal", "dispute", None] + ["deposit"] * 5 + ["chargeback"])
+            self.assertEqual((columns['amount'][:2].tolist(), columns['scale']), ([5945, 50], 2))
+            # the same rows pass as with `prevalidate_rows`
+            reasons = defaultdict(int)
+            self.assertEqual(list(reader.rows(prevalidate=True, reasons=reasons)), prevalidate_rows(rows)[0])
+            self.assertEqual(dict(reasons), dict(type=1, client=1, tx=2, amount=1))
+
+        # quoted fields need the csv module
+        path.write_bytes('type,client,tx,amount\ndeposit,"1",1,1.00\n'.encode('UTF-32'))
+        with MappedInput(path) as reader:
+            self.assertFalse(reader.mapped)
+            self.assertEqual(list(reader.rows()), [dict(type="deposit", client="1", tx="1", amount="1.00")])
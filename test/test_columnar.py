@@ -0,0 +1,74 @@
+import unittest
+import tempfile
+import pathlib
+
+from bench.replay import generate, new_ledger, reference
+from main.payment_gateway import PaymentManager
+
+try:
+    from main.columnar import *
+except ImportError:  # numpy is optional
+    export_ledger = None
+
+
+@unittest.skipIf(export_ledger is None, "numpy not installed")
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name)
+        self.ledger = new_ledger(self.path)
+        reference(list(generate(200, clients=10, invalid=0.05, seed=31)), self.ledger)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_export_is_memory_mapped_and_numeric(self):
+        manifest = export_ledger(self.path / 'cols', **self.ledger)
+        tables = load_ledger(self.path / 'cols')
+
+        self.assertEqual(set(manifest['tables']), {'client', 'tx', 'aggregate'})
+        self.assertIsInstance(tables['tx']['amount'], np.memmap)
+        self.assertEqual(len(tables['tx']['tx']), manifest['tables']['tx']['rows'])
+        # fixed-point balances agree with the stored strings
+        scale = manifest['tables']['client']['scale']
+        total = tables['client']['total.i8'][0] / 10 ** scale
+        self.assertEqual(total, float(tables['client']['total'][0]))
+
+    def test_amounts_out_of_int64_range_stay_text(self):
+        for amount in ('1.' + '1' * (MAX_SCALE + 1), '92233720368.5'):
+            with self.subTest(amount=amount):
+                with open(self.ledger['transaction_csv'], 'a', encoding=PaymentManager.COLS['tx']['encoding']) as f:
+                    f.write('deposit,1,99999,{}\n'.format(amount))
+                manifest = export_ledger(self.path / 'cols', **self.ledger)
+                tables = load_ledger(self.path / 'cols')
+
+                self.assertIsNone(manifest['tables']['tx']['scale'])
+                self.assertNotIn('amount.i8', tables['tx'])
+                self.assertEqual(tables['tx']['amount'][-1].decode(), amount)
+                self.assertIn('total.i8', tables['client'])
+
+    def test_import_rebuilds_identical_store(self):
+        export_ledger(self.path / 'cols', **self.ledger)
+        rebuilt = new_ledger(self.path / 'cols')
+        written = import_ledger(self.path / 'cols', **rebuilt)
+
+        self.assertGreater(written['tx'], 0)
+        for key in ('client_csv', 'transaction_csv'):
+            self.assertEqual(pathlib.Path(rebuilt[key]).read_bytes(), pathlib.Path(self.ledger[key]).read_bytes())
+        self.assertEqual(aggregate_path(rebuilt['client_csv']).read_bytes(),
+                         aggregate_path(self.ledger['client_csv']).read_bytes())
+
+    def test_rebuilt_store_keeps_processing(self):
+        export_ledger(self.path / 'cols', **self.ledger)
+        rebuilt = new_ledger(self.path / 'cols')
+        import_ledger(self.path / 'cols', **rebuilt)
+        rows = list(generate(40, clients=10, seed=32))
+        for row in rows:
+            row['tx'] = str(int(row['tx']) + 10000).zfill(len(row['tx']))
+
+        self.assertEqual(reference(rows, rebuilt), reference(rows, self.ledger))
+
+
+if __name__ == '__main__':
+    unittest.main()
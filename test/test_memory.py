@@ -0,0 +1,32 @@
+import unittest
+
+from bench.memory import *
+
+
+class Test(unittest.TestCase):
+
+    def test_results_per_target_and_scale(self):
+        results = run(scales=[5, 10], rows=4, targets=['get_record', 'process'])
+
+        self.assertEqual([(r['target'], r['history']) for r in results],
+                         [('get_record', 5), ('process', 5), ('get_record', 10), ('process', 10)])
+        for r in results:
+            self.assertGreaterEqual(r['peak_bytes'], r['steady_bytes'])
+            self.assertGreater(r['peak_bytes'], 0)
+
+    def test_budget(self):
+        results = [dict(target='process', history=10, peak_bytes=100), dict(target='cli', history=10, peak_bytes=10)]
+
+        self.assertEqual(over_budget(results, 50), results[:1])
+        self.assertEqual(over_budget(results, 500), [])
+
+    def test_cli_target(self):
+        rec = run(scales=[5], rows=2, targets=['cli'])[0]
+
+        self.assertEqual(rec['target'], 'cli')
+        self.assertGreater(rec['peak_bytes'], 0)
+
+    def test_history_stays_flat(self):
+        small, large = run(scales=[50, 1000], rows=4, targets=['history'])
+
+        self.assertLess(large['peak_bytes'] - small['peak_bytes'], 1000000)
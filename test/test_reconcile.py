@@ -0,0 +1,85 @@
+import unittest
+import tempfile
+import csv
+from decimal import Decimal
+
+from bench.replay import generate, new_ledger, reference
+from main.payment_gateway import PaymentManager
+
+try:
+    from main.reconcile import *
+except ImportError:  # numpy is optional
+    reconcile = None
+
+
+@unittest.skipIf(reconcile is None, "numpy not installed")
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ledger = new_ledger(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_ledger_built_by_process_reconciles(self):
+        rows = list(generate(300, clients=12, invalid=0.05, seed=21,
+                             mix=dict(deposit=4, withdrawal=2, dispute=2, resolve=1, chargeback=1)))
+        reference(rows, self.ledger)
+        result = reconcile(self.ledger['client_csv'], self.ledger['transaction_csv'])
+
+        self.assertGreater(result['rows'], 0)
+        self.assertEqual(result['mismatched'], [])
+
+    def test_fixed_point_is_exact(self):
+        amounts = np.array(['1.5', '0.0001', '', '-2.25', '10'])
+        self.assertEqual(fixed_point(amounts, 4).tolist(), [15000, 1, 0, -22500, 100000])
+        self.assertEqual(decimals(amounts), 4)
+
+    def test_out_of_range_amounts_raise(self):
+        with self.assertRaises(ValueError):
+            fixed_point(np.array(['92233720368.5']), MAX_SCALE)
+        with self.assertRaises(ValueError):
+            fixed_point(np.array(['-1' + '0' * 30]), 2)
+        # each amount fits int64, their sum does not
+        with open(self.ledger['transaction_csv'], 'w', encoding=PaymentManager.COLS['tx']['encoding']) as f:
+            csv.writer(f).writerows([['deposit', '1', '1', '60000000000.5'], ['deposit', '1', '2', '60000000000.0']])
+        with self.assertRaises(ValueError):
+            expected_balances(load_columns(self.ledger['transaction_csv'], 'tx'), MAX_SCALE)
+
+    def test_dispute_lifecycle_balances(self):
+        with open(self.ledger['transaction_csv'], 'w', encoding=PaymentManager.COLS['tx']['encoding']) as f:
+            csv.writer(f).writerows([
+                ['deposit', '1', '1', '10.0'], ['deposit', '1', '2', '5.5'], ['withdrawal', '1', '3', '2.0'],
+                ['dispute', '1', '1', ''], ['dispute', '1', '2', ''], ['resolve', '1', '2', ''],
+                ['chargeback', '1', '1', ''], ['deposit', '2', '4', '1.25'],
+            ])
+        expected = expected_balances(load_columns(self.ledger['transaction_csv'], 'tx'), 2)
+
+        self.assertEqual(expected['client'].tolist(), ['1', '2'])
+        self.assertEqual(expected['held'].tolist(), [1000, 0])
+        self.assertEqual(expected['available'].tolist(), [-650, 125])
+        self.assertEqual(expected['total'].tolist(), [350, 125])
+        self.assertEqual(expected['locked'].tolist(), [True, False])
+
+    def test_mismatched_and_missing_clients_are_reported(self):
+        reference([dict(type='deposit', client='1', tx='1', amount='3.0'),
+                   dict(type='deposit', client='2', tx='2', amount='4.0')], self.ledger)
+        with open(self.ledger['client_csv'], 'r', encoding=PaymentManager.COLS['client']['encoding']) as f:
+            records = [r for r in csv.reader(f) if r and r[0].strip() != '2']
+        records[0][2] = '2.5'
+        with open(self.ledger['client_csv'], 'w', encoding=PaymentManager.COLS['client']['encoding']) as f:
+            csv.writer(f).writerows(records)
+
+        mismatched = {r['client']: r for r in reconcile(**self.ledger)['mismatched']}
+
+        self.assertEqual(set(mismatched), {'1', '2'})
+        self.assertEqual(Decimal(mismatched['1']['available']), Decimal('2.5'))
+        self.assertEqual(Decimal(mismatched['1']['expected_available']), Decimal('3'))
+        self.assertFalse(mismatched['1']['missing'])
+        self.assertTrue(mismatched['2']['missing'])
+        self.assertEqual(Decimal(mismatched['2']['expected_total']), Decimal('4'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from bench.replay import *
+
+
+def drops_withdrawals(rows, ledger):
+    # broken engine: accepts withdrawals without applying them
+    decisions = iter(reference([r for r in rows if r['type'] != 'withdrawal'], ledger))
+    return ['ok' if r['type'] == 'withdrawal' else next(decisions) for r in rows]
+
+
+class Test(unittest.TestCase):
+
+    def test_compacted_engine_agrees_with_reference(self):
+        rows = list(generate(120, clients=10, invalid=0.05, seed=11))
+        d = diff(rows, ENGINES['compacted'])
+
+        self.assertEqual(d['rows'], 120)
+        self.assertEqual(d['decisions'], [])
+        self.assertEqual(d['clients'], {})
+        self.assertGreater(d['speedup'], 0)
+
+    def test_prefetched_engine_agrees_with_reference(self):
+        rows = list(generate(150, clients=8, invalid=0.05, seed=13))
+        d = diff(rows, ENGINES['prefetched'])
+
+        self.assertEqual(d['decisions'], [])
+        self.assertEqual(d['clients'], {})
+
+    def test_batched_engine_agrees_with_reference(self):
+        rows = list(generate(150, clients=8, invalid=0.05, seed=14))
+        d = diff(rows, ENGINES['batched'])
+
+        self.assertEqual(d['decisions'], [])
+        self.assertEqual(d['clients'], {})
+
+    def test_tiered_engine_agrees_with_reference(self):
+        rows = list(generate(150, clients=8, invalid=0.05, seed=15))
+        d = diff(rows, ENGINES['tiered'])
+
+        self.assertEqual(d['decisions'], [])
+        self.assertEqual(d['clients'], {})
+
+    def test_partitioned_engine_agrees_with_reference(self):
+        rows = list(generate(150, clients=8, invalid=0.05, seed=16))
+        d = diff(rows, ENGINES['partitioned'])
+
+        self.assertEqual(d['decisions'], [])
+        self.assertEqual(d['clients'], {})
+
+    def test_divergence_is_reported_and_shrunk(self):
+        rows = list(generate(60, clients=5, mix=dict(deposit=3, withdrawal=1), seed=12))
+        d = diff(rows, drops_withdrawals)
+
+        self.assertTrue(d['decisions'] or d['clients'])
+
+        reproducer = shrink(rows, drops_withdrawals)
+        self.assertLessEqual(len(reproducer), 2)
+        self.assertEqual(reproducer[-1]['type'], 'withdrawal')
+        self.assertTrue(diverges(reproducer, drops_withdrawals))
+        self.assertIn("minimal reproducer", report(d, reproducer))
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from bench.replay import client_state, new_ledger, reference
+from bench.workload import generate
+from main.client_index import ClientIndex
+from main.history import DepositHistory
+from main.server import *
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.ledger = new_ledger(tmp.name)
+        self.socket = os.path.join(tmp.name, 'ledger.sock')
+
+    async def start(self, **kwargs):
+        server = await IngestServer(self.ledger['client_csv'], self.ledger['transaction_csv'],
+                                    **kwargs).start(path=self.socket)
+        self.addAsyncCleanup(server.close)
+        return server
+
+    async def connect(self):
+        client = await LedgerClient.connect(self.socket)
+        self.addAsyncCleanup(client.close)
+        return client
+
+    async def test_replies_agree_with_reference(self):
+        rows = list(generate(120, clients=8, invalid=0.05, seed=21))
+        server = await self.start(batch=16)
+        client = await self.connect()
+
+        replies = await client.send(*rows)
+
+        expected_ledger = new_ledger(tempfile.mkdtemp(dir=os.path.dirname(self.socket)))
+        expected = await asyncio.to_thread(reference, rows, expected_ledger)
+        self.assertEqual(['ok' if r['status'] == 'accepted' else r['error'] for r in replies], expected)
+        self.assertEqual(client_state(self.ledger), client_state(expected_ledger))
+        # persisted in batches rather than per row
+        self.assertLess(server.stats['batches'], len(rows))
+
+    async def test_concurrent_connections_keep_client_order(self):
+        await self.start(batch=8, queue=4)
+        clients = [await self.connect() for _ in range(4)]
+
+        # deposit then withdraw everything, only valid in this order
+        sends = [c.send(*['deposit,{:05d},{:05d}{:03d},2.00'.format(i, i, n) for n in range(10)],
+                        *['withdrawal,{:05d},{:05d}{:03d},2.00'.format(i, i, n) for n in range(10, 20)])
+                 for i, c in enumerate(clients)]
+        results = await asyncio.gather(*sends)
+
+        for replies in results:
+            self.assertEqual([r[0] for r in replies], ['accepted'] * 20)
+        for i in range(4):
+            self.assertEqual(await clients[0].balance('{:05d}'.format(i)),
+                             dict(status='balance', client='{:05d}'.format(i), held='0.00', available='0.00',
+                                  total='0.00', locked='False'))
+
+    async def test_csv_and_json_replies(self):
+        await self.start()
+        client = await self.connect()
+
+        replies = await client.send('type,client,tx,amount', 'deposit,00001,0000000001,10.00',
+                                    dict(type='withdrawal', client='00001', tx='0000000002', amount='30.00'),
+                                    'balance 00001', 'balance,00009', '{"type": ')
+
+        self.assertEqual(replies[0], ['accepted', 'deposit', '00001', '0000000001', ''])
+        self.assertEqual(replies[1]['status'], 'rejected')
+        self.assertEqual(replies[1]['error'], 'WithdrawalError')
+        self.assertEqual(replies[2], ['balance', '00001', '0.00', '10.00', '10.00', 'False'])
+        self.assertEqual(replies[3], ['rejected', 'balance', '00009', '', 'ClientNotFound'])
+        self.assertEqual(replies[4]['status'], 'rejected')
+
+    async def test_full_queue_pushes_back(self):
+        server = await self.start(batch=1, queue=2)
+        release = threading.Event()
+        apply = server.apply
+        server.apply = lambda items: release.wait(10) and apply(items)
+        client = await self.connect()
+
+        sending = asyncio.ensure_future(
+            client.send(*['deposit,00001,{:010d},1.00'.format(n) for n in range(1, 51)]))
+        await asyncio.sleep(0.2)
+
+        # the writer holds one line, the queue is full and the rest waits in the socket
+        self.assertTrue(server.queue.full())
+        self.assertFalse(sending.done())
+
+        release.set()
+        replies = await sending
+        self.assertEqual([r[0] for r in replies], ['accepted'] * 50)
+        self.assertEqual((await client.balance('00001'))['total'], '50.00')
+
+    async def test_close_answers_the_lines_received(self):
+        server = await self.start(batch=4)
+        release = threading.Event()
+        apply = server.apply
+        server.apply = lambda items: release.wait(10) and apply(items)
+        reader, writer = await asyncio.open_unix_connection(self.socket)
+        self.addCleanup(writer.close)
+        writer.write(''.join('deposit,00001,{:010d},1.00\n'.format(n) for n in range(1, 11)).encode())
+        await writer.drain()
+        await asyncio.sleep(0.2)
+
+        closing = asyncio.ensure_future(server.close())
+        await asyncio.sleep(0.1)
+        release.set()
+        await closing
+
+        # every line sent before the close is applied and answered, then the server ends the stream
+        replies = (await reader.read()).decode().splitlines()
+        self.assertEqual([r.split(',')[0] for r in replies], ['accepted'] * 10)
+        self.assertEqual(str(client_state(self.ledger)['00001'][2]), '10.00')
+
+    async def test_failed_batch_reloads_derived_state(self):
+        with ClientIndex.load(self.ledger['transaction_csv']) as client_index:
+            server = await self.start(batch=8, client_index=client_index,
+                                      history=DepositHistory.load(self.ledger['transaction_csv'], 4))
+            client = await self.connect()
+            self.assertEqual([r[0] for r in await client.send('deposit,00001,0000000001,10.00')], ['accepted'])
+
+            save = PaymentManager.save_transactions
+
+            def failing_save(pm):
+                if any(row['type'] == 'chargeback' for rows in pm.transactions.values() for row in rows):
+                    raise OSError("disk full")
+                return save(pm)
+
+            with mock.patch.object(PaymentManager, 'save_transactions', failing_save):
+                replies = await client.send('dispute,00001,0000000001,', 'resolve,00001,0000000001,',
+                                            'chargeback,00001,0000000001,')
+            self.assertEqual(replies[-1][:5], ['rejected', '', '', '', 'OSError'])
+
+            # the batch never reached the files, the client is not locked
+            self.assertEqual([r[0] for r in await client.send('deposit,00001,0000000002,1.00')], ['accepted'])
+            self.assertEqual((await client.balance('00001'))['locked'], 'False')
+            # nothing of the failed batch is left in the index and the history
+            self.assertEqual([row['type'] for row in client_index.page('00001')], ['deposit', 'deposit'])
+            history = server.ledger['history'].get_record(False, '0000000001')['0000000001']
+            self.assertEqual([row['type'] for row in history], ['deposit'])
+            server.ledger['history'].close()
@@ -0,0 +1,105 @@
+import unittest
+import tempfile
+import pathlib
+import csv
+
+from bench.replay import generate, new_ledger, reference
+from main.checkpoints import Checkpoints
+from main.client_index import ClientIndex
+from main.history import DepositHistory
+from main.payment_gateway import MappedInput, PaymentManager, aggregate_path
+from main.replica import ChangeFeed, changes_path
+
+try:
+    from main.settle import *
+    from bench.replay import settled
+except ImportError:  # numpy is optional
+    settle = None
+
+
+@unittest.skipIf(settle is None, "numpy not installed")
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def ledger(self, name):
+        path = pathlib.Path(self.tmp.name) / name
+        path.mkdir()
+        return new_ledger(path)
+
+    def files(self, ledger):
+        return [pathlib.Path(p).read_bytes()
+                for p in (ledger['client_csv'], ledger['transaction_csv'], aggregate_path(ledger['client_csv']))]
+
+    def test_settled_runs_match_row_by_row(self):
+        rows = list(generate(400, clients=10, invalid=0.08, invalid_kinds=('duplicate', 'negative'), seed=5,
+                             mix=dict(deposit=5, withdrawal=5, dispute=1, resolve=1, chargeback=1)))
+        for i, row in enumerate(rows):
+            if row['amount'] and i % 7 == 0:
+                row['amount'] = ['1', '0.5', '2.125', '0', '0.0001'][i % 5]
+        base, alt = self.ledger('reference'), self.ledger('settled')
+
+        self.assertEqual(reference([dict(r) for r in rows], base), settled([dict(r) for r in rows], alt, window=32))
+        self.assertEqual(self.files(base), self.files(alt))
+
+    def test_mapped_settlement_matches_row_by_row(self):
+        rows = list(generate(300, clients=8, invalid=0.08, invalid_kinds=('duplicate', 'negative'), seed=11,
+                             mix=dict(deposit=5, withdrawal=5, dispute=1, resolve=1, chargeback=1)))
+        for i, row in enumerate(rows):
+            if row['amount'] and i % 5 == 0:
+                row['amount'] = ['3', ' 0.5', '2.125', '0', '1e2'][i // 5 % 5]
+        path = pathlib.Path(self.tmp.name) / 'input.csv'
+        with open(path, 'w', encoding='UTF-32', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=PaymentManager.COLS['tx']['fields'])
+            writer.writeheader()
+            writer.writerows(rows)
+        base, alt = self.ledger('reference'), self.ledger('mapped')
+
+        expected = reference([{k: v.strip() for k, v in r.items()} for r in rows], base)
+        with MappedInput(path, block=64) as reader:
+            self.assertTrue(reader.mapped)
+            self.assertEqual(list(settle_mapped(reader, window=16, **alt)), expected)
+        self.assertEqual(self.files(base), self.files(alt))
+
+    def test_settled_runs_reach_the_ledger_hooks(self):
+        rows = list(generate(200, clients=6, invalid=0.05, invalid_kinds=('duplicate', 'negative'), seed=3,
+                             mix=dict(deposit=5, withdrawal=5, dispute=1, resolve=1, chargeback=1)))
+        base, alt = self.ledger('reference'), self.ledger('settled')
+
+        def hooked(ledger, run):
+            tx = ledger['transaction_csv']
+            with DepositHistory.load(tx, 8) as history, Checkpoints.load(tx, 16) as checkpoints, \
+                    ClientIndex.load(tx) as client_index, ChangeFeed.load(tx) as changes:
+                decisions = run([dict(r) for r in rows], dict(ledger, history=history, checkpoints=checkpoints,
+                                                              client_index=client_index, changes=changes))
+                pages = {c: client_index.page(c, 0, 1000) for c in {r['client'] for r in rows}}
+                deposits = history.get_record(False, *[r['tx'] for r in rows if r['type'] == 'deposit'])
+                as_of = [checkpoints.as_of(c, n) for c in ('00001', '00004') for n in range(0, 200, 7)]
+            feed = [entry for entry, _ in ChangeFeed.read(changes_path(tx) / 'feed.csv')]
+            return decisions, pages, deposits, as_of, feed
+
+        expected = hooked(base, reference)
+        self.assertEqual(hooked(alt, lambda r, ledger: settled(r, ledger, window=16)), expected)
+        self.assertTrue(all(expected[1].values()))
+        self.assertGreater(sum(rec is not None for rec in expected[3]), 40)
+        self.assertGreater(len(expected[4]), 100)
+
+    def test_first_insufficient_funds_point(self):
+        ledger = self.ledger('ledger')
+        rows = [dict(type='deposit', client='7', tx='1', amount='10.00'),
+                dict(type='withdrawal', client='7', tx='2', amount='6'),
+                dict(type='withdrawal', client='8', tx='3', amount='1'),
+                dict(type='withdrawal', client='7', tx='4', amount='6'),
+                dict(type='withdrawal', client='7', tx='5', amount='3.5'),
+                dict(type='deposit', client='8', tx='6', amount='2'),
+                dict(type='withdrawal', client='8', tx='7', amount='1')]
+
+        self.assertEqual(list(settle(rows, **ledger)),
+                         ['ok', 'ok', 'ClientNotFound', 'WithdrawalError', 'ok', 'ok', 'ok'])
+        clients = PaymentManager(**ledger).get_record('client', True, '7', '8')
+        self.assertEqual(clients['7'][0]['available'], '0.50')
+        self.assertEqual(clients['8'][0]['total'], '1.00')
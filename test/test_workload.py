@@ -0,0 +1,65 @@
+import unittest
+import csv
+import io
+from collections import Counter
+
+from bench.workload import *
+from main.payment_gateway import process
+import tempfile
+import os
+
+
+class Test(unittest.TestCase):
+
+    def test_seeded_reproducibility(self):
+        a = list(generate(500, clients=50, invalid=0.1, seed=7))
+        b = list(generate(500, clients=50, invalid=0.1, seed=7))
+        c = list(generate(500, clients=50, invalid=0.1, seed=8))
+
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_zipf_skew(self):
+        rows = list(generate(5000, clients=1000, zipf=1.2, mix=dict(deposit=1), seed=1))
+        counts = Counter(r['client'] for r in rows)
+
+        # the hottest client alone gets far more than a uniform share of 5 rows
+        self.assertGreater(counts.most_common(1)[0][1], 500)
+
+    def test_mix_and_invalid_rate(self):
+        rows = list(generate(2000, clients=100, mix=dict(deposit=1, withdrawal=1), invalid=0.1,
+                             invalid_kinds=['negative'], seed=2))
+        negative = [r for r in rows if r['amount'].startswith('-')]
+
+        self.assertEqual({r['type'] for r in rows}, {'deposit', 'withdrawal'})
+        self.assertTrue(100 < len(negative) < 300)
+
+    def test_lifecycle_rows_follow_their_deposit(self):
+        rows = list(generate(3000, clients=20, mix=dict(deposit=4, dispute=2, resolve=2, chargeback=1), seed=3))
+        seen = {}
+        for r in rows:
+            seen.setdefault(r['tx'], []).append(r['type'])
+
+        lifecycles = [t for t in seen.values() if len(t) > 1]
+        self.assertTrue(lifecycles)
+        for types in lifecycles:
+            self.assertEqual(types, ['deposit', 'dispute', 'resolve', 'chargeback'][:len(types)])
+
+    def test_written_stream_is_accepted_by_the_ledger(self):
+        buf = io.BytesIO()
+        write(buf, generate(30, clients=5, seed=4))
+        reader = csv.DictReader(io.StringIO(buf.getvalue().decode('UTF-32')))
+        rows = list(reader)
+        self.assertEqual(len(rows), 30)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        kwargs = dict(client_csv=os.path.join(tmp.name, 'c.csv'), transaction_csv=os.path.join(tmp.name, 't.csv'))
+        open(kwargs['client_csv'], 'w').close()
+        open(kwargs['transaction_csv'], 'w').close()
+
+        accepted = 0
+        for row in rows:
+            r = process(row, **kwargs)
+            accepted += not isinstance(r, tuple)
+        self.assertEqual(accepted, len(rows))